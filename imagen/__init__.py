@@ -8,7 +8,8 @@ PatternGenerator classes can be derived from these, and can then be
 combined with the existing classes easily.
 """
 
-import sys, os, copy
+import sys, os, collections
+from multiprocessing.pool import ThreadPool
 
 # Add param submodule to sys.path
 cwd = os.path.abspath(os.path.split(__file__)[0])
@@ -32,6 +33,9 @@ from param import ClassSelector
 from .patterngenerator import PatternGenerator, CompositeBase, Composite
 from .patterngenerator import Constant, ChannelTransform, ChannelGenerator # pyflakes:ignore (API import)
 from .patterngenerator import CorrelateChannels, ComposeChannels # pyflakes:ignore (API import)
+from .patterngenerator import TranslationCache, GeneratorSpec # pyflakes:ignore (API import)
+from .patterngenerator import _same_values, _subgenerators
+from .patterngenerator import _is_repeatable, _has_output_fns, _has_untimed_dynamic_values
 
 
 from holoviews.element import Image                    # pyflakes:ignore (API import)
@@ -58,6 +62,8 @@ class HalfPlane(PatternGenerator):
     with optional Gaussian smoothing.
     """
 
+    _pointwise = True
+
     smoothing = param.Number(default=0.02,bounds=(0.0,None),softbounds=(0.0,0.5),
                              precedence=0.61,doc="Width of the Gaussian fall-off.")
 
@@ -87,6 +93,8 @@ class Gaussian(PatternGenerator):
       exp(-x^2/(2*xsigma^2) - y^2/(2*ysigma^2)
     """
 
+    _pointwise = True
+
     aspect_ratio = param.Number(default=1/0.31,bounds=(0.0,None),softbounds=(0.0,6.0),
         precedence=0.31,doc="""
         Ratio of the width to the height.
@@ -121,6 +129,8 @@ class ExponentialDecay(PatternGenerator):
       exp(-sqrt((x/xscale)^2 - (y/yscale)^2))
     """
 
+    _pointwise = True
+
     aspect_ratio = param.Number(default=1/0.31,bounds=(0.0,None),softbounds=(0.0,2.0),
         precedence=0.31,doc="""Ratio of the width to the height.""")
 
@@ -137,6 +147,8 @@ class ExponentialDecay(PatternGenerator):
 class SineGrating(PatternGenerator):
     """2D sine grating pattern generator."""
 
+    _pointwise = True
+
     frequency = param.Number(default=2.4,bounds=(0.0,None),softbounds=(0.0,10.0),
                        precedence=0.50, doc="Frequency of the sine grating.")
 
@@ -152,6 +164,8 @@ class SineGrating(PatternGenerator):
 class Gabor(PatternGenerator):
     """2D Gabor pattern generator."""
 
+    _pointwise = True
+
     frequency = param.Number(default=2.4,bounds=(0.0,None),softbounds=(0.0,10.0),
         precedence=0.50,doc="Frequency of the sine grating component.")
 
@@ -179,6 +193,12 @@ class Gabor(PatternGenerator):
 class Line(PatternGenerator):
     """2D line pattern generator."""
 
+    # The minimal thickness is enforced by counting pixels across the
+    # whole array, which cannot be done one location at a time.
+    @property
+    def _pointwise(self):
+        return not self.enforce_minimal_thickness
+
     # Hide unused parameters
     size = param.Number(precedence=-1.0)
 
@@ -245,6 +265,8 @@ class Disk(PatternGenerator):
     stretching that was closest to P.
     """
 
+    _pointwise = True
+
     aspect_ratio  = param.Number(default=1.0,bounds=(0.0,None),softbounds=(0.0,2.0),
         precedence=0.31,doc=
         "Ratio of width to height; size*aspect_ratio gives the width of the disk.")
@@ -271,6 +293,8 @@ class Ring(PatternGenerator):
     See the Disk class for a note about the Gaussian fall-off.
     """
 
+    _pointwise = True
+
     thickness = param.Number(default=0.015,bounds=(0.0,None),softbounds=(0.0,0.5),
         precedence=0.60,doc="Thickness (line width) of the ring.")
 
@@ -343,6 +367,8 @@ class RawRectangle(PatternGenerator):
     drawing patterns pixel by pixel.
     """
 
+    _pointwise = True
+
     aspect_ratio   = param.Number(default=1.0,bounds=(0.0,None),softbounds=(0.0,2.0),
         precedence=0.31,doc=
         "Ratio of width to height; size*aspect_ratio gives the width of the rectangle.")
@@ -363,6 +389,8 @@ class Rectangle(PatternGenerator):
     edges.
     """
 
+    _pointwise = True
+
     aspect_ratio = param.Number(default=1.0,bounds=(0.0,None),softbounds=(0.0,6.0),
         precedence=0.31,doc=
         "Ratio of width to height; size*aspect_ratio gives the width of the rectangle.")
@@ -393,6 +421,8 @@ class Arc(PatternGenerator):
     See the Disk class for a note about the Gaussian fall-off.
     """
 
+    _pointwise = True
+
     aspect_ratio = param.Number(default=1.0,bounds=(0.0,None),softbounds=(0.0,6.0),
         precedence=0.31,doc="""
         Ratio of width to height; size*aspect_ratio gives the overall width.""")
@@ -473,6 +503,8 @@ class Curve(Arc):
 class SquareGrating(PatternGenerator):
     """2D squarewave (symmetric or asymmetric) grating pattern generator."""
 
+    _pointwise = True
+
     frequency = param.Number(default=2.4,bounds=(0.0,None),softbounds=(0.0,10.0),
         precedence=0.50,doc="Frequency of the square grating.")
 
@@ -521,6 +553,16 @@ class Selector(CompositeBase):
     PatternGenerator that selects from a list of other PatternGenerators.
     """
 
+    _shares_render_context = False
+
+    generators = param.List(class_=(PatternGenerator,GeneratorSpec),default=[Constant(scale=0.0)],
+                            bounds=(1,None),precedence=0.97,doc="""
+        List of patterns to select from.  Items may also be
+        GeneratorSpecs, each of which is replaced in the list by the
+        PatternGenerator it describes when it is first selected, so
+        that long lists (e.g. one image per file of a large dataset)
+        are cheap to set up.""")
+
     # CB: needs to have time_fn=None
     index = param.Number(default=numbergen.UniformRandom(lbound=0,ubound=1.0,seed=76),
         bounds=(-1.0,1.0),precedence=0.20,doc="""
@@ -529,24 +571,191 @@ class Selector(CompositeBase):
         random value or other number generator, to allow a different item
         to be selected each time.""")
 
+    cache_size = param.Integer(default=0,bounds=(0,None),precedence=-1,doc="""
+        Number of drawn patterns to keep, so that selecting a
+        generator again with the same parameter values (its own and
+        those of any generators it contains) returns a copy of the
+        earlier result, instead of drawing it again (e.g. decoding
+        and resampling an image file).  When the cache is full, the
+        least recently used pattern is discarded.  Generators whose
+        dynamic parameters produce a new value on every access, or
+        whose output functions keep state, are always drawn.""")
+
+    prefetch = param.Integer(default=0,bounds=(0,None),precedence=-1,doc="""
+        Number of upcoming selections to prepare in the background
+        while the current one is drawn, e.g. so that their image files
+        are already decoded (see FileImage._prefetch_image) when they are
+        selected.  The upcoming selections are predicted by evaluating
+        the index at the next times (according to the timestep of its
+        time function), so this is only possible when the index is a
+        time-dependent number generator (or an expression of them).
+        The parameters of a predicted generator are looked up at the
+        time it is predicted for, and only the decoding is done in the
+        background; generators whose dynamic parameters produce a new
+        value on every access are not prepared.  GeneratorSpecs that
+        are predicted are created in the background, so the
+        parameters they specify should not be dynamic.  The threads
+        are stopped when prefetch is set back to 0.""")
+
+    prefetch_threads = param.Integer(default=2,bounds=(1,None),precedence=-1,doc="""
+        Number of threads used to prepare upcoming selections.""")
+
+
+    def __init__(self, **params):
+        super(Selector,self).__init__(**params)
+        self._cache = collections.OrderedDict()
+        self._prefetched = collections.OrderedDict()
+        self._prefetch_pool = None
+
+
+    def __getstate__(self):
+        """
+        Return the object's state (as in the superclass), but without
+        the cached patterns, which are drawn again when needed, or the
+        background preparation of upcoming selections.
+        """
+        state = super(Selector,self).__getstate__()
+        state['_cache'] = collections.OrderedDict()
+        state['_prefetched'] = collections.OrderedDict()
+        state['_prefetch_pool'] = None
+        return state
+
+
+    def __setstate__(self, state):
+        # Selectors pickled before patterns were cached or prefetched
+        state.setdefault('_cache',collections.OrderedDict())
+        state.setdefault('_prefetched',collections.OrderedDict())
+        state.setdefault('_prefetch_pool',None)
+        super(Selector,self).__setstate__(state)
+
+
+    def __del__(self):
+        self._stop_prefetching()
+
+
+    def _stop_prefetching(self):
+        "Stop the threads preparing upcoming selections, if any."
+        pool = getattr(self,'_prefetch_pool',None)
+        if pool is not None:
+            self._prefetch_pool = None
+            self._prefetched.clear()
+            # Lets the threads finish what they are preparing, and exit
+            pool.close()
+
+
+    def _generator(self, generators, index):
+        """Return generators[index], creating it first if it is a GeneratorSpec."""
+        pg = generators[index]
+        if isinstance(pg,GeneratorSpec):
+            item, pending = self._prefetched.get(index,(None,None))
+            pg = generators[index] = pending.get() if item is pg else pg()
+        return pg
+
+
+    def _prefetch_upcoming(self, p):
+        """
+        Start preparing the generators selected at the next p.prefetch
+        times in the background, if they can be predicted.
+        """
+        index_generator = self.get_value_generator('index')
+        time_fn = _time_fn_of(index_generator)
+        if time_fn is None:
+            return
+
+        now = time_fn()
+        for step in range(1,p.prefetch+1):
+            with time_fn as t:
+                t(now+step*time_fn.timestep)
+                index = int(len(p.generators)*wrap(0,1.0,index_generator()))
+                item = p.generators[index]
+                if self._prefetched.get(index,(None,None))[0] is item:
+                    continue
+                task = self._prefetch_task(item,p)
+
+            if task is None:
+                continue
+            if self._prefetch_pool is None:
+                self._prefetch_pool = ThreadPool(p.prefetch_threads)
+            self._prefetched.pop(index,None)
+            self._prefetched[index] = item, self._prefetch_pool.apply_async(task)
+            while len(self._prefetched) > 2*p.prefetch:
+                self._prefetched.popitem(last=False)
+
+
+    def _prefetch_task(self, item, p):
+        """
+        Return a function that prepares item (as selected under p)
+        in the background, or None if there is nothing to prepare.
+        The function only decodes files or creates the generator
+        described by a GeneratorSpec; the parameters of an existing
+        generator are looked up by this call, on this thread.
+        """
+        if isinstance(item,GeneratorSpec):
+            # Creating an image generator also loads its image
+            return item
+        if hasattr(item,'_prefetch_image') and not _has_untimed_dynamic_values(item):
+            return item._prefetch_image(**self._overrides(p,item))
+        return None
+
+
+    def _overrides(self, p, pg):
+        """Return the parameters with which pg is drawn when selected under p."""
+        return dict(
+            xdensity=p.xdensity,ydensity=p.ydensity,bounds=p.bounds,
+            x=p.x+p.size*(pg.x*np.cos(p.orientation)-pg.y*np.sin(p.orientation)),
+            y=p.y+p.size*(pg.x*np.sin(p.orientation)+pg.y*np.cos(p.orientation)),
+            orientation=pg.orientation+p.orientation,size=pg.size*p.size,
+            scale=pg.scale*p.scale,offset=pg.offset+p.offset)
+
 
     def function(self,p):
         """Selects and returns one of the patterns in the list."""
+        if p.prefetch:
+            self._prefetch_upcoming(p)
+        else:
+            self._stop_prefetching()
+
         int_index=int(len(p.generators)*wrap(0,1.0,p.index))
-        pg=p.generators[int_index]
+        pg=self._generator(p.generators,int_index)
+        overrides = self._overrides(p,pg)
 
-        image_array = pg(xdensity=p.xdensity,ydensity=p.ydensity,bounds=p.bounds,
-                         x=p.x+p.size*(pg.x*np.cos(p.orientation)-pg.y*np.sin(p.orientation)),
-                         y=p.y+p.size*(pg.x*np.sin(p.orientation)+pg.y*np.cos(p.orientation)),
-                         orientation=pg.orientation+p.orientation,size=pg.size*p.size,
-                         scale=pg.scale*p.scale,offset=pg.offset+p.offset)
+        key = self._cache_key(pg,int_index,overrides) if p.cache_size else None
+        if key is None:
+            return self._draw_generator(pg,overrides)
+
+        if key in self._cache:
+            image_array, channel_data = self._cache.pop(key)
+        else:
+            image_array = self._draw_generator(pg,overrides)
+            channel_data = list(getattr(pg,'_channel_data',[]))
+        self._cache[key] = image_array, channel_data
+        while len(self._cache) > p.cache_size:
+            self._cache.popitem(last=False)
+
+        if channel_data:
+            pg._channel_data = [np.array(c) for c in channel_data]
+        return np.array(image_array)
+
+
+    def _cache_key(self, pg, index, overrides):
+        """
+        Return a hashable key for drawing pg with the given overrides,
+        or None if the result should not be cached.
+        """
+        if not _is_repeatable(pg):
+            return None
+        try:
+            key = (index,id(pg),_frozen(sorted(overrides.items())),_parameter_key(pg))
+            hash(key)
+        except TypeError:
+            return None
+        return key
 
-        return image_array
 
     def get_current_generator(self):
         """Return the current generator (as specified by self.index)."""
         int_index=int(len(self.generators)*wrap(0,1.0,self.inspect_value('index')))
-        return self.generators[int_index]
+        return self._generator(self.generators,int_index)
 
     def channels(self, use_cached=False, **params_to_override):
         """
@@ -570,12 +779,64 @@ class Selector(CompositeBase):
         """
         if(self.inspect_value('index') is None):
             if(len(self.generators)>0):
-                return self.generators[0].num_channels()
+                return self._generator(self.generators,0).num_channels()
             return 0
 
         return self.get_current_generator().num_channels()
 
 
+def _time_fn_of(value):
+    """
+    Return the time function of which the number generator value is a
+    pure function, or None if its values cannot be predicted from the
+    time (e.g. random values that are not time_dependent).
+    """
+    if isinstance(value,numbergen.BinaryOperator):
+        operands = [value.lhs,value.rhs]
+    elif isinstance(value,numbergen.UnaryOperator):
+        operands = [value.operand]
+    elif isinstance(value,numbergen.TimeAware):
+        if value.time_dependent and isinstance(value.time_fn,param.Time):
+            return value.time_fn
+        return None
+    else:
+        return None
+
+    time_fns = set()
+    for operand in operands:
+        if callable(operand):
+            time_fn = _time_fn_of(operand)
+            if time_fn is None:
+                return None
+            time_fns.add(time_fn)
+    return time_fns.pop() if len(time_fns)==1 else None
+
+
+def _frozen(value):
+    """
+    Return a hashable equivalent of value, or raise TypeError if there
+    is none.
+    """
+    if isinstance(value,boundingregion.BoundingRegion):
+        return value.lbrt()
+    if isinstance(value,(list,tuple)):
+        return tuple(_frozen(v) for v in value)
+    if isinstance(value,np.ndarray):
+        raise TypeError("Arrays cannot be used as keys.")
+    hash(value)
+    return value
+
+
+def _parameter_key(pg):
+    """
+    Return a hashable key for the parameter values of pg and of any
+    PatternGenerators it contains.
+    """
+    return (_frozen(pg.get_param_values()),
+            tuple(_parameter_key(sub) for sub in _subgenerators(pg)))
+
+
+
 class OffsetTimeFn(param.Parameterized):
     """
     A picklable version of the global time function with a custom offset
@@ -605,6 +866,9 @@ class Sweeper(ChannelGenerator):
     supplied PatternGenerator is sweeped further at a fixed speed, and
     after reset_period time steps a new pattern is drawn.
     """
+
+    _shares_render_context = False
+
     generator = param.ClassSelector(PatternGenerator,default=Gaussian(),precedence=0.97,
                                     doc="Pattern to sweep.")
 
@@ -629,6 +893,62 @@ class Sweeper(ChannelGenerator):
     time_fn = param.Callable(default=param.Dynamic.time_fn,doc="""
         Function to generate the time used as a base for translation.""")
 
+    fast_translation = param.ObjectSelector(default='none',
+        objects=['none','integer','fourier'],precedence=-1,doc="""
+        How frames are produced from a single drawing of the generator
+        per episode (see TranslationCache): 'integer' only when the
+        pattern has moved by a whole number of matrix units, 'fourier'
+        for any movement (approximately, for patterns with sharp
+        edges), or 'none' to draw the generator at every step.
+        Translating by whole units matches drawing the generator only
+        up to floating-point rounding, so patterns with sharp edges
+        (e.g. thresholded ones) can differ at pixels lying exactly on
+        an edge.""")
+
+    precompute_episodes = param.Boolean(default=False,precedence=-1,doc="""
+        Whether to draw all the frames of an episode together when the
+        episode starts, keeping them until the next episode.  Frames
+        of generators whose values do not depend on neighboring
+        locations are then computed in a single call covering all the
+        motion offsets.  Changes to the generator's parameters other
+        than its position, orientation, scale and offset then take
+        effect from the next episode.  Generators that could change
+        during an episode (because a generator they contain has
+        dynamic parameters of its own, or because their dynamic
+        parameters produce a new value on every access) are still
+        drawn at every step.""")
+
+    episode_block_bytes = param.Integer(default=2**17,bounds=(1,None),precedence=-1,doc="""
+        Approximate size in bytes of the frames drawn in a single call
+        when the frames of an episode are drawn together
+        (precompute_episodes).  Frames larger than this are still
+        drawn by the same vectorized path, one frame per call.""")
+
+
+    def __init__(self, **params):
+        super(Sweeper,self).__init__(**params)
+        self._translations = TranslationCache()
+        self._episode_key = None
+        self._episode = None
+
+
+    def __getstate__(self):
+        """
+        Return the object's state (as in the superclass), but without
+        the precomputed frames, which are drawn again when needed.
+        """
+        state = super(Sweeper,self).__getstate__()
+        state['_episode_key'] = state['_episode'] = None
+        return state
+
+
+    def __setstate__(self, state):
+        # Sweepers pickled before translations and episodes were cached
+        state.setdefault('_translations',TranslationCache())
+        state.setdefault('_episode_key',None)
+        state.setdefault('_episode',None)
+        super(Sweeper,self).__setstate__(state)
+
 
     def num_channels(self):
         return self.generator.num_channels()
@@ -642,38 +962,124 @@ class Sweeper(ChannelGenerator):
         pg.set_dynamic_time_fn(motion_time_fn)
         motion_orientation = pg.orientation + p.relative_motion_orientation
 
-        step = int(p.time_fn() % p.reset_period) + p.step_offset
+        frame = int(p.time_fn() % p.reset_period)
+        step = frame + p.step_offset
 
         new_x = p.x + p.size * pg.x
         new_y = p.y + p.size * pg.y
 
-        try:
-            #TFALERT: Not sure whether this is needed
-            if(len(self._channel_data)!=len(pg._channel_data)):
-               self._channel_data=copy.deepcopy(pg._channel_data)
-
-            # For multichannel pattern generators
-            for i in range(len(pg._channel_data)):
-                self._channel_data[i] = pg.channels(
-                    x=new_x + p.speed * step * np.cos(motion_orientation),
-                    y=new_y + p.speed * step * np.sin(motion_orientation),
-                    xdensity=p.xdensity, ydensity=p.ydensity,
-                    bounds=p.bounds,
-                    orientation=pg.orientation + p.orientation,
-                    scale=pg.scale * p.scale, offset=pg.offset + p.offset)[i]
-        except AttributeError:
-            pass
-
-        image_array = pg(xdensity=p.xdensity, ydensity=p.ydensity,
-                         bounds=p.bounds,
-                         x=new_x + p.speed * step * np.cos(motion_orientation),
-                         y=new_y + p.speed * step * np.sin(motion_orientation),
+        overrides = dict(xdensity=p.xdensity, ydensity=p.ydensity, bounds=p.bounds,
                          orientation=pg.orientation + p.orientation,
                          scale=pg.scale * p.scale, offset=pg.offset + p.offset)
 
+        if p.precompute_episodes:
+            key = (motion_time_fn(), pg, sorted(overrides.items()), new_x, new_y,
+                   p.speed, motion_orientation, p.step_offset, p.reset_period)
+            if not _same_values(key,self._episode_key):
+                self._episode = None
+                if self._fixed_for_episode(pg):
+                    steps = p.step_offset + np.arange(int(np.ceil(p.reset_period)))
+                    self._episode = self._draw_episode(
+                        pg, dict(overrides, x=new_x, y=new_y),
+                        p.speed * steps * np.cos(motion_orientation),
+                        p.speed * steps * np.sin(motion_orientation))
+                self._episode_key = key
+            if self._episode is not None:
+                frames, channel_frames = self._episode
+                self._channel_data = [np.array(c[frame]) for c in channel_frames]
+                return np.array(frames[frame])
+
+        dx = p.speed * step * np.cos(motion_orientation)
+        dy = p.speed * step * np.sin(motion_orientation)
+
+        # For multichannel pattern generators
+        if isinstance(pg, ChannelGenerator):
+            channels = pg.channels(x=new_x + dx, y=new_y + dy, **overrides)
+            self._channel_data = [channels[i] for i in range(len(pg._channel_data))]
+            return channels['default']
+
+        # Frames of an episode differ only in the position of the pattern
+        max_step = max(abs(p.step_offset),abs(p.step_offset+np.ceil(p.reset_period)-1))
+        image_array = self._translations(
+            pg, dict(overrides, x=new_x, y=new_y), dx, dy,
+            margin=p.speed * max_step, mode=p.fast_translation)
+
+        if image_array is None:
+            image_array = pg(x=new_x + dx, y=new_y + dy, **overrides)
+
         return image_array
 
 
+    def _fixed_for_episode(self, pg):
+        """
+        Return True if pg will draw the same pattern at every step of
+        an episode, apart from the motion.
+        """
+        return _is_repeatable(pg,fixed_subgenerators=True)
+
+
+    def _draw_episode(self, pg, overrides, dxs, dys):
+        """
+        Return the frames of pg(**overrides) moved by each of dxs,
+        dys, as a sequence with one frame per movement, along with a
+        list of such sequences for any channels of pg.
+        """
+        scs = SheetCoordinateSystem(overrides['bounds'],overrides['xdensity'],overrides['ydensity'])
+        rows,cols = scs.shape
+        block = max(1,self.episode_block_bytes // (rows*cols*np.dtype(float).itemsize))
+
+        if not isinstance(pg, ChannelGenerator) and not _has_output_fns(pg):
+            x_points,y_points = scs.sheetcoordinates_of_matrixidx()
+            frames = np.empty((len(dxs),rows,cols))
+            try:
+                for i in range(0,len(dxs),block):
+                    frames[i:i+block] = self._draw_moved(pg,overrides,x_points,y_points,
+                                                         dxs[i:i+block],dys[i:i+block])
+                return frames, []
+            except NotImplementedError:
+                pass
+
+        frames, channel_frames = [], []
+        for dx,dy in zip(dxs,dys):
+            moved = dict(overrides, x=overrides['x']+dx, y=overrides['y']+dy)
+            if isinstance(pg, ChannelGenerator):
+                channels = pg.channels(**moved)
+                frames.append(channels['default'])
+                channel_frames.append([channels[i] for i in range(len(pg._channel_data))])
+            else:
+                frames.append(pg(**moved))
+        return frames, [list(c) for c in zip(*channel_frames)]
+
+
+    def _draw_moved(self, pg, overrides, x_points, y_points, dxs, dys):
+        """
+        Return pg(**overrides) moved by each of dxs, dys, computed in
+        a single call, or raise NotImplementedError if pg does not
+        support this.
+        """
+        if not pg._renders_pointwise():
+            return pg.sample(x_points[np.newaxis,np.newaxis,:]-dxs[:,np.newaxis,np.newaxis],
+                             y_points[np.newaxis,:,np.newaxis]-dys[:,np.newaxis,np.newaxis],
+                             **dict((k,v) for k,v in overrides.items()
+                                    if k not in ('bounds','xdensity','ydensity')))
+
+        # Moving the pattern moves its coordinates the opposite way
+        p = ParamOverrides(pg,overrides)
+        pattern_x,pattern_y = pg._create_and_rotate_coordinate_arrays(
+            x_points-p.x,y_points-p.y,p.orientation)
+        offset_x,offset_y = pg._rotate_coordinate_arrays(dxs,dys,p.orientation)
+        pg.pattern_x = pattern_x - offset_x[:,np.newaxis,np.newaxis]
+        pg.pattern_y = pattern_y - offset_y[:,np.newaxis,np.newaxis]
+        frames = pg.function(p)
+        if p.mask is not None:
+            frames = frames * p.mask
+        if p.scale != 1.0:
+            frames = p.scale * frames
+        if p.offset != 0.0:
+            frames = frames + p.offset
+        return frames
+
+
 
 class Spiral(PatternGenerator):
     """
@@ -683,6 +1089,8 @@ class Spiral(PatternGenerator):
     Spiral is defined by polar equation r=size*angle plotted in Gaussian plane.
     """
 
+    _pointwise = True
+
     aspect_ratio = param.Number(default=1.0,bounds=(0.0,None),softbounds=(0.0,2.0),
         precedence=0.31,doc="Ratio of width to height.")
 
@@ -755,6 +1163,8 @@ class HyperbolicGrating(PatternGenerator):
     abs(x^2/a^2 - y^2/a^2) = 1, where a mod size = 0
     """
 
+    _pointwise = True
+
     aspect_ratio = param.Number(default=1.0,bounds=(0.0,None),softbounds=(0.0,2.0),
         precedence=0.31,doc="Ratio of width to height.")
 
@@ -796,6 +1206,8 @@ class Wedge(PatternGenerator):
     A sector of a circle with Gaussian fall-off, with size determining the arc length.
     """
 
+    _pointwise = True
+
     aspect_ratio = param.Number(default=1.0,bounds=(0.0,None),softbounds=(0.0,2.0),
         precedence=0.31,doc="Ratio of width to height.")
 
@@ -912,6 +1324,8 @@ class ConcentricRings(PatternGenerator):
     Gaussian fall-off at the edges.
     """
 
+    _pointwise = True
+
     aspect_ratio = param.Number(default=1.0,bounds=(0.0,None),softbounds=(0.0,2.0),
         precedence=0.31,doc="Ratio of width to height.")
 
@@ -964,9 +1378,9 @@ class ArcCentered(Arc):
     def function(self,p):
         if p.aspect_ratio==0.0:
             return self.pattern_x*0.0
-        self.pattern_x -= (1+np.cos(pi-p.arc_length/2))*p.size/4
+        pattern_x = self.pattern_x - (1+np.cos(pi-p.arc_length/2))*p.size/4
 
-        return arc_by_radian((self.pattern_x+p.size/2)/p.aspect_ratio, self.pattern_y, p.size,
+        return arc_by_radian((pattern_x+p.size/2)/p.aspect_ratio, self.pattern_y, p.size,
                              (2*pi-p.arc_length/2, p.arc_length/2), p.thickness, p.smoothing)
 
 
@@ -1022,6 +1436,8 @@ class Sigmoid(PatternGenerator):
     them.
     """
 
+    _pointwise = True
+
     slope = param.Number(default=10.0, bounds=(None,None), softbounds=(-100.0,100.0),
         doc="""Parameter controlling the smoothness of the transition
         between the two regions; high values give a sharp transition.""")
@@ -38,11 +38,10 @@ classes, and will rarely need to be used directly.
 
 """
 
-from math import pi, fmod, floor
+from math import pi
 
 import param
 import copy
-import colorsys
 import numpy as np
 
 
@@ -71,45 +70,103 @@ def _threeDdot_opt(M,a):
     # need to do asarray to ensure dtype?
     return np.asarray(b,dtype=a.dtype)
 
-# CB: probably could make a faster version if do aM instead,
-# e.g. something like (untested):
-
-#def _threeDdot(M,a):
-#    shape = a.shape
-#    result = np.dot(a.reshape((-1,3)),M)
-#    result.shape = shape
-#    return result
-
-threeDdot = _threeDdot_opt
-
-
-def _abc_to_def_array(ABC,fn):
-    shape = ABC[:,:,0].shape
-    dtype = ABC.dtype
-
-    DEF = np.zeros(ABC.shape,dtype=dtype)
-
-    for i in range(shape[0]):
-        for j in range(shape[1]):
-            DEF[i,j,0],DEF[i,j,1],DEF[i,j,2]=fn(ABC[i,j,0],ABC[i,j,1],ABC[i,j,2])
-
-    return DEF
-
+def _threeDdot_aM(M,a,out=None):
+    """
+    Return Ma for each pixel, computed as a.M^T in the type of a (if
+    a is floating point), which avoids copying a into the layout (and
+    type) np.dot(M,...) would require.  The result may be written to
+    out, which may be a itself.
+    """
+    if np.issubdtype(a.dtype,np.floating):
+        M = M.astype(a.dtype)
+        return np.matmul(a,M.T,out=out)
+    result = np.asarray(np.matmul(a,M.T),dtype=a.dtype)
+    if out is None:
+        return result
+    out[...] = result
+    return out
 
-def _rgb_to_hsv_array(RGB):
-    """Equivalent to colorsys.rgb_to_hsv, except expects array like :,:,3"""
-    return _abc_to_def_array(RGB,colorsys.rgb_to_hsv)
+threeDdot = _threeDdot_aM
 
 
-def _hsv_to_rgb_array(HSV):
-    """Equivalent to colorsys.hsv_to_rgb, except expects array like :,:,3"""
-    return _abc_to_def_array(HSV,colorsys.hsv_to_rgb)
+def _rgb_to_hsv_array(RGB, out=None):
+    """
+    Equivalent to colorsys.rgb_to_hsv applied to each pixel of an
+    array like :,:,3, returning an array of the same type (which may
+    be supplied as out, and may be RGB itself).
+    """
+    R, G, B = RGB[...,0], RGB[...,1], RGB[...,2]
+    # (np.maximum is much faster than RGB.max(axis=-1))
+    maxc = np.maximum(np.maximum(R,G),B)
+    rangec = maxc - np.minimum(np.minimum(R,G),B)
+    gray = rangec==0
+
+    # Gray pixels have zero hue and saturation; dividing by 1 instead
+    # of 0 avoids spurious warnings
+    divisor = np.where(gray,1,rangec)
+    S = rangec / np.where(gray,1,maxc)
+    rc, gc, bc = (maxc-R)/divisor, (maxc-G)/divisor, (maxc-B)/divisor
+    H = np.where(R==maxc, bc-gc, np.where(G==maxc, 2.0+rc-bc, 4.0+gc-rc))
+    H /= 6.0
+    # H % 1.0, but np.floor is much faster than np.mod
+    H -= np.floor(H)
+    H[gray] = 0
+
+    if out is None:
+        out = np.empty(RGB.shape,dtype=RGB.dtype)
+    out[...,0], out[...,1], out[...,2] = H, S, maxc
+    return out
+
+
+def _hsv_to_rgb_array(HSV, out=None):
+    """
+    Equivalent to colorsys.hsv_to_rgb applied to each pixel of an
+    array like :,:,3, returning an array of the same type (which may
+    be supplied as out, and may be HSV itself).
+    """
+    H, S, V = HSV[...,0], HSV[...,1], HSV[...,2]
+    H6 = H*6.0
+    VS = V*S
+
+    # Branch-free form of colorsys' six cases: each channel is V
+    # reduced by VS over the part of the hue circle far from its own
+    # hue, ramping linearly in between (so zero saturation gives V)
+    def channel(n):
+        k = n+H6
+        k -= 6.0*np.floor(k/6.0)
+        return V - VS*np.clip(np.minimum(k,4.0-k),0.0,1.0)
+    R, G, B = channel(5.0), channel(3.0), channel(1.0)
+
+    if out is None:
+        out = np.empty(HSV.shape,dtype=HSV.dtype)
+    out[...,0], out[...,1], out[...,2] = R, G, B
+    return out
+
+
+def _gamma_rgb_array(RGB, out=None):
+    "Apply the sRGB gamma to linear RGB values (into out, if supplied)."
+    result = np.where(RGB<=0.0031308, 12.92*RGB, 1.055*np.power(RGB,1/2.4)-0.055)
+    if out is None:
+        return result
+    out[...] = result
+    return out
+
+
+def _ungamma_rgb_array(RGB, out=None):
+    "Remove the sRGB gamma from RGB values (into out, if supplied)."
+    result = np.where(RGB<=0.04045, RGB/12.92, np.power((RGB+0.055)/1.055,2.4))
+    if out is None:
+        return result
+    out[...] = result
+    return out
 
 
 # these aliases can be overriden after loading this file, if
-# optimized versions are available
+# optimized versions (accepting the same arguments) are available
 rgb_to_hsv = _rgb_to_hsv_array
 hsv_to_rgb = _hsv_to_rgb_array
+gamma_rgb = _gamma_rgb_array
+ungamma_rgb = _ungamma_rgb_array
 
 
 # Should document where these constants are from.
@@ -126,7 +183,7 @@ def xyz_to_lab(XYZ,wp):
         t = t.copy() # probably unnecessary!
         t_eps = t>EPS
         t_not_eps = t<=EPS
-        t[t_eps] = np.power(t[t_eps], 1.0/3)
+        t[t_eps] = np.cbrt(t[t_eps])
         t[t_not_eps] = (KAP*t[t_not_eps]+16.0)/116.
         return t
 
@@ -165,7 +222,7 @@ def lab_to_lch(LAB):
     L,A,B = np.dsplit(LAB,3)
     range_ = 2*pi
     x = np.arctan2(B,A)
-    return np.dstack( (L, np.hypot(A,B), fmod(x + 2*range_*(1-floor(x/(2*range_))), range_) ) )
+    return np.dstack( (L, np.hypot(A,B), np.fmod(x + 2*range_*(1-np.floor(x/(2*range_))), range_) ) )
 
 
 def xyz_to_lch(XYZ,whitepoint):
@@ -246,10 +303,42 @@ def xyz_to_lch01(XYZ, whitepoint):
 
 def lch01_to_xyz(LCH, whitepoint):
     L,C,H = np.dsplit(LCH,3)
-    L*=Lmax
-    C*=Cmax
-    H*=Hmax
-    return lch_to_xyz(np.dstack((L,C,H)),whitepoint)
+    return lch_to_xyz(np.dstack((L*Lmax,C*Cmax,H*Hmax)),whitepoint)
+
+
+
+# Conversions between XYZ and each color space, as sequences of
+# stages: ('matrix',name) multiplies by the named matrix in
+# ColorSpace.transforms, ('array',name) applies the named function of
+# this module to the array, ('elementwise',name) does the same for a
+# function of each value alone (which can therefore be applied to a
+# lookup table instead), and ('whitepoint',name) applies the named
+# function of this module to the array and the whitepoint.
+_to_xyz = {
+    'xyz': [],
+    'rgb': [('matrix','xyz_from_rgb')],
+    'lms': [('matrix','xyz_from_lms')],
+    'lch': [('whitepoint','lch01_to_xyz')],
+    'gammargb': [('elementwise','ungamma_rgb'),('matrix','xyz_from_rgb')],
+    'hsv': [('array','hsv_to_rgb'),('elementwise','ungamma_rgb'),('matrix','xyz_from_rgb')]}
+
+_from_xyz = {
+    'xyz': [],
+    'rgb': [('matrix','rgb_from_xyz')],
+    'lms': [('matrix','lms_from_xyz')],
+    'lch': [('whitepoint','xyz_to_lch01')],
+    'gammargb': [('matrix','rgb_from_xyz'),('elementwise','gamma_rgb')],
+    'hsv': [('matrix','rgb_from_xyz'),('elementwise','gamma_rgb'),('array','rgb_to_hsv')]}
+
+# Pairs of stages that undo each other, and so can be left out of a
+# conversion (e.g. RGB to HSV need not pass through XYZ)
+_inverse_stages = {}
+for _a,_b in [(('matrix','xyz_from_rgb'),('matrix','rgb_from_xyz')),
+              (('matrix','xyz_from_lms'),('matrix','lms_from_xyz')),
+              (('elementwise','gamma_rgb'),('elementwise','ungamma_rgb')),
+              (('array','rgb_to_hsv'),('array','hsv_to_rgb')),
+              (('whitepoint','xyz_to_lch01'),('whitepoint','lch01_to_xyz'))]:
+    _inverse_stages[_a], _inverse_stages[_b] = _b, _a
 
 
 
@@ -257,7 +346,7 @@ class ColorSpace(param.Parameterized):
     """
     Low-level color conversion. The 'convert' method handles color
     conversion to and from (and through) XYZ, and supports RGB, LCH,
-    LMS and HSV.
+    LMS and HSV (and gamma-corrected RGB, as 'gammargb').
     """
 
     whitepoint = param.String(default='D65', doc="""
@@ -280,27 +369,151 @@ class ColorSpace(param.Parameterized):
     dtype = param.Parameter(default=np.float32, doc="Datatype to use for result.")
 
 
-    def convert(self, from_, to, what):
+    def __init__(self, **params):
+        super(ColorSpace,self).__init__(**params)
+        self._plans = {}
+        self._tables = {}
+
+
+    def __getstate__(self):
+        # Conversion plans and lookup tables are made again when needed
+        state = super(ColorSpace,self).__getstate__()
+        state['_plans'] = {}
+        state['_tables'] = {}
+        return state
+
+
+    def __setstate__(self, state):
+        # ColorSpaces pickled before conversions were planned
+        state.setdefault('_plans',{})
+        state.setdefault('_tables',{})
+        super(ColorSpace,self).__setstate__(state)
+
+
+    def convert(self, from_, to, what, out=None):
         """
         Convert image or color "what" from "from_" colorpace to "to"
         colorspace.  E.g.: ``convert("rgb", "hsv", X)``, where X is a
         numpy dstack or a color tuple.
-        """
 
-        if(from_.lower()==to.lower()):
-            return what
+        If an array out is supplied, the result is written to it
+        instead; out may be what itself (if it has the type self.dtype),
+        in which case it is converted in place.
+
+        Arrays of 8- or 16-bit unsigned integers (e.g. images as
+        stored in files) are taken to be fractions of the largest
+        value of their type, and converted by looking them up in a
+        table (see _lookup), which is much faster.
+        """
+        from_, to = from_.lower(), to.lower()
+        if from_==to:
+            if out is None:
+                return what
+            out[...] = what
+            return out
+
+        plan = self._plan(from_,to)
+        if isinstance(what,np.ndarray) and what.dtype in (np.uint8,np.uint16):
+            in_shape = self._get_shape(what)
+            a, plan = self._lookup(np.array(what,copy=False,ndmin=3),from_,to,plan)
+            owned = True
+        else:
+            a, in_shape = self._prepare_input(what,*self.input_limits)
+            owned = a is not what or a is out
+
+        for kind,op in plan:
+            if kind=='matrix':
+                a = threeDdot(op,a,out=a if owned else None)
+                owned = True
+            elif kind in ('array','elementwise'):
+                a = op(a,out=a if owned else None)
+                owned = True
+            else:
+                a = op(a,self._triwp())
+                owned = True
+            self._clip(a,*self.output_limits,action=self.output_clip)
+
+        a = self._put_shape(a,in_shape)
+        if out is None or a is out:
+            return a
+        out[...] = a
+        return out
 
-        # Check if there exist an optimized function that performs
-        # from_to_to conversion
-        direct_conversion = '%s_to_%s'%(from_.lower(),to.lower())
-        if( hasattr(self, direct_conversion ) ):
-            fn = getattr(self, direct_conversion)
-            return fn(what)
 
-        from_to_xyz = getattr(self, '%s_to_xyz'%(from_.lower()) )
-        xyz_to_to = getattr(self, 'xyz_to_%s'%(to.lower()) )
+    def _plan(self, from_, to):
+        """
+        Return the stages converting from_ to to, as (kind,operation)
+        pairs: 'matrix' stages multiply by a 3x3 matrix, 'array' and
+        'elementwise' stages apply a function accepting an out array,
+        and 'whitepoint' stages apply a function of the array and the
+        whitepoint.  Plans are cached for each whitepoint.
+
+        Conversions pass through XYZ, except that stages undoing each
+        other are left out, and consecutive matrices are multiplied
+        together so that each linear part of the conversion is a
+        single pass (without clipping the values between them).
+        """
+        key = (from_,to,self.whitepoint)
+        cached = self._plans.get(key)
+        if cached is not None and cached[0] is self.transforms:
+            return cached[1]
 
-        return xyz_to_to( from_to_xyz(what) )
+        try:
+            route = _to_xyz[from_] + _from_xyz[to]
+        except KeyError:
+            raise ValueError("Cannot convert from %s to %s." % (from_,to))
+        stages = []
+        for stage in route:
+            if stages and _inverse_stages[stage]==stages[-1]:
+                stages.pop()
+            else:
+                stages.append(stage)
+
+        matrices = self.transforms[self.whitepoint]
+        plan = []
+        for kind,name in stages:
+            if kind=='matrix':
+                M = matrices[name]
+                if plan and plan[-1][0]=='matrix':
+                    plan[-1] = ('matrix',np.dot(M,plan[-1][1]))
+                else:
+                    plan.append(('matrix',M))
+            else:
+                plan.append((kind,globals()[name]))
+
+        self._plans[key] = (self.transforms,plan)
+        return plan
+
+
+    def _lookup(self, what, from_, to, plan):
+        """
+        Return the unsigned integer array what converted to self.dtype
+        by table lookup, and the stages of plan remaining to be
+        applied.
+
+        The table holds the fraction of the type's largest value that
+        each integer represents, with the plan's leading elementwise
+        stages (e.g. removing the gamma of 8-bit sRGB images) already
+        applied, so that a single lookup replaces both the conversion
+        to floating point and per-value power functions.  The results
+        are those of converting what/max by the analytic path.
+        """
+        key = (from_,to,self.whitepoint,what.dtype.str)
+        cached = self._tables.get(key)
+        if cached is None or cached[0] is not plan:
+            maximum = np.iinfo(what.dtype).max
+            table = np.arange(maximum+1,dtype=self.dtype)/self.dtype(maximum)
+            if table.min()<self.input_limits[0] or table.max()>self.input_limits[1]:
+                raise ValueError('Input out of limits')
+            n = 0
+            while n<len(plan) and plan[n][0]=='elementwise':
+                table = plan[n][1](table,out=table)
+                self._clip(table,*self.output_limits,action=self.output_clip)
+                n += 1
+            cached = self._tables[key] = (plan,table,n)
+
+        plan, table, n = cached
+        return table[what], plan[n:]
 
 
     def _triwp(self):
@@ -347,99 +560,74 @@ class ColorSpace(param.Parameterized):
         a.clip(min_limit,max_limit,out=a)
 
 
-    def _threeDdot(self,M,a):
-        # b = Ma
-        a, in_shape = self._prepare_input(a,*self.input_limits)
-        b = threeDdot(M,a)
-        self._clip(b,*self.output_limits,action=self.output_clip)
-        self._put_shape(b,in_shape)
-        return b
-
-    def _ABC_to_DEF_by_fn(self,ABC,fn,*fnargs):
-        ABC, in_shape = self._prepare_input(ABC,*self.input_limits)
-        DEF = fn(ABC,*fnargs)
-        self._clip(DEF,*self.output_limits,action=self.output_clip)
-        self._put_shape(DEF, in_shape)
-        return DEF
-
     ##  TO XYZ:     RGB, LCH, LMS, HSV(passing through RGB)
     def rgb_to_xyz(self,RGB):
-        return self._threeDdot(
-            self.transforms[self.whitepoint]['xyz_from_rgb'], RGB)
+        return self.convert('rgb','xyz',RGB)
 
 
     def lch_to_xyz(self,LCH):
-        return self._ABC_to_DEF_by_fn(LCH,lch01_to_xyz,self._triwp())
+        return self.convert('lch','xyz',LCH)
 
 
     def lms_to_xyz(self,LMS):
-        return self._threeDdot(
-            self.transforms[self.whitepoint]['xyz_from_lms'], LMS)
+        return self.convert('lms','xyz',LMS)
 
 
     def hsv_to_xyz(self,HSV):
-        return self.rgb_to_xyz(self.hsv_to_rgb(HSV))
+        return self.convert('hsv','xyz',HSV)
 
     ##  XYZ TO:RGB, LCH, LMS, HSV(passing through RGB)
 
     def xyz_to_rgb(self,XYZ):
-        return self._threeDdot(
-            self.transforms[self.whitepoint]['rgb_from_xyz'], XYZ)
+        return self.convert('xyz','rgb',XYZ)
 
 
     def xyz_to_lch(self, XYZ):
-        return self._ABC_to_DEF_by_fn(XYZ,xyz_to_lch01,self._triwp())
+        return self.convert('xyz','lch',XYZ)
 
 
     def xyz_to_lms(self,XYZ):
-        return self._threeDdot(
-            self.transforms[self.whitepoint]['lms_from_xyz'], XYZ)
+        return self.convert('xyz','lms',XYZ)
 
 
     def xyz_to_hsv(self, XYZ):
-        return self.rgb_to_hsv( self.xyz_to_rgb(XYZ) )
+        return self.convert('xyz','hsv',XYZ)
+
 
-    # Optimized
-    @staticmethod
-    def _gamma_rgb(RGB):
-        return (12.92*RGB*(RGB<=0.0031308)
-                + ((1+0.055)*RGB**(1/2.4) - 0.055) * (RGB>0.0031308))
+    _gamma_rgb = staticmethod(_gamma_rgb_array)
 
-    @staticmethod
-    def _ungamma_rgb(RGB):
-        return (RGB/12.92*(RGB<=0.04045)
-                + (((RGB+0.055)/1.055)**2.4) * (RGB>0.04045))
+    _ungamma_rgb = staticmethod(_ungamma_rgb_array)
 
     def rgb_to_hsv(self,RGB):
         "linear rgb to hsv"
-        gammaRGB = self._gamma_rgb(RGB)
-        return self._ABC_to_DEF_by_fn(gammaRGB,rgb_to_hsv)
+        return self.convert('rgb','hsv',RGB)
 
     def hsv_to_rgb(self,HSV):
         "hsv to linear rgb"
-        gammaRGB = self._ABC_to_DEF_by_fn(HSV,hsv_to_rgb)
-        return self._ungamma_rgb(gammaRGB)
+        return self.convert('hsv','rgb',HSV)
 
     def hsv_to_gammargb(self,HSV):
         "hsv is already specifying gamma corrected rgb"
-        return self._ABC_to_DEF_by_fn(HSV,hsv_to_rgb)
+        return self.convert('hsv','gammargb',HSV)
 
     def lch_to_gammargb(self,LCH):
-        return self._gamma_rgb(self.lch_to_rgb(LCH))
+        return self.convert('lch','gammargb',LCH)
 
-    def lms_to_lch(self,LCH):
-        lch_to_xyz
+    def lms_to_lch(self,LMS):
+        return self.convert('lms','lch',LMS)
 
 
 
 def _swaplch(LCH):
-    "Reverse the order of an LCH numpy dstack or tuple for analysis."
-    try: # Numpy array
-        L,C,H = np.dsplit(LCH,3)
-        return np.dstack((H,C,L))
-    except: # Tuple
-        L,C,H = LCH
-        return H,C,L
+    """
+    Reverse the order of an LCH numpy dstack or tuple for analysis.
+    Arrays are reversed as a view, so that they can still be
+    converted in place.
+    """
+    if isinstance(LCH,np.ndarray):
+        return LCH[...,::-1]
+    L,C,H = LCH
+    return H,C,L
 
 
 
@@ -474,21 +662,32 @@ class ColorConverter(param.Parameterized):
         'LCH': _swaplch }
 
 
-    def image2working(self,i):
+    # The methods below accept an array out to write the result to
+    # (see ColorSpace.convert), which may be the input itself.
+
+    def image2working(self,i,out=None):
         """Transform images i provided into the specified working
         color space."""
         return self.colorspace.convert(self.image_space,
-                                       self.working_space, i)
+                                       self.working_space, i, out=out)
 
-    def working2analysis(self,r):
+    def working2analysis(self,r,out=None):
         "Transform working space inputs to the analysis color space."
-        a = self.colorspace.convert(self.working_space, self.analysis_space, r)
+        a = self.colorspace.convert(self.working_space, self.analysis_space, r, out=out)
+        return self.swap_polar_HSVorder[self.analysis_space](a)
+
+    def image2analysis(self,i,out=None):
+        """
+        Transform images i directly to the analysis color space, as
+        working2analysis(image2working(i)) but in a single conversion.
+        """
+        a = self.colorspace.convert(self.image_space, self.analysis_space, i, out=out)
         return self.swap_polar_HSVorder[self.analysis_space](a)
 
-    def analysis2working(self,a):
+    def analysis2working(self,a,out=None):
         "Convert back from the analysis color space to the working space."
         a = self.swap_polar_HSVorder[self.analysis_space](a)
-        return self.colorspace.convert(self.analysis_space, self.working_space, a)
+        return self.colorspace.convert(self.analysis_space, self.working_space, a, out=out)
 
     def analysis2display(self,a):
         """
@@ -502,12 +701,14 @@ class ColorConverter(param.Parameterized):
 
     def jitter_hue(self,a,amount):
         "Rotate the hue component of a by the given amount."
-        a[:,:,0] += amount
-        a[:,:,0] %= 1.0
+        hue = a[...,0]
+        hue += amount
+        # hue %= 1.0, but np.floor is much faster than np.mod
+        hue -= np.floor(hue)
 
     def multiply_sat(self,a,factor):
         "Scale the saturation of a by the given amount."
-        a[:,:,1] *= factor
+        a[...,1] *= factor
 
 
 # Provide a shared color_conversion object
@@ -10,7 +10,7 @@ from numpy import pi
 
 from param.parameterized import ParamOverrides
 
-from .patterngenerator import Constant, PatternGenerator, Composite
+from .patterngenerator import Constant, PatternGenerator, Composite, TranslationCache
 from . import Gaussian
 from .image import FileImage, PatternSampler, ImageSampler, edge_average
 
@@ -205,6 +205,9 @@ class Translator(PatternGenerator):
     cannot be passed in when the instance is called; only the values
     set on the instance are used.
     """
+
+    _shares_render_context = False
+
     generator = param.ClassSelector(default=Gaussian(),
         class_=PatternGenerator,doc="""Pattern to be translated.""")
 
@@ -233,6 +236,18 @@ class Translator(PatternGenerator):
     time_fn = param.Callable(default=param.Dynamic.time_fn,doc="""
         Function to generate the time used as a base for translation.""")
 
+    fast_translation = param.ObjectSelector(default='none',
+        objects=['none','integer','fourier'],precedence=-1,doc="""
+        How frames are produced from a single drawing of the generator
+        per episode (see TranslationCache): 'integer' only when the
+        pattern has moved by a whole number of matrix units, 'fourier'
+        for any movement (approximately, for patterns with sharp
+        edges), or 'none' to draw the generator every time.
+        Translating by whole units matches drawing the generator only
+        up to floating-point rounding, so patterns with sharp edges
+        (e.g. thresholded ones) can differ at pixels lying exactly on
+        an edge.""")
+
     def _advance_params(self):
         """
         Explicitly generate new values for these parameters only
@@ -245,9 +260,16 @@ class Translator(PatternGenerator):
 
     def __init__(self,**params):
         super(Translator,self).__init__(**params)
+        self._translations = TranslationCache()
         self._advance_params()
 
 
+    def __setstate__(self, state):
+        # Translators pickled before translations were cached
+        state.setdefault('_translations',TranslationCache())
+        super(Translator,self).__setstate__(state)
+
+
     def __call__(self,**params_to_override):
         p=ParamOverrides(self,params_to_override)
 
@@ -277,6 +299,16 @@ class Translator(PatternGenerator):
         # float(t) required because time could be e.g. gmpy.mpq
         t = float(self.time_fn()-self.last_time)
 
+        # Frames of an episode differ only in the position of the pattern
+        image_array = self._translations(
+            p.generator, dict(xdensity=p.xdensity,ydensity=p.ydensity,bounds=p.bounds,
+                              x=x+p.generator.x,y=y+p.generator.y,
+                              orientation=(direction-pi/2)+p.generator.orientation),
+            t*np.cos(direction)*p.speed,t*np.sin(direction)*p.speed,
+            margin=p.reset_period*p.speed,mode=p.fast_translation)
+        if image_array is not None:
+            return image_array
+
         ## CEBALERT: mask gets applied twice, both for the underlying
         ## generator and for this one.  (leads to redundant
         ## calculations in current lissom_oo_or usage, but will lead
@@ -312,6 +344,8 @@ class OldSweeper(PatternGenerator):
     direction perpendicular to its orientation.
     """
 
+    _shares_render_context = False
+
     generator = param.Parameter(default=Gaussian(),precedence=0.97, doc="Pattern to sweep.")
 
     speed = param.Number(default=0.25,bounds=(0.0,None),doc="""
@@ -321,6 +355,27 @@ class OldSweeper(PatternGenerator):
         Number of steps at the given speed to move in the sweep direction.
         The distance moved is speed*step.""")
 
+    fast_translation = param.ObjectSelector(default='none',
+        objects=['none','integer','fourier'],precedence=-1,doc="""
+        How patterns at different steps are produced from a single
+        drawing of the generator (see TranslationCache): 'integer' only
+        when the pattern has moved by a whole number of matrix units,
+        'fourier' for any movement (approximately, for patterns with
+        sharp edges), or 'none' to draw the generator every time.
+        Translating by whole units matches drawing the generator only
+        up to floating-point rounding, so patterns with sharp edges
+        (e.g. thresholded ones) can differ at pixels lying exactly on
+        an edge.""")
+
+    def __init__(self,**params):
+        super(OldSweeper,self).__init__(**params)
+        self._translations = TranslationCache()
+
+    def __setstate__(self, state):
+        # OldSweepers pickled before translations were cached
+        state.setdefault('_translations',TranslationCache())
+        super(OldSweeper,self).__setstate__(state)
+
     # Provide access to value needed for measuring maps
     def __get_phase(self): return self.generator.phase
     def __set_phase(self,new_val): self.generator.phase = new_val
@@ -334,11 +389,20 @@ class OldSweeper(PatternGenerator):
         new_x = p.x+p.size*pg.x
         new_y = p.y+p.size*pg.y
 
-        image_array = pg(xdensity=p.xdensity,ydensity=p.ydensity,bounds=p.bounds,
-                         x=new_x + p.speed*p.step*np.cos(motion_orientation),
-                         y=new_y + p.speed*p.step*np.sin(motion_orientation),
-                         orientation=p.orientation,
-                         scale=pg.scale*p.scale,offset=pg.offset+p.offset)
+        image_array = self._translations(
+            pg, dict(xdensity=p.xdensity,ydensity=p.ydensity,bounds=p.bounds,
+                     x=new_x,y=new_y,orientation=p.orientation,
+                     scale=pg.scale*p.scale,offset=pg.offset+p.offset),
+            p.speed*p.step*np.cos(motion_orientation),
+            p.speed*p.step*np.sin(motion_orientation),
+            margin=abs(p.speed*p.step),mode=p.fast_translation)
+
+        if image_array is None:
+            image_array = pg(xdensity=p.xdensity,ydensity=p.ydensity,bounds=p.bounds,
+                             x=new_x + p.speed*p.step*np.cos(motion_orientation),
+                             y=new_y + p.speed*p.step*np.sin(motion_orientation),
+                             orientation=p.orientation,
+                             scale=pg.scale*p.scale,offset=pg.offset+p.offset)
 
         return image_array
 
@@ -26,10 +26,17 @@ import param
 from param.parameterized import overridable_property
 from holoviews.core import BoundingBox, SheetCoordinateSystem
 
-from .patterngenerator import ChannelGenerator, ChannelTransform
-from .transferfn import DivisiveNormalizeLinf, TransferFn
+from .patterngenerator import ChannelGenerator, ChannelTransform, _same_values
+from .transferfn import DivisiveNormalizeLinf, TransferFn, TransferFnWithState
 
+import os
 from os.path import splitext
+import collections
+import functools
+import threading
+import struct
+import zipfile
+import weakref
 
 import numbergen
 
@@ -101,14 +108,60 @@ class PatternSampler(ImageSampler):
         corresponds to one matrix unit of the Sheet on which the
         pattern being displayed.""")
 
+    index_cache_size = param.Integer(default=8,bounds=(0,None),doc="""
+        Number of sampling geometries (the shape of the image, the
+        supplied coordinates, sheet densities, width and height, and
+        the size_normalization) for which to keep the indices of the
+        image pixels sampled, so that drawing the same geometry again
+        (e.g. another image of the same shape, or the same image again)
+        only has to look up the pixels.  Each geometry kept takes about
+        four times the memory of the supplied x coordinates.""")
+
+    mipmap = param.Boolean(default=False,doc="""
+        Whether to sample images drawn smaller than their original
+        size from a mipmap: copies of the image (after the
+        whole_pattern_output_fns) reduced by successive factors of
+        two, each pixel being the average of a 2x2 block of pixels of
+        the previous copy.  The copy sampled is the smallest that still
+        has at least one pixel per sample, so that each sample is an
+        average of the pixels around it rather than a single pixel
+        (avoiding aliasing), and fewer pixels of the image are
+        accessed.  The position and extent of the pattern are the same
+        as without the mipmap.  Copies are made when first needed and
+        kept with the processed image (see ProcessedImageCache).""")
+
+    def __init__(self, **params):
+        super(PatternSampler,self).__init__(**params)
+        self._index_cache = collections.OrderedDict()
+        self._processed_key = None
+
+    def __getstate__(self):
+        state = super(PatternSampler,self).__getstate__()
+        state['_index_cache'] = collections.OrderedDict()
+        state['_processed_key'] = None
+        state['_mipmaps'] = {}
+        state.pop('_last_pil_image',None)
+        # The image is supplied again whenever a pattern is sampled
+        state['scs'] = None
+        return state
+
+    def __setstate__(self, state):
+        state.setdefault('_index_cache',collections.OrderedDict())
+        state.setdefault('_processed_key',None)
+        super(PatternSampler,self).__setstate__(state)
+
     def _get_image(self):
         return self.scs.activity
 
     def _set_image(self,image):
         # Stores a SheetCoordinateSystem with an activity matrix
         # representing the image
-        if not isinstance(image,np.ndarray):
-            image = np.array(image,np.float)
+        # whole_pattern_output_fns work in place, so read-only
+        # (e.g. shared, see ImageCache) images are copied
+        if not isinstance(image,np.ndarray) or not image.flags.writeable:
+            image = np.asarray(image,np.float)
+            if not image.flags.writeable:
+                image = image.copy()
 
         rows,cols = image.shape
         self.scs = SheetCoordinateSystem(xdensity=1.0,ydensity=1.0,
@@ -118,6 +171,7 @@ class PatternSampler(ImageSampler):
 
     def _del_image(self):
         self.scs = None
+        self._mipmaps = {}
 
 
     def __call__(self, image, x, y, sheet_xdensity, sheet_ydensity, width=1.0, height=1.0):
@@ -139,26 +193,174 @@ class PatternSampler(ImageSampler):
         # CEB: could allow image=None in args and have 'if image is
         # not None: self.image=image' here to avoid re-initializing the
         # image.
-        self.image=image
+        self._process(image)
+
+        pattern_rows,pattern_cols = self.image.shape
+
+        if width==0 or height==0 or pattern_cols==0 or pattern_rows==0:
+            return np.ones(x.shape)*self.background_value
+
+        return self._sample(x,y,sheet_xdensity,sheet_ydensity,width,height)
+
 
+    def _sample(self, x, y, sheet_xdensity, sheet_ydensity, width, height):
+        """
+        Return the pixels of self.image at the given (x,y)
+        coordinates, or self.background_value for those outside it.
+        """
+        factor = self._mipmap_factor(sheet_xdensity,sheet_ydensity,width,height)
+        index,outside = self._sample_indices(x,y,sheet_xdensity,sheet_ydensity,width,height,factor)
+        result = self._mipmap_level(factor).take(index)
+        if outside is not None:
+            result.flat[outside] = self.background_value
+        return result
+
+
+    def _process(self, image):
+        """
+        Set self.image to the supplied image with the
+        whole_pattern_output_fns applied, and self.background_value to
+        its background value, using those kept in
+        processed_image_cache from a previous call with the same image
+        if possible.
+        """
+        signature = self._processing_signature(image)
+        if signature is not None:
+            cached = processed_image_cache.get(image,signature)
+            if cached is not None:
+                self.scs,self.background_value,self._mipmaps = cached
+                self._processed_key = id(image)
+                return
+
+        self.image=image
         for wpof in self.whole_pattern_output_fns:
             wpof(self.image)
         if not self.background_value_fn:
             self.background_value = 0.0
         else:
             self.background_value = self.background_value_fn(self.image)
+        self._mipmaps = {1:self.image}
+        self._processed_key = None
+
+        if signature is not None and processed_image_cache.put(
+                image,signature,self.scs,self.background_value,self._mipmaps):
+            # Shared with other samplers from now on
+            self.image.flags.writeable = False
+            self._processed_key = id(image)
+
+
+    def _processing_signature(self, image):
+        """
+        Return what the processing of image depends on, other than
+        the image itself, or None if the processed image should not be
+        kept (see ProcessedImageCache).
+        """
+        if not processed_image_cache.max_bytes:
+            return None
+        if isinstance(image,np.ndarray):
+            if image.flags.writeable:
+                return None
+        elif not isinstance(image,(Image.Image,_LazyImage)):
+            return None
+        signature = [self.background_value_fn]
+        for wpof in self.whole_pattern_output_fns:
+            if isinstance(wpof,TransferFnWithState):
+                return None
+            signature.append((wpof,wpof.get_param_values()))
+        return signature
 
+
+    def _pil_image(self, image):
+        """Return the array image as a single-precision PIL Image."""
+        last = getattr(self,'_last_pil_image',None)
+        if last is not None and last[0] is image:
+            return last[1]
+        pil_image = Image.fromarray(np.asarray(image,dtype=np.float32),'F')
+        self._last_pil_image = (image,pil_image)
+        return pil_image
+
+
+    def _mipmap_factor(self, sheet_xdensity, sheet_ydensity, width, height):
+        """
+        Return the reduction of the copy of the image to sample (see
+        mipmap).
+        """
+        if not self.mipmap:
+            return 1
         pattern_rows,pattern_cols = self.image.shape
+        x_sf,y_sf = self._size_normalization_factors(pattern_rows,pattern_cols,
+                                                     sheet_xdensity,sheet_ydensity)
+        # Distance (in pixels of the image) between the samples
+        spacing = min(x_sf/float(width),y_sf/float(height))
+        factor = 1
+        while 2*factor <= min(spacing,max(pattern_rows,pattern_cols)):
+            factor *= 2
+        return factor
 
-        if width==0 or height==0 or pattern_cols==0 or pattern_rows==0:
-            return np.ones(x.shape)*self.background_value
+
+    def _mipmap_level(self, factor):
+        """
+        Return the copy of self.image reduced by factor (a power of
+        two), making it from the largest copy already made if needed.
+        """
+        mipmaps = self._mipmaps
+        if factor in mipmaps:
+            return mipmaps[factor]
+        reduction = max(f for f in mipmaps if f < factor)
+        level = mipmaps[reduction]
+        while reduction < factor:
+            rows,cols = level.shape
+            # Odd rows and columns are averaged with themselves
+            level = np.pad(level,((0,rows%2),(0,cols%2)),'edge')
+            level = 0.25*(level[0::2,0::2]+level[1::2,0::2]+level[0::2,1::2]+level[1::2,1::2])
+            level.flags.writeable = False
+            reduction *= 2
+            mipmaps[reduction] = level
+            if self._processed_key is not None:
+                processed_image_cache.grow(self._processed_key,mipmaps,level.nbytes)
+        return level
+
+
+    def _sample_indices(self, x, y, sheet_xdensity, sheet_ydensity, width, height, factor=1):
+        """
+        Return the flat indices of the pixels of the image (or of its
+        copy reduced by factor, see mipmap) sampled at the given (x,y)
+        coordinates, and the flat indices of the coordinates that fall
+        outside the image (or None if there are none), using those
+        computed previously for the same geometry if they are still
+        cached.
+        """
+        key = (self.image.shape,x.shape,sheet_xdensity,sheet_ydensity,width,height,
+               self.size_normalization,factor)
+        if x.size:
+            key += (x.flat[0],x.flat[-1],y.flat[0],y.flat[-1])
+
+        cached = self._index_cache.pop(key,None)
+        if cached is not None and np.array_equal(cached[0],x) and np.array_equal(cached[1],y):
+            self._index_cache[key] = cached
+            return cached[2:]
+
+        index,outside = self._compute_indices(x,y,sheet_xdensity,sheet_ydensity,width,height,
+                                              factor)
+        if self.index_cache_size:
+            self._index_cache[key] = (x.copy(),y.copy(),index,outside)
+            while len(self._index_cache) > self.index_cache_size:
+                self._index_cache.popitem(last=False)
+        return index,outside
+
+
+    def _compute_indices(self, x, y, sheet_xdensity, sheet_ydensity, width, height, factor=1):
+        pattern_rows,pattern_cols = self.image.shape
 
         # scale the supplied coordinates to match the pattern being at density=1
         x=x*sheet_xdensity # deliberately don't operate in place (so as not to change supplied x & y)
         y=y*sheet_ydensity
 
         # scale according to initial pattern size_normalization selected (size_normalization)
-        self.__apply_size_normalization(x,y,sheet_xdensity,sheet_ydensity,self.size_normalization)
+        if self.size_normalization!='original':
+            x_sf,y_sf = self._size_normalization_factors(pattern_rows,pattern_cols,
+                                                         sheet_xdensity,sheet_ydensity)
+            x*=x_sf; y*=y_sf
 
         # scale according to user-specified width and height
         x/=width
@@ -170,36 +372,117 @@ class PatternSampler(ImageSampler):
         r.clip(0,pattern_rows-1,out=r)
         c.clip(0,pattern_cols-1,out=c)
         left,bottom,right,top = self.scs.bounds.lbrt()
-        return np.where((x>=left) & (x<right) & (y>bottom) & (y<=top),
-                           self.image[r,c],
-                           self.background_value)
+        outside = np.flatnonzero(~((x>=left) & (x<right) & (y>bottom) & (y<=top)))
+        if factor > 1:
+            r//=factor; c//=factor
+            pattern_cols = -(-pattern_cols//factor)
+        return r*pattern_cols+c, (outside if len(outside) else None)
 
 
-    def __apply_size_normalization(self,x,y,sheet_xdensity,sheet_ydensity,size_normalization):
-        pattern_rows,pattern_cols = self.image.shape
+    def _size_normalization_factors(self,pattern_rows,pattern_cols,sheet_xdensity,sheet_ydensity):
+        """
+        Return the factors by which size_normalization scales the x
+        and y coordinates (at density=1) of an image of the given
+        shape.
+        """
+        size_normalization = self.size_normalization
 
         # Instead of an if-test, could have a class of this type of
         # function (c.f. OutputFunctions, etc)...
-        if size_normalization=='original':
-            return
-
-        elif size_normalization=='stretch_to_fit':
-            x_sf,y_sf = pattern_cols/sheet_xdensity, pattern_rows/sheet_ydensity
-            x*=x_sf; y*=y_sf
+        if size_normalization=='stretch_to_fit':
+            return pattern_cols/sheet_xdensity, pattern_rows/sheet_ydensity
 
         elif size_normalization=='fit_shortest':
             if pattern_rows<pattern_cols:
                 sf = pattern_rows/sheet_ydensity
             else:
                 sf = pattern_cols/sheet_xdensity
-            x*=sf;y*=sf
+            return sf,sf
 
         elif size_normalization=='fit_longest':
             if pattern_rows<pattern_cols:
                 sf = pattern_cols/sheet_xdensity
             else:
                 sf = pattern_rows/sheet_ydensity
-            x*=sf;y*=sf
+            return sf,sf
+
+        return 1,1
+
+
+
+
+class AffineImageSampler(PatternSampler):
+    """
+    PatternSampler that resamples the image in a single affine
+    transformation performed by PIL (Image.transform), optionally
+    interpolating between pixels.
+
+    The coordinates supplied by a PatternGenerator are an affine
+    function of the position in the sheet's matrix (translated,
+    rotated and scaled), so rather than looking up a pixel for each of
+    them, the transformation is computed from the corners of the
+    coordinate arrays, taking the size_normalization and any supplied
+    width and height into account as PatternSampler does.  With
+    nearest-neighbour interpolation, the pattern is the same as that
+    of a PatternSampler (except for values rounded to single
+    precision, and samples exactly on the edges of pixels), including
+    the background value outside the image.  Coordinates that are not
+    an affine function of the matrix position are sampled as by
+    PatternSampler.
+    """
+
+    interpolation = param.ObjectSelector(default='nearest',
+        objects=['nearest','bilinear','bicubic'],doc="""
+        How to compute the value at coordinates between the centres
+        of the image's pixels: using the nearest pixel, or by bilinear
+        or bicubic interpolation between the surrounding pixels.""")
+
+    _filters = {'nearest':Image.NEAREST,'bilinear':Image.BILINEAR,'bicubic':Image.BICUBIC}
+
+    def _sample(self, x, y, sheet_xdensity, sheet_ydensity, width, height):
+        coefficients = self._affine_coefficients(x,y,sheet_xdensity,sheet_ydensity,width,height)
+        if coefficients is None:
+            return super(AffineImageSampler,self)._sample(x,y,sheet_xdensity,sheet_ydensity,
+                                                          width,height)
+        factor = self._mipmap_factor(sheet_xdensity,sheet_ydensity,width,height)
+        coefficients = [coefficient/factor for coefficient in coefficients]
+        rows,cols = x.shape
+        result = self._pil_image(self._mipmap_level(factor)).transform(
+            (cols,rows),Image.AFFINE,coefficients,self._filters[self.interpolation],
+            fillcolor=float(self.background_value))
+        return np.asarray(result,dtype=float)
+
+
+    def _affine_coefficients(self, x, y, sheet_xdensity, sheet_ydensity, width, height):
+        """
+        Return the coefficients (a,b,c,d,e,f) for which the pixel of
+        the image at (a*j+b*i+c,d*j+e*i+f) (column, row) is sampled
+        for the centre of element (i,j) of the coordinate arrays, or
+        None if the coordinates are not an affine function of (i,j).
+        """
+        pattern_rows,pattern_cols = self.image.shape
+        x_sf,y_sf = self._size_normalization_factors(pattern_rows,pattern_cols,
+                                                     sheet_xdensity,sheet_ydensity)
+        kx = sheet_xdensity*x_sf/width
+        ky = sheet_ydensity*y_sf/height
+
+        rows,cols = x.shape
+        affine = []
+        for a in (x,y):
+            di = (a[-1,0]-a[0,0])/(rows-1) if rows>1 else 0.0
+            dj = (a[0,-1]-a[0,0])/(cols-1) if cols>1 else 0.0
+            predicted = a[0,0]+(rows-1)*di+(cols-1)*dj
+            if not np.isclose(a[-1,-1],predicted,rtol=1e-9,atol=1e-12*(abs(di)+abs(dj))):
+                return None
+            affine.append((a[0,0],di,dj))
+
+        (x0,xi,xj),(y0,yi,yj) = affine
+        # Matrix position (column,row) of the coordinates, as in
+        # PatternSampler (PIL samples at the centre of each element)
+        a,b = kx*xj,kx*xi
+        d,e = -ky*yj,-ky*yi
+        return (a,b,kx*x0+pattern_cols/2.0-0.5*(a+b),
+                d,e,pattern_rows/2.0-ky*y0-0.5*(d+e))
 
 
 
@@ -221,35 +504,462 @@ def edge_average(a):
 
 
 
-class FastImageSampler(ImageSampler):
+class FastImageSampler(PatternSampler):
     """
-    A fast-n-dirty image sampler using Python Imaging Library
-    routines.  Currently this sampler doesn't support user-specified
-    size_normalization or cropping but rather simply scales and crops
-    the image to fit the given matrix size without distorting the
-    aspect ratio of the original picture.
+    PatternSampler that uses Python Imaging Library routines to sample
+    patterns that are not rotated, i.e. whose x coordinates vary only
+    along rows and y coordinates only along columns of the sheet.
+
+    With sampling_method Image.NEAREST, the pattern is the same as
+    that of a PatternSampler, but the pixels are looked up separately
+    for each row and column rather than for each sample.  With other
+    sampling methods, the part of the image covered by the sheet is
+    resized by PIL (Image.resize), which averages (or interpolates)
+    the pixels around each sample.  Other patterns are sampled as by
+    PatternSampler.
     """
 
     sampling_method = param.Integer(default=Image.NEAREST,doc="""
        Python Imaging Library sampling method for resampling an image.
        Defaults to Image.NEAREST.""")
 
-    def _set_image(self,image):
-        if not isinstance(image,Image.Image):
-            self._image = Image.new('L',image.shape)
-            self._image.putdata(image.ravel())
+    reducing_gap = param.Number(default=None,allow_None=True,bounds=(1.0,None),doc="""
+       If not None, images reduced by more than this factor are first
+       reduced by an integer factor by averaging blocks of pixels, and
+       then resized with the sampling_method (see PIL's
+       Image.resize), which is faster but less accurate.  Not used
+       with Image.NEAREST, or with versions of PIL (Pillow) before
+       7.0, with which the region of the image resized is also
+       rounded to whole pixels.""")
+
+    size_normalization = param.ObjectSelector(default='fit_shortest',
+        objects=['original','stretch_to_fit','fit_shortest','fit_longest'],doc="""
+        Determines how the pattern is scaled initially; see
+        PatternSampler.""")
+
+    def _sample(self, x, y, sheet_xdensity, sheet_ydensity, width, height):
+        rows,cols = x.shape
+        if not (np.array_equal(x[0],x[-1]) and np.array_equal(y[:,0],y[:,-1])):
+            return super(FastImageSampler,self)._sample(x,y,sheet_xdensity,sheet_ydensity,
+                                                        width,height)
+
+        # scale the coordinates of a row and a column as in PatternSampler
+        pattern_rows,pattern_cols = self.image.shape
+        x_sf,y_sf = self._size_normalization_factors(pattern_rows,pattern_cols,
+                                                     sheet_xdensity,sheet_ydensity)
+        xs = x[0]*sheet_xdensity*x_sf/width
+        ys = y[:,0]*sheet_ydensity*y_sf/height
+        left,bottom,right,top = self.scs.bounds.lbrt()
+        inside_cols = (xs>=left) & (xs<right)
+        inside_rows = (ys>bottom) & (ys<=top)
+
+        if self.sampling_method == Image.NEAREST:
+            factor = self._mipmap_factor(sheet_xdensity,sheet_ydensity,width,height)
+            r = self.scs.sheet2matrixidx(np.zeros_like(ys),ys)[0].clip(0,pattern_rows-1)
+            c = self.scs.sheet2matrixidx(xs,np.zeros_like(xs))[1].clip(0,pattern_cols-1)
+            result = self._mipmap_level(factor)[np.ix_(r//factor,c//factor)]
         else:
-            self._image = image
+            result = self._resize(xs,ys,inside_cols,inside_rows)
+
+        result[~inside_rows,:] = self.background_value
+        result[:,~inside_cols] = self.background_value
+        return result
+
+
+    def _resize(self, xs, ys, inside_cols, inside_rows):
+        """
+        Return an array of the image resized by PIL so that its pixels
+        are at the matrix coordinates (xs,ys) (where inside the
+        image).
+        """
+        result = np.empty((len(ys),len(xs)))
+        if not (inside_cols.any() and inside_rows.any()):
+            return result
+        i0,i1 = np.flatnonzero(inside_rows)[[0,-1]]
+        j0,j1 = np.flatnonzero(inside_cols)[[0,-1]]
+
+        # Box of the image (in pixels) covered by the samples that
+        # are inside it
+        pattern_rows,pattern_cols = self.image.shape
+        u = xs[j0:j1+1]+pattern_cols/2.0
+        v = pattern_rows/2.0-ys[i0:i1+1]
+        du = (u[-1]-u[0])/(j1-j0) if j1>j0 else 1.0
+        dv = (v[-1]-v[0])/(i1-i0) if i1>i0 else 1.0
+        box = (max(u[0]-du/2.0,0.0),max(v[0]-dv/2.0,0.0),
+               min(u[-1]+du/2.0,pattern_cols),min(v[-1]+dv/2.0,pattern_rows))
+
+        pil_image, size = self._pil_image(self.image), (j1-j0+1,i1-i0+1)
+        options = dict(box=box)
+        if self.reducing_gap is not None:
+            options['reducing_gap'] = self.reducing_gap
+        try:
+            resized = pil_image.resize(size,self.sampling_method,**options)
+        except TypeError:
+            # Pillow before 7.0 has no reducing_gap, and before 4.3 no
+            # box, so the box is cropped to whole pixels instead
+            box = tuple(int(round(b)) for b in box)
+            resized = pil_image.crop(box).resize(size,self.sampling_method)
+        result[i0:i1+1,j0:j1+1] = np.asarray(resized)
+        return result
+
+
+
+class ImageCache(object):
+    """
+    Least-recently-used cache of decoded images, shared between
+    FileImages so that each file is decoded only once while it stays
+    in the cache.
+
+    Entries are keyed on the absolute path, modification time and size
+    of the file and on the options with which it was loaded, so that
+    files changed on disk are loaded again.  The least recently used
+    entries are discarded whenever the images held take more than
+    max_bytes.  Arrays held in the cache are made read-only, so that
+    they can be shared safely.
+
+    The hits, misses, evictions and nbytes attributes record how the
+    cache has been used; see also stats().
+    """
+
+    def __init__(self, max_bytes=128*2**20):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.clear()
+
+
+    def clear(self):
+        """Discard all entries and reset the statistics."""
+        self._entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def __getstate__(self):
+        # Entries can always be loaded again
+        return {'max_bytes':self.max_bytes}
+
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def key(self, filename, *options):
+        """
+        Return the key for filename loaded with the given options, or
+        None if the file cannot be found.
+        """
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        return (os.path.abspath(filename),stat.st_mtime,stat.st_size,options)
+
+
+    def load(self, filename, read, *options):
+        """
+        Return the entry for filename read with read(filename,
+        *options), calling read only if the entry is not cached.
+        """
+        key = self.key(filename,read.__name__,*options)
+        entry = self.get(key) if key is not None else None
+        if entry is None:
+            entry = self.put(key,*read(filename,*options))
+        return entry
+
+
+    def contains(self, key):
+        """
+        Return True if key is cached, without counting a hit or miss
+        or marking the entry as recently used.
+        """
+        with self._lock:
+            return key in self._entries
+
+
+    def get(self, key):
+        """Return the entry for key, or None if it is not cached."""
+        with self._lock:
+            item = self._entries.pop(key,None)
+            if item is None:
+                self.misses += 1
+                return None
+            self._entries[key] = item
+            self.hits += 1
+            return item[0]
+
+
+    def put(self, key, image, channels=()):
+        """
+        Store a decoded image (a PIL Image or array) and its channel
+        arrays under key, and return them as they are held in the
+        cache.  Entries larger than max_bytes are returned but not
+        stored.
+        """
+        image = self._shared(image)
+        channels = tuple(self._shared(c) for c in channels)
+        entry = (image,channels)
+        nbytes = _nbytes(image) + sum(_nbytes(c) for c in channels)
+        if key is None or nbytes > self.max_bytes:
+            return entry
+
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (entry,nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                self.nbytes -= self._entries.popitem(last=False)[1][1]
+                self.evictions += 1
+        return entry
+
+
+    def _shared(self, image):
+        if isinstance(image,np.ndarray):
+            image.flags.writeable = False
+        return image
+
+
+    def stats(self):
+        """Return a dictionary of the cache statistics."""
+        with self._lock:
+            return dict(hits=self.hits,misses=self.misses,evictions=self.evictions,
+                        entries=len(self._entries),nbytes=self.nbytes,
+                        max_bytes=self.max_bytes)
+
+
+
+def _nbytes(image):
+    "Return the approximate number of bytes taken by an array or PIL Image."
+    if isinstance(image,np.memmap):
+        return 0
+    if isinstance(image,(np.ndarray,_LazyImage)):
+        return image.nbytes
+    width,height = image.size
+    return width*height*{'1':1,'L':1,'P':1,'LA':2,'I;16':2,'RGB':3}.get(image.mode,4)
+
+
+# Cache used by FileImages by default
+image_cache = ImageCache()
+
 
-    def __call__(self, image, x, y, sheet_xdensity, sheet_ydensity, width=1.0, height=1.0):
-        self.image=image
 
-        # JPALERT: Right now this ignores all options and just fits the image into given array.
-        # It needs to be fleshed out to properly size and crop the
-        # image given the options. (maybe this class needs to be
-        # redesigned?  The interface to this function is pretty inscrutable.)
-        im = ImageOps.fit(self.image,x.shape,self.sampling_method)
-        return np.array(im,dtype=np.float)
+class ProcessedImageCache(object):
+    """
+    Least-recently-used cache of images as processed by
+    PatternSamplers (i.e. after their whole_pattern_output_fns),
+    shared by all PatternSamplers so that the memory it takes is
+    bounded however many samplers there are (e.g. one per FileImage).
+
+    Each entry holds what a sampler needs to sample an image again
+    without processing it again (the processed image and any mipmap
+    levels made from it, its SheetCoordinateSystem and its background
+    value).  Entries are keyed on the image they were processed from,
+    and are used only for that same image processed in the same way
+    (the same background_value_fn, and the same
+    whole_pattern_output_fns with the same parameter values).  Only
+    images that cannot be changed (PIL Images, and read-only arrays
+    such as those in image_cache) are kept, and nothing is kept if any
+    of the whole_pattern_output_fns has state (TransferFnWithState).
+
+    An entry is discarded when the image it was processed from is
+    garbage collected, and the least recently used entries are
+    discarded whenever those kept take more than max_bytes.  The
+    default max_bytes of 0 keeps nothing.
+    """
+
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.clear()
+
+
+    def clear(self):
+        """Discard all entries."""
+        self._entries = collections.OrderedDict()
+        # (key,ref) of entries whose image has been garbage collected
+        self._collected = []
+        self.nbytes = 0
+
+
+    def __getstate__(self):
+        # Entries can always be processed again
+        return {'max_bytes':self.max_bytes}
+
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+    def __len__(self):
+        with self._lock:
+            self._discard_collected()
+            return len(self._entries)
+
+
+    def get(self, image, signature):
+        """
+        Return the (scs, background_value, mipmaps) kept for image
+        processed with the given signature (see
+        PatternSampler._processing_signature), or None.
+        """
+        with self._lock:
+            self._discard_collected()
+            item = self._entries.pop(id(image),None)
+            if item is None:
+                return None
+            self._entries[id(image)] = item
+        if item[0]() is not image or not _same_values(item[1],signature):
+            return None
+        return item[2]
+
+
+    def put(self, image, signature, scs, background_value, mipmaps):
+        """
+        Keep the result of processing image with the given signature,
+        returning True if it was kept.
+        """
+        nbytes = sum(a.nbytes for a in mipmaps.values())
+        if nbytes > self.max_bytes:
+            return False
+        key, collected = id(image), self._collected
+        try:
+            ref = weakref.ref(image,lambda r: collected.append((key,r)))
+        except TypeError:
+            return False
+        with self._lock:
+            self._discard_collected()
+            self._discard(key)
+            self._entries[key] = [ref,signature,(scs,background_value,mipmaps),nbytes]
+            self.nbytes += nbytes
+            self._evict()
+        return True
+
+
+    def grow(self, key, mipmaps, nbytes):
+        """
+        Count nbytes more for the entry under key (the id of the image
+        it was processed from), if it still holds mipmaps.
+        """
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None and item[2][2] is mipmaps:
+                item[3] += nbytes
+                self.nbytes += nbytes
+                self._evict()
+
+
+    def _discard(self, key, ref=None):
+        item = self._entries.get(key)
+        if item is not None and (ref is None or item[0] is ref):
+            del self._entries[key]
+            self.nbytes -= item[3]
+
+
+    def _discard_collected(self):
+        while self._collected:
+            self._discard(*self._collected.pop())
+
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes:
+            self._discard(next(iter(self._entries)))
+
+
+# Cache used by all PatternSamplers, keeping nothing unless max_bytes is set
+processed_image_cache = ProcessedImageCache()
+
+
+
+class _LazyImage(object):
+    """
+    One channel, or the average of all channels, of an array of image
+    data (e.g. memory-mapped from a file), multiplied by scale.  The
+    values are computed only when converted to an array, so that the
+    data is not copied until it is sampled.
+    """
+
+    def __init__(self, data, scale, channel=None):
+        self.data = data
+        self.scale = scale
+        self.channel = channel
+
+
+    @property
+    def shape(self):
+        return self.data.shape[:2]
+
+
+    @property
+    def nbytes(self):
+        """
+        Bytes held in memory: none for memory-mapped data, and for
+        other data only for the average (which shares the data with
+        the channels).
+        """
+        if isinstance(self.data,np.memmap) or self.channel is not None:
+            return 0
+        return self.data.nbytes
+
+
+    def __array__(self, dtype=None):
+        if self.data.ndim == 2:
+            result = np.multiply(self.data,self.scale,dtype=float)
+        elif self.channel is not None:
+            result = np.multiply(self.data[:,:,self.channel],self.scale,dtype=float)
+        else:
+            result = np.array(self.data[:,:,0],dtype=float)
+            for i in range(1,self.data.shape[2]):
+                result += self.data[:,:,i]
+            result *= self.scale/self.data.shape[2]
+        return result if dtype is None else result.astype(dtype,copy=False)
+
+
+
+def _cache_image(filename, read, options):
+    """
+    Load the image in filename into image_cache, as read by
+    read(filename,*options), unless it is already there.
+    """
+    key = image_cache.key(filename,read.__name__,*options)
+    if key is not None and not image_cache.contains(key):
+        image_cache.put(key,*read(filename,*options))
+
+
+def _load_npz_member(filename, name=None, mmap_mode=None):
+    """
+    Return the array called name (or the first array) from the .npz
+    file filename, reading only that array.  If mmap_mode is given
+    and the array is stored without compression, it is memory-mapped
+    rather than read.
+    """
+    with np.load(filename) as npz:
+        name = npz.files[0] if name is None else name
+        if mmap_mode is None:
+            return npz[name]
+        member = npz.zip.getinfo(name+'.npy')
+        if member.compress_type != zipfile.ZIP_STORED:
+            return npz[name]
+
+    with open(filename,'rb') as f:
+        # Skip the member's local file header to reach the .npy data
+        f.seek(member.header_offset)
+        header = f.read(30)
+        f.seek(member.header_offset+30+struct.unpack('<H',header[26:28])[0]
+               +struct.unpack('<H',header[28:30])[0])
+        version = np.lib.format.read_magic(f)
+        if version == (1,0):
+            shape,fortran_order,dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape,fortran_order,dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    return np.memmap(filename,dtype=dtype,mode=mmap_mode,offset=offset,shape=shape,
+                     order='F' if fortran_order else 'C')
 
 
 
@@ -349,29 +1059,47 @@ class GenericImage(ChannelGenerator):
     def __getstate__(self):
         """
         Return the object's state (as in the superclass), but replace
-        the '_image' attribute's Image with a string representation.
+        the '_image' attribute's Image with an array of its pixels and
+        its mode.  Arrays are pickled as raw buffers (out of band, with
+        pickle protocol 5 and a buffer_callback), which is much faster
+        than encoding the image.
         """
         state = super(GenericImage,self).__getstate__()
 
         if '_image' in state and state['_image'] is not None:
-            f = BytesIO()
-            image = state['_image']
-            # format could be None (we should probably just not save in that case)
-            image.save(f,format=image.format or 'TIFF')
-            state['_image'] = f.getvalue()
-            f.close()
+            state['_image'] = self._image_state(state['_image'])
 
         return state
 
+    # Modes of PIL Images that can be converted to and from arrays
+    _array_modes = ['L','I','F','RGB','RGBA','LA','CMYK','YCbCr']
+
+    def _image_state(self, image):
+        "Return the representation of image to pickle."
+        if not isinstance(image,Image.Image):
+            return np.asarray(image)
+        elif image.mode in self._array_modes:
+            return (image.mode,np.asarray(image))
+        # e.g. palette images, which are saved with their palette
+        f = BytesIO()
+        image.save(f,format='TIFF')
+        data = f.getvalue()
+        f.close()
+        return data
+
 
     def __setstate__(self,state):
         """
         Load the object's state (as in the superclass), but replace
-        the '_image' string with an actual Image object.
+        the '_image' array (or, for older pickles, string) with an
+        actual Image object.
         """
         # state['_image'] is apparently sometimes None (see SF #2276819).
-        if '_image' in state and state['_image'] is not None:
-            state['_image'] = Image.open(BytesIO(state['_image']))
+        image = state.get('_image')
+        if isinstance(image,tuple):
+            state['_image'] = Image.fromarray(image[1],image[0])
+        elif isinstance(image,bytes):
+            state['_image'] = Image.open(BytesIO(image))
         super(GenericImage,self).__setstate__(state)
 
 
@@ -394,9 +1122,46 @@ class FileImage(GenericImage):
         or .npz) containing 2D or 3D arrays (where the third dimension
         is used for each channel).""")
 
+    npz_array = param.String(default=None,allow_None=True,doc="""
+        Name of the array to use from a .npz file, or None for the
+        first array in the file.""")
+
+    memory_map = param.Boolean(default=True,doc="""
+        Whether to memory-map arrays from .npy files (and arrays
+        stored without compression in .npz files) rather than reading
+        them into memory, so that only the parts that are sampled are
+        read and processes drawing the same file share one copy.""")
+
+
+    use_image_cache = param.Boolean(default=True,doc="""
+        Whether to share decoded images with other FileImages through
+        image_cache, so that a file presented repeatedly is decoded
+        only once while it remains in the cache.  Unlike cache_image,
+        the memory used is limited by the cache's max_bytes.""")
+
+    reduced_decoding = param.Boolean(default=False,doc="""
+        Whether to decode image files (other than numpy files) at a
+        reduced resolution when the pattern is drawn with fewer
+        samples than the file has pixels, e.g. a large photograph
+        drawn on a small sheet.  The resolution is reduced by the
+        largest power of two that still leaves at least one decoded
+        pixel per sample, as determined by the pattern_sampler's
+        size_normalization and the size, aspect_ratio, xdensity and
+        ydensity parameters.  JPEG files are then decoded directly at
+        the reduced scale (see PIL's Image.draft), and other files are
+        reduced by averaging blocks of pixels (see Image.reduce), which
+        makes decoding faster and the decoded images (e.g. in
+        image_cache) smaller.  Because the reduced image averages
+        neighbouring pixels rather than picking one of them, the
+        pattern can differ slightly from that drawn at full resolution.
+        Only has an effect with a PatternSampler whose
+        size_normalization is not 'original'.""")
+
 
     def __init__(self, **params):
         self.last_filename = None  # Cached to avoid unnecessary reloading for each channel
+        self._last_options = None
+        self._last_size = (None,None) # (filename,size), to avoid reopening the file
         self._cached_average = None
         super(FileImage,self).__init__(**params) ## must be called after setting the class-attributes
         self._image = None # necessary to ensure reloading of data (due to cache mechanisms
@@ -422,6 +1187,42 @@ class FileImage(GenericImage):
         return self._cached_average
 
 
+    def channels(self, use_cached=False, **params_to_override):
+        res = super(FileImage,self).channels(use_cached,**params_to_override)
+        # Until the pattern is first drawn, the channels are those
+        # loaded from the file, which may not yet be arrays (_LazyImage)
+        for i,channel in res.items():
+            if isinstance(channel,_LazyImage):
+                res[i] = np.asarray(channel)
+        return res
+
+
+    def __getstate__(self):
+        """
+        Return the object's state (as in GenericImage), but without
+        the image loaded from the file, which is loaded again (or
+        found in image_cache) when it is next needed.
+        """
+        state = super(FileImage,self).__getstate__()
+        originals = state.get('_original_channel_data',[])
+        state['_original_channel_data'] = []
+        if '_channel_data' in state:
+            state['_channel_data'] = [None if any(c is o for o in originals) else c
+                                      for c in state['_channel_data']]
+        return state
+
+
+    def __setstate__(self, state):
+        # FileImages pickled before decoding options were remembered
+        state.setdefault('_last_options',None)
+        state.setdefault('_last_size',(None,None))
+        super(FileImage,self).__setstate__(state)
+
+
+    def _image_state(self, image):
+        return None
+
+
     def set_matrix_dimensions(self, *args):
         """
         Subclassed to delete the cached image when matrix dimensions
@@ -432,57 +1233,188 @@ class FileImage(GenericImage):
 
 
     def _get_image(self,p):
-        file_, ext = splitext(p.filename)
-        npy = (ext.lower() == ".npy")
-        reload_image = (p.filename!=self.last_filename or self._image is None)
+        read, options = self._reader(p)
+        reload_image = (p.filename!=self.last_filename or self._image is None or
+                        options!=self._last_options)
 
         self.last_filename = p.filename
+        self._last_options = options
 
         if reload_image:
-            if npy:
-                self._load_npy(p.filename)
+            if p.use_image_cache:
+                self._set_loaded(*image_cache.load(p.filename,read,*options))
             else:
-                self._load_pil_image(p.filename)
+                self._set_loaded(*read(p.filename,*options))
 
         return self._image
 
 
-    def _load_pil_image(self, filename):
+    def _reader(self, p):
         """
-        Load image using PIL.
+        Return the function that reads p.filename (see _read_pil_image
+        and _read_npy), and the options to pass to it after the
+        filename.
         """
-        self._channel_data = []
-        self._original_channel_data = []
+        file_, ext = splitext(p.filename)
+        if ext.lower() in (".npy",".npz"):
+            return _read_npy, ('r' if p.memory_map else None, p.npz_array)
+        return _read_pil_image, (self._reduction(p) if p.reduced_decoding else 1,)
 
-        im = Image.open(filename)
-        self._image = ImageOps.grayscale(im)
-        im.load()
 
-        file_data = np.asarray(im, float)
-        file_data = file_data / file_data.max()
+    def _reduction(self, p):
+        """
+        Return the factor by which the image in p.filename can be
+        reduced while leaving at least one pixel per sample of the
+        pattern (see reduced_decoding).
+        """
+        sampler = p.pattern_sampler
+        if not isinstance(sampler,PatternSampler) or sampler.size_normalization=='original':
+            return 1
+        size = self._image_size(p)
+        if size is None:
+            return 1
+        cols,rows = size
+
+        # Distance (in pixels of the image) between the samples, as
+        # in PatternSampler.__call__
+        x_sf,y_sf = sampler._size_normalization_factors(rows,cols,float(p.xdensity),
+                                                        float(p.ydensity))
+        width,height = p.aspect_ratio*p.size, p.size
+        if width==0 or height==0:
+            return 1
+        spacing = min(x_sf/width,y_sf/height)
+
+        factor = 1
+        while 2*factor <= spacing:
+            factor *= 2
+        return factor
+
+
+    def _image_size(self, p):
+        """
+        Return the (width,height) of the image in p.filename at full
+        resolution, or None if it cannot be read.  The size is
+        remembered until another file is used.
+        """
+        filename, size = self._last_size
+        if filename==p.filename:
+            return size
+        try:
+            with Image.open(p.filename) as im:
+                size = im.size
+        except IOError:
+            return None
+        self._last_size = (p.filename,size)
+        return size
+
+
+    def _set_loaded(self, image, channels):
+        self._image = image
+        self._channel_data = list(channels)
+        self._original_channel_data = list(channels)
 
-        # if the image has more than one channel, load them
-        if( len(file_data.shape) == 3 ):
-            num_channels = file_data.shape[2]
-            for i in range(num_channels):
-                self._channel_data.append( file_data[:, :, i])
-                self._original_channel_data.append( file_data[:, :, i] )
+
+    def _prefetch_image(self, **params_to_override):
+        """
+        Return a function that loads the image into image_cache (if it
+        is not already there), so that drawing the pattern later does
+        not have to decode it, or None if image_cache is not used.
+        The parameter values, including the resolution to decode at,
+        are looked up by this call; the function returned only reads
+        the file, without changing this object, and so can be run in
+        another thread while the pattern is being used (see
+        Selector.prefetch).
+        """
+        p = param.ParamOverrides(self,params_to_override)
+        if not p.use_image_cache:
+            return None
+        read, options = self._reader(p)
+        return functools.partial(_cache_image,p.filename,read,options)
 
 
-    def _load_npy(self, filename):
+    def _load_pil_image(self, filename):
         """
-        Load image using Numpy.
+        Load image using PIL.
         """
-        self._channel_data = []
-        self._original_channel_data = []
-        file_channel_data = np.load(filename)
-        file_channel_data = file_channel_data / file_channel_data.max()
+        self._set_loaded(*_read_pil_image(filename))
 
-        for i in range(file_channel_data.shape[2]):
-            self._channel_data.append(file_channel_data[:, :, i])
-            self._original_channel_data.append(file_channel_data[:, :, i])
 
-        self._image = file_channel_data.sum(2) / file_channel_data.shape[2]
+    def _load_npy(self, filename, mmap_mode=None, name=None):
+        """
+        Load image using Numpy, from a .npy file or from the array
+        called name (or the first array) in a .npz file.
+        """
+        self._set_loaded(*_read_npy(filename,mmap_mode,name))
+
+
+
+def _read_pil_image(filename, reduction=1):
+    """
+    Read an image file using PIL, returning the grayscale image and a
+    list of normalized arrays for its channels (if it has more than
+    one).
+
+    If reduction is greater than one, the image is decoded with its
+    width and height divided by reduction (see _decode_pil_image).
+    """
+    im = _decode_pil_image(filename,reduction)
+    image = ImageOps.grayscale(im)
+
+    file_data = np.asarray(im, float)
+    file_data = file_data / file_data.max()
+
+    # if the image has more than one channel, load them
+    channels = []
+    if( len(file_data.shape) == 3 ):
+        num_channels = file_data.shape[2]
+        for i in range(num_channels):
+            channels.append( file_data[:, :, i])
+    return image, channels
+
+
+def _decode_pil_image(filename, reduction=1):
+    """
+    Open and decode an image file using PIL, with its width and
+    height divided by reduction (rounding up), decoding directly at
+    that scale where the file format allows (e.g. JPEG).
+    """
+    im = Image.open(filename)
+    if reduction > 1:
+        cols,rows = im.size
+        im.draft(im.mode,(-(-cols//reduction),-(-rows//reduction)))
+        im.load()
+        remaining = reduction*im.size[0]//cols
+        if remaining > 1:
+            try:
+                im = im.reduce(remaining)
+            except (AttributeError,ValueError):
+                # Pillow before 7.0, or a mode that cannot be reduced
+                # (e.g. palette images): keep the larger draft image
+                pass
+    im.load()
+    return im
+
+
+def _read_npy(filename, mmap_mode=None, name=None):
+    """
+    Read an array from a .npy file, or the array called name (or the
+    first array) from a .npz file, returning the average of its
+    channels and a list of its channels (if it has more than one).
+
+    The data is not copied: the image and channels are views that are
+    normalized as they are sampled (see _LazyImage).
+    """
+    if splitext(filename)[1].lower() == ".npz":
+        file_channel_data = _load_npz_member(filename,name,mmap_mode)
+    else:
+        file_channel_data = np.load(filename,mmap_mode=mmap_mode)
+    scale = 1.0/np.max(file_channel_data)
+
+    channels = []
+    if file_channel_data.ndim == 3:
+        for i in range(file_channel_data.shape[2]):
+            channels.append(_LazyImage(file_channel_data,scale,i))
+    return _LazyImage(file_channel_data,scale), channels
 
 
 
@@ -516,22 +1448,50 @@ class RotateHue(ChannelTransform):
 
         from .colorspaces import color_conversion as cc
 
-        channs_in  = np.dstack(channel_data[0:3])
-        channs_out = cc.image2working(channs_in)
-        analysis_space = cc.working2analysis(channs_out)
+        # Takes only the first three channels (e.g. RGB), converting
+        # them in place in a buffer in which each channel is
+        # contiguous (viewed with the channels last, as the
+        # conversions expect)
+        channels = _channel_buffer(channel_data[0:3],cc.colorspace.dtype)
+        pixels = np.rollaxis(channels,0,3)
 
+        analysis_space = cc.image2analysis(pixels,out=pixels)
         if self.rotation != 0:
             cc.jitter_hue(analysis_space,self.rotation)
         cc.multiply_sat(analysis_space,self.saturation)
+        cc.analysis2working(analysis_space,out=pixels)
 
-        channs_out = cc.analysis2working(analysis_space)
+        channel_data[0:3] = list(channels)
+        return channel_data
 
-        # Takes only the first three channels (e.g. RGB)
-        channel_data[0:3] = np.dsplit(channs_out, 3)
-        for a in channel_data:
-            a.shape = a.shape[0:2]
 
-        return channel_data
+
+def _buffer_of(channels, dtype=None):
+    """
+    Return the writeable array (of the given type, if any) whose
+    consecutive rows are the given channels, such as the buffer
+    created by _channel_buffer for RotateHue, or None if there is no
+    such array.
+    """
+    base = channels[0].base if len(channels) else None
+    if (isinstance(base,np.ndarray) and dtype in (None,base.dtype)
+        and base.flags.c_contiguous and base.flags.writeable
+        and base.shape==(len(channels),)+channels[0].shape
+        and all(c.base is base and c.ctypes.data==b.ctypes.data
+                for c,b in zip(channels,base))):
+        return base
+    return None
+
+
+def _channel_buffer(channels, dtype):
+    """
+    Return an array of the given channels (along its first axis) of
+    the given type.  Channels that are already the consecutive rows of
+    such an array (e.g. as returned by RotateHue) are returned as that
+    array, without copying.
+    """
+    base = _buffer_of(channels,dtype)
+    return np.array(channels,dtype=dtype) if base is None else base
 
 
 
@@ -553,14 +1513,24 @@ class ScaleChannels(ChannelTransform):
     def __call__(self,channel_data):
         # safety check
         num_channels = min( len(channel_data), len(self.channel_factors) )
+        # Channels written by an earlier transform (e.g. RotateHue)
+        # can be scaled in place; others (e.g. an image cached by a
+        # generator) must not be changed
+        buffer = _buffer_of(channel_data[0:3])
+        owned = 3 if buffer is not None and buffer.dtype.kind=='f' else 0
         for i in range( num_channels ):
             #TFALERT: Not sure why this is required, it should work out of the box
             #Maybe because channel_factors should be a param.List rather than
             #param.Dynamic?
-            if(callable(self.channel_factors[i])):
-                channel_data[i] = channel_data[i] * self.channel_factors[i]()
+            factor = self.channel_factors[i]
+            if(callable(factor)):
+                factor = factor()
+
+            channel = channel_data[i]
+            if i < owned:
+                channel *= factor
             else:
-                channel_data[i] = channel_data[i] * self.channel_factors[i]
-            channel_data[i][channel_data[i]>1]=1.0
+                channel = channel_data[i] = channel * factor
+            np.minimum(channel,1.0,out=channel)
 
         return channel_data
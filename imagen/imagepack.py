@@ -0,0 +1,235 @@
+"""
+Image archives: datasets of images decoded in advance and packed into
+a single file, from which ArchiveImage reads them without decoding or
+copying.
+
+An archive is written by pack_images (or by
+PatternCoordinatorImages.pack), which decodes the files on a pool of
+processes, optionally at several reduced resolutions (see
+FileImage.reduced_decoding).  The file consists of the decoded arrays,
+each aligned to ALIGNMENT bytes, followed by a JSON index of their
+offsets, shapes and types (and the dataset's MANIFEST_json metadata,
+if supplied), and a trailer recording where the index starts.  The
+arrays are memory-mapped when the archive is read, so that opening an
+archive of thousands of images reads only its index, and processes
+reading the same archive share one copy of the images.
+"""
+
+import os
+import json
+import struct
+import threading
+import multiprocessing
+
+import numpy as np
+from PIL import Image, ImageOps
+
+import param
+
+from .image import FileImage, _LazyImage, _decode_pil_image
+
+
+MAGIC = b'IMAGEPK1'
+
+ALIGNMENT = 64
+
+_TRAILER = struct.Struct('<QQ')
+
+
+
+def _decode(job):
+    """
+    Decode the file filename at each of the given reductions,
+    returning its full-resolution size and, for each reduction, the
+    grayscale image, the array of its channels (or None if it has only
+    one) and the scale that normalizes the channels.
+    """
+    filename, reductions = job
+    with Image.open(filename) as im:
+        size = im.size
+    decoded = []
+    for reduction in reductions:
+        im = _decode_pil_image(filename,reduction)
+        image = np.asarray(ImageOps.grayscale(im))
+        data = np.asarray(im)
+        if data.ndim == 3:
+            decoded.append((image,data,1.0/float(data.max())))
+        else:
+            decoded.append((image,None,1.0))
+    return size, decoded
+
+
+def _write_array(f, array):
+    "Write array to f at the next aligned offset, returning its description."
+    offset = -(-f.tell()//ALIGNMENT)*ALIGNMENT
+    f.write(b'\0'*(offset-f.tell()))
+    f.write(np.ascontiguousarray(array).tobytes())
+    return {'offset':offset,'shape':list(array.shape),'dtype':array.dtype.str}
+
+
+def pack_images(filenames, archive, names=None, reductions=(1,), manifest=None, processes=None):
+    """
+    Decode the image files in filenames and write them to the image
+    archive called archive, under the given names (by default the
+    filenames themselves).
+
+    Each image is stored at each of the reductions (see
+    FileImage.reduced_decoding), so that ArchiveImage can read the
+    one best suited to the pattern being drawn.  manifest is any
+    JSON-serializable metadata to record in the archive, such as the
+    contents of a dataset's MANIFEST_json.  The files are decoded by
+    a pool of the given number of processes (by default, one per CPU),
+    or in this process if processes is 1.
+    """
+    filenames = list(filenames)
+    names = filenames if names is None else list(names)
+    if len(names) != len(filenames):
+        raise ValueError("pack_images requires one name per file.")
+    reductions = sorted(set(int(r) for r in reductions))
+
+    pool = multiprocessing.Pool(processes) if processes != 1 else None
+    try:
+        jobs = [(filename,reductions) for filename in filenames]
+        results = pool.imap(_decode,jobs) if pool else (_decode(job) for job in jobs)
+
+        images = {}
+        with open(archive,'wb') as f:
+            f.write(MAGIC)
+            for name,(size,decoded) in zip(names,results):
+                entry = {'size':list(size)}
+                for reduction,(image,channels,scale) in zip(reductions,decoded):
+                    entry[str(reduction)] = {
+                        'image':_write_array(f,image),
+                        'channels':None if channels is None else _write_array(f,channels),
+                        'scale':scale}
+                images[name] = entry
+
+            index = json.dumps({'names':names,'reductions':reductions,
+                                'manifest':manifest,'images':images}).encode('utf-8')
+            index_offset = f.tell()
+            f.write(index)
+            f.write(_TRAILER.pack(index_offset,len(index)))
+            f.write(MAGIC)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+
+class ImageArchive(object):
+    """
+    An image archive written by pack_images, whose images are
+    returned as read-only arrays memory-mapped from the file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename,'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise IOError("%s is not an image archive." % filename)
+            f.seek(-(_TRAILER.size+len(MAGIC)),os.SEEK_END)
+            index_offset,index_length = _TRAILER.unpack(f.read(_TRAILER.size))
+            f.seek(index_offset)
+            index = json.loads(f.read(index_length).decode('utf-8'))
+
+        self.names = index['names']
+        self.reductions = index['reductions']
+        self.manifest = index['manifest']
+        self._images = index['images']
+        self._data = np.memmap(filename,dtype=np.uint8,mode='r')
+
+
+    def __contains__(self, name):
+        return name in self._images
+
+
+    def size(self, name):
+        """Return the (width,height) of the named image at full resolution."""
+        return tuple(self._images[name]['size'])
+
+
+    def read(self, name, reduction=1):
+        """
+        Return the grayscale image, the array of channels (or None if
+        the image has only one) and the scale that normalizes the
+        channels, for the named image at the given reduction.
+        """
+        entry = self._images[name][str(reduction)]
+        channels = entry['channels']
+        return (self._array(entry['image']),
+                None if channels is None else self._array(channels),
+                entry['scale'])
+
+
+    def _array(self, description):
+        dtype = np.dtype(description['dtype'])
+        shape = tuple(description['shape'])
+        offset = description['offset']
+        nbytes = int(np.prod(shape))*dtype.itemsize
+        return self._data[offset:offset+nbytes].view(dtype).reshape(shape)
+
+
+
+_archives = {}
+_archives_lock = threading.Lock()
+
+def open_archive(filename):
+    """
+    Return the ImageArchive for filename, sharing one ImageArchive
+    (and so one memory map) between all the users of a file until the
+    file is changed.
+    """
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    key = (stat.st_mtime,stat.st_size)
+    with _archives_lock:
+        cached = _archives.get(path)
+        if cached is None or cached[0] != key:
+            cached = _archives[path] = (key,ImageArchive(path))
+        return cached[1]
+
+
+def _read_archive(filename, name, reduction=1):
+    """
+    Read the named image from the image archive filename, returning
+    the grayscale image and a list of normalized arrays for its
+    channels (if it has more than one), as _read_pil_image does.  The
+    data is not copied (see _LazyImage).
+    """
+    image, channels, scale = open_archive(filename).read(name,reduction)
+    if channels is None:
+        return image, []
+    return image, [_LazyImage(channels,scale,i) for i in range(channels.shape[2])]
+
+
+
+class ArchiveImage(FileImage):
+    """
+    2D Image generator that reads the image from an image archive
+    (see pack_images), rather than decoding it from a file.
+
+    The images are memory-mapped from the archive, so that each is
+    read from disk only when it is drawn, and is not copied until it
+    is sampled.  If reduced_decoding is True, the image is read at the
+    largest reduction stored in the archive that still leaves at
+    least one pixel per sample.
+    """
+
+    filename = param.Filename(default=None,allow_None=True,precedence=0.9,doc="""
+        File path (can be relative to Param's base path) to an image
+        archive written by pack_images.""")
+
+    member = param.String(default=None,allow_None=True,precedence=0.91,doc="""
+        Name of the image in the archive.""")
+
+
+    def _reader(self, p):
+        reductions = open_archive(p.filename).reductions
+        target = self._reduction(p) if p.reduced_decoding else 1
+        suitable = [r for r in reductions if r <= target]
+        return _read_archive, (p.member, max(suitable) if suitable else min(reductions))
+
+
+    def _image_size(self, p):
+        return open_archive(p.filename).size(p.member)
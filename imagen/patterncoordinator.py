@@ -11,14 +11,17 @@ import os
 import math
 import json
 import glob
+import fnmatch
 import collections
 import copy
+import functools
 
 import param
 from param.parameterized import ParamOverrides
 
-from imagen.patterngenerator import PatternGenerator
+from imagen.patterngenerator import PatternGenerator, GeneratorSpec
 from imagen.image import FileImage
+from imagen.imagepack import ArchiveImage, open_archive, pack_images
 from imagen import Gaussian, Composite, Selector, CompositeBase
 
 import numbergen
@@ -215,8 +218,10 @@ class PatternCoordinator(param.Parameterized):
     def _create_patterns(self, properties=None):
         """
         Return a list (of length patterns_per_label) of
-        PatternGenerator instances.  Should use pattern_type and
-        pattern_parameters to create each pattern.
+        PatternGenerator instances, or of GeneratorSpecs describing
+        them if composite_type supports creating them on demand (see
+        Selector).  Should use pattern_type and pattern_parameters to
+        create each pattern.
 
         properties is a dictionary, e.g. {'pattern_label':
         pattern_label}, which can be used to create PatternGenerators
@@ -271,8 +276,12 @@ class PatternCoordinator(param.Parameterized):
             # Apply _feature_coordinators_to_apply
             for i in range(len(patterns)):
                 for fn in self._feature_coordinators_to_apply:
-                    patterns[i]=fn(patterns[i],pattern_label, i,
-                                   self.master_seed, **self._feature_params)
+                    if isinstance(patterns[i],GeneratorSpec):
+                        patterns[i]=patterns[i].apply(fn,pattern_label, i,
+                                                      self.master_seed, **self._feature_params)
+                    else:
+                        patterns[i]=fn(patterns[i],pattern_label, i,
+                                       self.master_seed, **self._feature_params)
 
             combined_patterns=self.composite_type(generators=patterns,
                                                   **self.composite_parameters)
@@ -291,6 +300,19 @@ class PatternCoordinatorImages(PatternCoordinator):
     composite_type = param.ClassSelector(CompositeBase,
                                          default=Selector,is_instance=False)
 
+    lazy = param.Boolean(default=False,doc="""
+        Whether to create each image's PatternGenerator only when it
+        is first selected, rather than creating one for every file of
+        the dataset up front.  Only used when composite_type is a
+        Selector, and recommended for large datasets.""")
+
+    archive = param.String(default=None,allow_None=True,doc="""
+        Image archive (see pack()) from which to read the dataset,
+        using ArchiveImages rather than decoding the individual image
+        files (which need not then exist).  The dataset's description
+        is also read from the archive rather than from its
+        MANIFEST_json.""")
+
     def __init__(self,dataset_name,**params):
         """
         dataset_name is the path to a folder containing a
@@ -368,24 +390,40 @@ class PatternCoordinatorImages(PatternCoordinator):
             :'placeholder_mapping': {}
         """
 
-        filepath=param.resolve_path(dataset_name,path_to_file=False)
+        archive=params.get('archive',self.archive)
+        self._archive=open_archive(param.resolve_path(archive)) if archive else None
+        try:
+            filepath=param.resolve_path(dataset_name,path_to_file=False)
+        except IOError:
+            if self._archive is None:
+                raise
+            filepath=os.path.abspath(dataset_name)
+        self._dataset_path=filepath
+        self._manifest=None
+
         self.dataset_name=filepath
         self.filename_template=filepath+"/*.*"
         self.description=""
         self.source=self.dataset_name
         self.placeholder_mapping={}
-        patterns_per_label = len(glob.glob(self.filename_template))
+        patterns_per_label = len(self._glob(self.filename_template))
         inherent_features=['sf','cr']
         try:
-            filename=param.resolve_path(dataset_name+'/MANIFEST_json')
-            filepath=os.path.dirname(filename)
-            dataset=json.loads(open(filename).read())
+            if self._archive is not None:
+                dataset=self._archive.manifest
+                if dataset is None:
+                    raise IOError("No MANIFEST_json in %s" % archive)
+            else:
+                filename=param.resolve_path(dataset_name+'/MANIFEST_json')
+                filepath=os.path.dirname(filename)
+                dataset=json.loads(open(filename).read())
+            self._manifest=dataset
 
             self.dataset_name=dataset.get('dataset_name', self.dataset_name)
             self.description=dataset.get('description', self.description)
             self.filename_template=dataset.get('filename_template', self.filename_template)
             patterns_per_label=dataset.get('length',
-                                                len(glob.glob(self.filename_template)))
+                                                len(self._glob(self.filename_template)))
             self.source=dataset.get('source', self.source)
             self.placeholder_mapping=(eval(dataset['placeholder_mapping'])
                                       if 'placeholder_mapping' in dataset
@@ -409,15 +447,61 @@ class PatternCoordinatorImages(PatternCoordinator):
                              for filename,params['current_image'] in
                              zip(filenames,range(self.patterns_per_label))]
         else:
-            filenames = sorted(glob.glob(self.filename_template))
+            filenames = sorted(self._glob(self.filename_template))
 
         return filenames
 
 
+    def _glob(self, template):
+        """
+        Return the filenames matching the glob pattern template, from
+        the archive if there is one.
+        """
+        if self._archive is None:
+            return glob.glob(template)
+        filenames = [os.path.join(self._dataset_path,name) for name in self._archive.names]
+        return fnmatch.filter(filenames,os.path.abspath(template))
+
+
+    def _member(self, filename):
+        "Return the name of filename in an archive of the dataset."
+        return os.path.relpath(os.path.abspath(filename),self._dataset_path).replace(os.sep,'/')
+
+
+    def pack(self, archive, reductions=(1,), processes=None):
+        """
+        Decode the images of the dataset (for all the pattern_labels)
+        and write them, along with the dataset's description, to the
+        image archive called archive, from which they can then be read
+        by passing archive to PatternCoordinatorImages.  See
+        imagen.imagepack.pack_images for the other arguments.
+        """
+        filenames, seen = [], set()
+        for pattern_label in self.pattern_labels:
+            for f,i in zip(self._generate_filenames({'pattern_label':pattern_label}),
+                           range(self.patterns_per_label)):
+                if f not in seen:
+                    seen.add(f)
+                    filenames.append(f)
+        pack_images(filenames,archive,[self._member(f) for f in filenames],
+                    reductions,self._manifest,processes)
+
+
     def _create_patterns(self, properties):
-        return [self.pattern_type(
-                    filename=f,
+        pattern_type = self.pattern_type
+        archive_params = {}
+        if self.archive is not None:
+            if not issubclass(pattern_type,ArchiveImage):
+                pattern_type = ArchiveImage
+            archive_params = dict(filename=self.archive)
+
+        factory = pattern_type
+        if self.lazy and issubclass(self.composite_type,Selector):
+            factory = functools.partial(GeneratorSpec,pattern_type)
+        return [factory(
                     cache_image=False,
-                    **self.pattern_parameters)
+                    **dict(self.pattern_parameters,
+                           **(dict(archive_params,member=self._member(f))
+                              if archive_params else dict(filename=f))))
                 for f,i in zip(self._generate_filenames(properties),
                                range(self.patterns_per_label))]
@@ -11,14 +11,16 @@ more information.
 import numpy as np
 from numpy import pi
 import collections
+import threading
 
 import param
 from param.parameterized import ParamOverrides
 
 from holoviews import HoloMap, Image, RGB, Dimension
 from holoviews.core import BoundingBox, BoundingRegionParameter, SheetCoordinateSystem
+from holoviews.core.sheetcoords import Slice
 
-from .transferfn import TransferFn
+from .transferfn import TransferFn, TransferFnWithState
 
 
 # CEBALERT: PatternGenerator has become a bit of a monster abstract
@@ -65,6 +67,18 @@ class PatternGenerator(param.Parameterized):
     """
     __abstract = True
 
+    # Subclasses whose function() computes each value only from
+    # pattern_x and pattern_y at the same location, using scalar
+    # parameter values, can set this to True.  Such patterns can then
+    # be evaluated on coordinate arrays of any shape, e.g. for many
+    # instances at once (see Composite).
+    _pointwise = False
+
+    # Subclasses that draw at most one of the generators they contain
+    # (e.g. Selector) set this to False, so that drawing them does not
+    # set up a _RenderContext, which would have nothing to share.
+    _shares_render_context = True
+
     bounds  = BoundingRegionParameter(
         default=BoundingBox(points=((-0.5,-0.5), (0.5,0.5))),precedence=-1,
         doc="BoundingBox of the area in which the pattern is generated.")
@@ -142,6 +156,12 @@ class PatternGenerator(param.Parameterized):
         if 'output_fns' in params_to_override:
             self.warning("Output functions specified through the call method will be ignored.")
 
+        # Only trees of generators have anything to share
+        if (self._shares_render_context and _RenderContext.current() is None
+            and _subgenerators(self)):
+            with _RenderContext(self):
+                return PatternGenerator.__call__(self,**params_to_override)
+
         p=ParamOverrides(self,params_to_override)
 
         # CEBERRORALERT: position parameter is not currently
@@ -167,7 +187,65 @@ class PatternGenerator(param.Parameterized):
         return result
 
 
+    def sample(self, xs, ys, **params_to_override):
+        """
+        Evaluate the pattern at the given sheet coordinates.
+
+        xs and ys are arrays (of any matching or broadcastable shape)
+        giving the x and y coordinates of each location at which to
+        evaluate the pattern, which need not lie on a regular grid.
+        The pattern is positioned, rotated, sized, scaled, offset and
+        masked as for __call__, but any mask array must have the shape
+        of xs and ys rather than that of the matrix.  Returns an array
+        with that shape.
+
+        Only patterns whose values do not depend on neighboring
+        locations can be evaluated this way; others raise
+        NotImplementedError.
+        """
+        if 'output_fns' in params_to_override:
+            self.warning("Output functions specified through the call method will be ignored.")
+
+        p=ParamOverrides(self,params_to_override)
+        xs,ys = np.broadcast_arrays(np.asarray(xs,dtype=float),np.asarray(ys,dtype=float))
+
+        fn_result = self._sample_function(p,xs,ys)
+        self._apply_sample_mask(p,xs,ys,fn_result)
+        if p.scale != 1.0:
+            result = p.scale * fn_result
+        else:
+            result = fn_result
+        if p.offset != 0.0:
+            result += p.offset
+
+        for of in p.output_fns:
+            of(result)
+
+        return result
+
+
+    def _sample_function(self, p, xs, ys):
+        """
+        Return the result of function() evaluated at the locations
+        xs, ys, before any mask, scale or offset is applied.
+        """
+        if not (self._pointwise and type(self).__call__ == PatternGenerator.__call__):
+            raise NotImplementedError("%s cannot be evaluated at arbitrary coordinates."
+                                      % self.__class__.__name__)
+
+        self.pattern_x, self.pattern_y = self._rotate_coordinate_arrays(xs-p.x,ys-p.y,p.orientation)
+        result = self.function(p)
+        if np.shape(result) != xs.shape:
+            result = np.ones(xs.shape)*result
+        return result
+
+
     def __getitem__(self, coords):
+        if self.num_channels() in [0, 1] and self._renders_pointwise():
+            item = self._getitem_region(coords)
+            if item is not None:
+                return item
+
         value_dims = {}
         if self.num_channels() in [0, 1]:
             raster, data = Image, self()
@@ -183,6 +261,73 @@ class PatternGenerator(param.Parameterized):
         return image if isinstance(coords, slice) else image.__getitem__(coords)
 
 
+    def _renders_pointwise(self):
+        """
+        Return True if each value returned by __call__ depends only on
+        the coordinates of its own location, so that any part of the
+        pattern can be drawn without drawing the rest.
+        """
+        return (self._pointwise and type(self).__call__ == PatternGenerator.__call__
+                and self.mask_shape is None and not self.output_fns)
+
+
+    def _getitem_region(self, coords):
+        """
+        Look up coords (a location, or slices along x and y) by
+        drawing only the part of the pattern they cover.  Returns None
+        if coords cannot be handled this way.
+
+        Which units are selected is decided by HoloViews, using an
+        Image of the same size as the whole pattern that is never
+        filled in.
+        """
+        if not (isinstance(coords, tuple) and len(coords)==2):
+            return None
+
+        shape = SheetCoordinateSystem(self.bounds,self.xdensity,self.ydensity).shape
+        value_dims = {'value_dimensions':[self.z]} if self.z else {}
+        template = Image(np.zeros(shape), bounds=self.bounds,
+                         **dict(group=self.group,
+                                label=self.__class__.__name__, **value_dims))
+
+        if not any(isinstance(c, slice) for c in coords):
+            r,c = template.sheet2matrixidx(*coords)
+            if not (0<=r<shape[0] and 0<=c<shape[1]):
+                return None
+            return self._draw_region(slice(r,r+1),slice(c,c+1))[0,0]
+
+        region = template[coords]
+        if not isinstance(region, Image):
+            return None
+        if region.data.size == 0:
+            return region
+        y0,y1,x0,x1 = Slice(region.bounds,template)
+        data = self._draw_region(slice(y0,y1),slice(x0,x1))
+        if data.shape != region.data.shape:
+            return None
+        return region.clone(data)
+
+
+    def _draw_region(self, rows, cols, **params_to_override):
+        """
+        Return the given rows and cols of the pattern matrix, drawing
+        only those units.
+        """
+        p = ParamOverrides(self,params_to_override)
+        x_points,y_points = SheetCoordinateSystem(
+            p.bounds,p.xdensity,p.ydensity).sheetcoordinates_of_matrixidx()
+        self.pattern_x, self.pattern_y = self._create_and_rotate_coordinate_arrays(
+            x_points[cols]-p.x,y_points[rows]-p.y,p.orientation)
+
+        result = self.function(p)
+        if p.mask is not None:
+            mask = np.asarray(p.mask)
+            result *= mask[rows,cols] if mask.ndim==2 else mask
+        if p.scale != 1.0:
+            result = p.scale * result
+        if p.offset != 0.0:
+            result += p.offset
+        return result
 
 
     def channels(self, use_cached=False, **params_to_override):
@@ -221,6 +366,11 @@ class PatternGenerator(param.Parameterized):
         # will be sampled.
 
         # CB: note to myself - use slice_._scs if supplied?
+        context = _RenderContext.current()
+        if context is not None:
+            self.pattern_x, self.pattern_y = context.coordinates(self,bounds,xdensity,ydensity,x,y,orientation)
+            return
+
         x_points,y_points = SheetCoordinateSystem(bounds,xdensity,ydensity).sheetcoordinates_of_matrixidx()
 
         # Generate matrices of x and y sheet coordinates at which to
@@ -257,17 +407,72 @@ class PatternGenerator(param.Parameterized):
         return pattern_x, pattern_y
 
 
+    def _rotate_coordinate_arrays(self, x, y, orientation):
+        """
+        Rotate the coordinate arrays x and y, which have the same
+        shape, to the specified orientation.  Equivalent to
+        _create_and_rotate_coordinate_arrays, but for coordinates
+        that are already paired up rather than forming a grid.
+        """
+        pattern_y = np.cos(orientation)*y - np.sin(orientation)*x
+        pattern_x = np.sin(orientation)*y + np.cos(orientation)*x
+        return pattern_x, pattern_y
+
+
+    def _mask_shape_overrides(self,p):
+        """
+        Return the position, orientation and size with which the
+        mask_shape is drawn, relative to this pattern.
+        """
+        ms=p.mask_shape
+        return dict(x=p.x+p.size*(ms.x*np.cos(p.orientation)-ms.y*np.sin(p.orientation)),
+                    y=p.y+p.size*(ms.x*np.sin(p.orientation)+ms.y*np.cos(p.orientation)),
+                    orientation=ms.orientation+p.orientation,size=ms.size*p.size)
+
+
+    def _mask_array(self,p):
+        """Return the mask, creating it from mask_shape if necessary."""
+        mask = p.mask
+        ms=p.mask_shape
+        if ms is not None:
+            overrides = dict(bounds=p.bounds,ydensity=p.ydensity,xdensity=p.xdensity,
+                             **self._mask_shape_overrides(p))
+            context = _RenderContext.current()
+            mask = ms(**overrides) if context is None else context.draw(ms,overrides,copy=False)
+        return mask
+
+
     def _apply_mask(self,p,mat):
         """Create (if necessary) and apply the mask to the given matrix mat."""
+        mask = self._mask_array(p)
+        if mask is not None:
+            mat*=mask
+
+
+    def _apply_sample_mask(self,p,xs,ys,values):
+        """
+        Create (if necessary) and apply the mask to the given values,
+        sampled at the locations xs, ys.
+        """
         mask = p.mask
         ms=p.mask_shape
         if ms is not None:
-            mask = ms(x=p.x+p.size*(ms.x*np.cos(p.orientation)-ms.y*np.sin(p.orientation)),
-                      y=p.y+p.size*(ms.x*np.sin(p.orientation)+ms.y*np.cos(p.orientation)),
-                      orientation=ms.orientation+p.orientation,size=ms.size*p.size,
-                      bounds=p.bounds,ydensity=p.ydensity,xdensity=p.xdensity)
+            mask = ms.sample(xs,ys,**self._mask_shape_overrides(p))
         if mask is not None:
-            mat*=mask
+            values*=mask
+
+
+    def compile(self, **params_to_override):
+        """
+        Return a RenderPlan that draws this pattern with its current
+        parameter values, overridden by any params specified.
+
+        Calling the plan gives the same result as calling this object,
+        but the parameter values and the coordinate and mask arrays
+        are looked up or computed only once, which matters mostly for
+        small patterns drawn many times.  See RenderPlan.
+        """
+        return RenderPlan(self, **params_to_override)
 
 
     def set_matrix_dimensions(self, bounds, xdensity, ydensity):
@@ -417,6 +622,486 @@ PatternGenerator.params('mask_shape').class_=PatternGenerator
 
 
 
+# Parameters on which the coordinate arrays of a RenderPlan depend,
+# and those on which its mask depends.
+_coordinate_parameters = set(['bounds', 'xdensity', 'ydensity', 'x', 'y', 'orientation'])
+_mask_parameters = _coordinate_parameters | set(['size', 'mask', 'mask_shape'])
+
+
+class _ParamSnapshot(object):
+    """
+    Plain object with the parameter values of a PatternGenerator as
+    attributes, used in place of ParamOverrides by RenderPlan.
+    """
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+
+class RenderPlan(object):
+    """
+    Callable that draws a PatternGenerator using parameter values
+    looked up once, as returned by PatternGenerator.compile().
+
+    For a PatternGenerator using the default __call__ method, the
+    coordinate arrays and any mask are also computed once, so that
+    calling the plan goes straight to the generator's function().
+    Other PatternGenerators are simply called with the overrides.
+
+    Dynamic parameter values are looked up again whenever a new value
+    would be generated, i.e. when the time has changed or, for values
+    that do not depend on time, on every call.  Other changes made to
+    the generator (or to any generators it contains) after compiling
+    are not seen by the plan; use update() or compile the generator
+    again instead.  In particular, the mask is drawn from mask_shape
+    when the plan is built (or updated), so dynamic parameters of the
+    mask_shape keep the values they had then.
+
+    The coordinate arrays are reused by every call, and so are
+    read-only.
+    """
+
+    __slots__ = ['generator', 'p', '_overrides', '_dynamic', '_direct',
+                 '_pattern_x', '_pattern_y', '_mask']
+
+    def __init__(self, generator, **params_to_override):
+        self.generator = generator
+        self.p = None
+        self._overrides = dict(params_to_override)
+        self._direct = type(generator).__call__ == PatternGenerator.__call__
+        self._dynamic = []
+        if self._direct:
+            self._set_values(self._resolve())
+
+
+    def __call__(self):
+        if not self._direct:
+            return self.generator(**self._overrides)
+
+        if self._dynamic and self._stale():
+            self._set_values(self._resolve())
+
+        g,p = self.generator,self.p
+        g.pattern_x, g.pattern_y = self._pattern_x, self._pattern_y
+        fn_result = g.function(p)
+        if self._mask is not None:
+            fn_result*=self._mask
+        if p.scale != 1.0:
+            result = p.scale * fn_result
+        else:
+            result = fn_result
+        if p.offset != 0.0:
+            result += p.offset
+
+        for of in p.output_fns:
+            of(result)
+
+        return result
+
+
+    def update(self, **changes):
+        """
+        Change the values of the specified parameters, recomputing
+        only what depends on them.
+        """
+        self._overrides.update(changes)
+        if not self._direct:
+            return
+        self._dynamic = [d for d in self._dynamic if d[0] not in changes]
+        values = dict(self.p.__dict__)
+        values.update(changes)
+        self._set_values(values)
+
+
+    def _resolve(self):
+        """
+        Return the values of all parameters of the generator, noting
+        which of them are dynamic.
+        """
+        g = self.generator
+        values, self._dynamic = {}, []
+        for name,param_obj in g.params().items():
+            if name in self._overrides:
+                values[name] = self._overrides[name]
+                continue
+            if hasattr(param_obj,'_value_is_dynamic') and param_obj._value_is_dynamic(g):
+                gen = g.get_value_generator(name)
+                time_fn = getattr(gen,'_Dynamic_time_fn',param_obj.time_fn)
+                if not param_obj.time_dependent:
+                    time_fn = None
+                self._dynamic.append((name,time_fn,None if time_fn is None else time_fn()))
+            values[name] = getattr(g,name)
+        return values
+
+
+    def _stale(self):
+        """Return True if any dynamic parameter would have a new value."""
+        for name,time_fn,time in self._dynamic:
+            if time_fn is None or time_fn() != time:
+                return True
+        return False
+
+
+    def _set_values(self, values):
+        """
+        Store the given parameter values, recomputing the coordinate
+        arrays and mask if any values they depend on have changed.
+        """
+        old = self.p.__dict__ if self.p is not None else {}
+        changed = set(name for name in values if name not in old or old[name] is not values[name])
+        g = self.generator
+        p = self.p = _ParamSnapshot(values)
+
+        if changed & _coordinate_parameters:
+            x_points,y_points = SheetCoordinateSystem(p.bounds,p.xdensity,p.ydensity).sheetcoordinates_of_matrixidx()
+            self._pattern_x, self._pattern_y = g._create_and_rotate_coordinate_arrays(
+                x_points-p.x,y_points-p.y,p.orientation)
+            self._pattern_x.flags.writeable = False
+            self._pattern_y.flags.writeable = False
+
+        if changed & _mask_parameters:
+            self._mask = p.mask
+            if p.mask_shape is not None:
+                self._mask = p.mask_shape(bounds=p.bounds,ydensity=p.ydensity,xdensity=p.xdensity,
+                                          **g._mask_shape_overrides(p))
+
+
+
+class _RenderContext(object):
+    """
+    Intermediate results shared between the PatternGenerators drawn
+    while drawing one top-level PatternGenerator.
+
+    A context is entered by the outermost PatternGenerator.__call__
+    (unless that generator draws at most one of the generators it
+    contains, as for Selector) and lasts until it returns.  Within
+    it, coordinate arrays are computed once for each set of bounds,
+    density, position and orientation, masks are drawn once for each
+    mask_shape and set of parameter values, and generators that
+    appear more than once in the tree (as found, when first needed,
+    by walking generators, generator and mask_shape from the
+    top-level PatternGenerator) are drawn once for each set of
+    parameter values.  Generators with dynamic
+    parameters that produce a new value on every access, or with
+    output functions that keep state, are always drawn again.
+
+    The coordinate arrays are shared by every generator drawn with
+    them, and so are read-only: a function must not modify
+    p.pattern_x or p.pattern_y in place.
+    """
+
+    _state = threading.local()
+
+    # Maximum number of rotated coordinate arrays kept at once
+    max_coordinates = 8
+
+    def __init__(self, root):
+        self._vectors = {}
+        self._coordinates = collections.OrderedDict()
+        self._results = {}
+        self._reusable = {}
+        # Objects whose id is used in a key, kept alive until the end
+        self._keep = []
+        self._root = root
+        self._shared = None # Found when first needed
+
+
+    @classmethod
+    def current(cls):
+        """Return the context of the drawing in progress, if any."""
+        return getattr(cls._state,'context',None)
+
+
+    def __enter__(self):
+        self._state.context = self
+        return self
+
+
+    def __exit__(self, *args):
+        self._state.context = None
+
+
+    def _find_shared(self, root):
+        """Return the ids of generators reachable more than once from root."""
+        seen, shared = set(), set()
+        stack = [root]
+        while stack:
+            pg = stack.pop()
+            if id(pg) in seen:
+                shared.add(id(pg))
+                continue
+            seen.add(id(pg))
+            stack.extend(_subgenerators(pg))
+        return shared
+
+
+    def coordinates(self, pg, bounds, xdensity, ydensity, x, y, orientation):
+        """Return the rotated coordinate arrays, as for _setup_xy."""
+        grid = (bounds.lbrt(),xdensity,ydensity)
+        key = (grid,x,y,orientation)
+        if key in self._coordinates:
+            return self._coordinates[key]
+
+        if grid not in self._vectors:
+            self._vectors[grid] = SheetCoordinateSystem(bounds,xdensity,ydensity).sheetcoordinates_of_matrixidx()
+        x_points,y_points = self._vectors[grid]
+        arrays = pg._create_and_rotate_coordinate_arrays(x_points-x,y_points-y,orientation)
+        for a in arrays:
+            a.flags.writeable = False
+
+        self._coordinates[key] = arrays
+        if len(self._coordinates) > self.max_coordinates:
+            self._coordinates.popitem(last=False)
+        return arrays
+
+
+    def draw(self, pg, overrides, copy=True):
+        """
+        Return pg(**overrides), drawn only once per context for
+        generators that can be reused.  Unless copy is False, the
+        caller receives its own copy of a reused result.
+        """
+        if (not copy or self._is_shared(pg)) and self._can_reuse(pg):
+            key = self._key(pg,overrides)
+            if key is not None:
+                if key not in self._results:
+                    self._results[key] = pg(**overrides)
+                result = self._results[key]
+                return np.array(result) if copy else result
+        return pg(**overrides)
+
+
+    def _is_shared(self, pg):
+        """Return True if pg is reachable more than once from the root."""
+        if self._shared is None:
+            self._shared = self._find_shared(self._root)
+        return id(pg) in self._shared
+
+
+    def _can_reuse(self, pg):
+        """
+        Return True if drawing pg again with the same parameters in
+        this context would give the same result.
+        """
+        if id(pg) not in self._reusable:
+            self._reusable[id(pg)] = _is_repeatable(pg)
+            self._keep.append(pg)
+        return self._reusable[id(pg)]
+
+
+    def _key(self, pg, overrides):
+        """Return a hashable key for pg drawn with overrides, or None."""
+        items = []
+        for name,value in sorted(overrides.items()):
+            if isinstance(value,BoundingBox):
+                value = value.lbrt()
+            elif isinstance(value,np.ndarray):
+                self._keep.append(value)
+                value = ('array',id(value))
+            try:
+                hash(value)
+            except TypeError:
+                return None
+            items.append((name,value))
+        self._keep.append(pg)
+        return (id(pg),tuple(items))
+
+
+
+class TranslationCache(object):
+    """
+    Draws a PatternGenerator translated by varying amounts, by drawing
+    it once on a canvas larger than the requested bounds and returning
+    the part of the canvas that the translated pattern would cover.
+
+    Only single-channel PatternGenerators whose values do not depend
+    on neighboring locations are supported.  A translation by a whole
+    number of matrix units in each direction gives the same result as
+    drawing the translated pattern, up to floating-point rounding.
+    Other translations are supported only in 'fourier' mode, by
+    shifting the canvas by multiplying its Fourier transform with a
+    phase ramp; this is exact only for band-limited patterns, and
+    patterns with sharp edges will show some ringing.
+
+    The canvas is drawn again whenever the generator's parameter
+    values (or the parameters the canvas was drawn with) change, or
+    when a translation goes beyond the canvas.
+    """
+
+    # Matrix units added around the canvas beyond the expected
+    # translation, as a guard against wraparound for 'fourier' mode
+    fourier_padding = 8
+
+    def __init__(self):
+        self._clear()
+
+
+    def _clear(self):
+        self._key = None
+        self._canvas = None
+        self._spectrum = None
+        self._ramps = {}
+
+
+    def __getstate__(self):
+        # The canvas can always be drawn again
+        return {}
+
+
+    def __setstate__(self, state):
+        self._clear()
+
+
+    def __call__(self, pg, overrides, dx, dy, margin=0.0, mode='integer'):
+        """
+        Return pg(**overrides) translated by dx, dy (in sheet
+        coordinates), or None if this translation cannot be produced
+        from the canvas so that pg has to be drawn as usual.
+
+        overrides must include the bounds, xdensity and ydensity.
+        margin is the largest translation expected before the
+        generator's parameters next change, so that the canvas can be
+        made large enough on the first call.
+        """
+        if (mode=='none' or not pg._renders_pointwise() or pg.num_channels()!=1 or
+            overrides.get('mask',pg.mask) is not None or _has_untimed_dynamic_values(pg)):
+            return None
+
+        scs = SheetCoordinateSystem(overrides['bounds'],overrides['xdensity'],overrides['ydensity'])
+        shift_c, shift_r = dx*scs.xdensity, -dy*scs.ydensity
+        whole = abs(shift_c-round(shift_c))<1e-6 and abs(shift_r-round(shift_r))<1e-6
+        if not whole and mode!='fourier':
+            return None
+        if whole:
+            shift_c, shift_r = int(round(shift_c)), int(round(shift_r))
+
+        key = (pg,pg.get_param_values(),sorted(overrides.items()))
+        needed = int(np.ceil(max(abs(shift_c),abs(shift_r))))
+        if (self._canvas is None or not _same_values(key,self._key)
+            or needed > self._padding - (0 if whole else self.fourier_padding)):
+            padding = int(np.ceil(max(margin*scs.xdensity,margin*scs.ydensity,needed)))
+            self._draw_canvas(pg,overrides,scs,padding+self.fourier_padding)
+            self._key = key
+
+        rows,cols = scs.shape
+        m = self._padding
+        if whole:
+            frame = self._canvas[m-shift_r:m-shift_r+rows,m-shift_c:m-shift_c+cols]
+        else:
+            frame = self._fourier_shift(shift_r,shift_c)[m:m+rows,m:m+cols]
+        return np.array(frame)
+
+
+    def _draw_canvas(self, pg, overrides, scs, padding):
+        """Draw pg with padding matrix units around the requested bounds."""
+        self._clear()
+        self._padding = padding
+        rows,cols = scs.shape
+        x_points = scs.matrixidx2sheet(0,np.arange(-padding,cols+padding))[0]
+        y_points = scs.matrixidx2sheet(np.arange(-padding,rows+padding),0)[1]
+
+        p = ParamOverrides(pg,overrides)
+        pg.pattern_x, pg.pattern_y = pg._create_and_rotate_coordinate_arrays(
+            x_points-p.x,y_points-p.y,p.orientation)
+        canvas = pg.function(p)
+        if p.scale != 1.0:
+            canvas = p.scale * canvas
+        if p.offset != 0.0:
+            canvas = canvas + p.offset
+        self._canvas = np.asarray(canvas,dtype=float)
+
+
+    def _fourier_shift(self, shift_r, shift_c):
+        """Return the canvas shifted by a (fractional) number of rows and columns."""
+        if self._spectrum is None:
+            self._spectrum = np.fft.rfft2(self._canvas)
+        key = (round(shift_r,9),round(shift_c,9))
+        if key not in self._ramps:
+            fr = np.fft.fftfreq(self._canvas.shape[0])[:,np.newaxis]
+            fc = np.fft.rfftfreq(self._canvas.shape[1])[np.newaxis,:]
+            self._ramps[key] = np.exp(-2j*pi*(fr*shift_r+fc*shift_c))
+        return np.fft.irfft2(self._spectrum*self._ramps[key],s=self._canvas.shape)
+
+
+
+def _same_values(a, b):
+    """
+    Return True if a and b are equal, comparing sequences element by
+    element and arrays and other objects that cannot be compared for
+    equality by identity.
+    """
+    if a is b:
+        return True
+    if isinstance(a,(list,tuple)) and isinstance(b,(list,tuple)):
+        return len(a)==len(b) and all(_same_values(x,y) for x,y in zip(a,b))
+    if isinstance(a,np.ndarray) or isinstance(b,np.ndarray):
+        return False
+    try:
+        return bool(a==b)
+    except Exception:
+        return False
+
+
+def _subgenerators(pg):
+    """Return the PatternGenerators that pg contains."""
+    subs = []
+    for name in ['generators','generator','mask_shape']:
+        value = getattr(pg,name,None)
+        if isinstance(value,PatternGenerator):
+            subs.append(value)
+        elif isinstance(value,(list,tuple)):
+            subs.extend(v for v in value if isinstance(v,PatternGenerator))
+    return subs
+
+
+def _has_untimed_dynamic_values(pg):
+    """
+    Return True if any parameter of pg is dynamic and produces a new
+    value each time it is accessed, rather than once per time.
+    """
+    for name,param_obj in pg.params().items():
+        if hasattr(param_obj,'_value_is_dynamic') and param_obj._value_is_dynamic(pg):
+            gen = pg.get_value_generator(name)
+            if not param_obj.time_dependent or getattr(gen,'_Dynamic_time_fn',param_obj.time_fn) is None:
+                return True
+    return False
+
+
+
+def _is_repeatable(pg, fixed_subgenerators=False):
+    """
+    Return True if drawing pg again with the same parameter values
+    (at the same time) would give the same result: neither pg nor any
+    generator it contains has dynamic parameters producing a new
+    value on each access, or output functions that keep state.  If
+    fixed_subgenerators is True, the generators pg contains must have
+    no dynamic parameters at all, so that they also do not change
+    with time.
+    """
+    if (_has_untimed_dynamic_values(pg) or
+        any(isinstance(of,TransferFnWithState) for of in pg.output_fns)):
+        return False
+    for sub in _subgenerators(pg):
+        if fixed_subgenerators and _has_dynamic_values(sub):
+            return False
+        if not _is_repeatable(sub,fixed_subgenerators):
+            return False
+    return True
+
+
+def _has_dynamic_values(pg):
+    """Return True if any parameter of pg is dynamic."""
+    for name,param_obj in pg.params().items():
+        if hasattr(param_obj,'_value_is_dynamic') and param_obj._value_is_dynamic(pg):
+            return True
+    return False
+
+
+def _has_output_fns(pg):
+    """Return True if pg or any PatternGenerator it contains has output functions."""
+    return bool(pg.output_fns) or any(_has_output_fns(sub) for sub in _subgenerators(pg))
+
+
+
 # Trivial example of a PatternGenerator, provided for when a default is
 # needed.  The other concrete PatternGenerator classes are stored
 # elsewhere, to be imported as needed.
@@ -444,6 +1129,77 @@ class Constant(PatternGenerator):
         return result
 
 
+    def sample(self, xs, ys, **params_to_override):
+        p = ParamOverrides(self,params_to_override)
+        xs,ys = np.broadcast_arrays(np.asarray(xs,dtype=float),np.asarray(ys,dtype=float))
+
+        result = p.scale*np.ones(xs.shape, np.float)+p.offset
+        self._apply_sample_mask(p,xs,ys,result)
+
+        for of in p.output_fns:
+            of(result)
+
+        return result
+
+
+
+class GeneratorSpec(object):
+    """
+    Description of a PatternGenerator that is created only when it is
+    first needed, e.g. when a Selector first selects it.
+
+    Calling the spec creates the PatternGenerator by calling factory
+    (typically a PatternGenerator class) with the supplied arguments,
+    and then passing the result through each function added with
+    apply().  A spec takes much less memory than the PatternGenerator
+    it describes, so large collections of generators (such as one
+    FileImage per image of a dataset) can be described up front and
+    created only as they are used.
+    """
+
+    __slots__ = ['factory','args','params','modifiers']
+
+    def __init__(self, factory, *args, **params):
+        self.factory = factory
+        self.args = args
+        self.params = params
+        self.modifiers = ()
+
+
+    def __call__(self):
+        """Create and return the PatternGenerator."""
+        pg = self.factory(*self.args,**self.params)
+        for fn,args,kwargs in self.modifiers:
+            pg = fn(pg,*args,**kwargs)
+        return pg
+
+
+    def apply(self, fn, *args, **kwargs):
+        """
+        Return a new spec for the result of fn(pg, *args, **kwargs),
+        where pg is the PatternGenerator described by this spec.
+        """
+        spec = GeneratorSpec(self.factory,*self.args,**self.params)
+        spec.modifiers = self.modifiers + ((fn,args,kwargs),)
+        return spec
+
+
+    def __getstate__(self):
+        return dict((name,getattr(self,name)) for name in self.__slots__)
+
+
+    def __setstate__(self, state):
+        for name,value in state.items():
+            setattr(self,name,value)
+
+
+    def __repr__(self):
+        args = [getattr(self.factory,'__name__',repr(self.factory))]
+        args += [repr(a) for a in self.args]
+        args += ['%s=%r' % item for item in sorted(self.params.items())]
+        return 'GeneratorSpec(%s)' % ', '.join(args)
+
+
 
 class CompositeBase(PatternGenerator):
     """
@@ -461,6 +1217,30 @@ class CompositeBase(PatternGenerator):
     size = param.Number(default=1.0,doc="""Scaling factor applied to all sub-patterns.""")
 
 
+    def _draw_generator(self, pg, overrides):
+        """
+        Draw one of the generators with the given overrides, reusing
+        an earlier result if it has already been drawn with them (see
+        _RenderContext).
+        """
+        context = _RenderContext.current()
+        if context is None:
+            return pg(**overrides)
+        return context.draw(pg,overrides)
+
+
+
+# Operators for which the order of combining patterns does not matter,
+# so that instances can be grouped by class (see Composite).
+_commutative_operators = (np.add, np.multiply, np.maximum, np.minimum)
+
+# Parameters that may differ between instances rendered together, or
+# that are supplied by the Composite itself.
+_instance_parameters = set(['name', 'x', 'y', 'position', 'orientation',
+                            'scale', 'offset', 'bounds', 'xdensity',
+                            'ydensity', 'mask', 'mask_shape', 'output_fns',
+                            'z', 'group'])
+
 
 class Composite(CompositeBase):
     """
@@ -468,6 +1248,23 @@ class Composite(CompositeBase):
     To create a new pattern, asks each of the PatternGenerators in the
     list to create a pattern, then it combines the patterns to create
     a single pattern that it returns.
+
+    When the operator is one of add, multiply, maximum or minimum,
+    generators of the same pointwise class whose parameters differ
+    only in position, orientation, scale and offset are rendered
+    together as instances, with one vectorized call per
+    instance_chunk_pixels pixels of patterns.  The result is the same as
+    rendering each generator separately, up to floating-point rounding
+    for add and multiply.
+
+    By default the mask (or mask_shape) is applied to each generator
+    as well as to the combined pattern.  With mask_mode='once' it is
+    applied only to the combined pattern, and the generators are drawn
+    only within the smallest rectangle containing the non-zero values
+    of the mask.  For a mask of zeros and ones the result is the same
+    either way, but for other masks it is not: with add, for instance,
+    each value m of the mask multiplies the combined pattern by m*m by
+    default but by m in 'once' mode.
     """
 
     # The Accum_Replace operator from LISSOM is not yet supported,
@@ -493,6 +1290,9 @@ class Composite(CompositeBase):
         are uses for at least some of the others as well (e.g. to
         remove pieces of other patterns).
 
+        Binary ufuncs are applied to each pattern as soon as it has
+        been drawn, accumulating the result in a single array.
+
         You can also write your own operators, by making a class that
         has a static method named "reduce" that returns an array of the
         same size and type as the arrays in the list.  For example::
@@ -504,6 +1304,25 @@ class Composite(CompositeBase):
 
         """)
 
+    instanced = param.Boolean(default=True,precedence=-1,doc="""
+        Whether to render generators of the same class that differ only
+        in position, orientation, scale and offset together, when the
+        operator allows the patterns to be combined in any order.""")
+
+    instance_chunk_pixels = param.Integer(default=2**14,bounds=(1,None),precedence=-1,doc="""
+        Maximum total number of pixels of the instances rendered in
+        one vectorized call.  Vectorizing helps only while the
+        temporary arrays stay small, so patterns larger than half
+        this size (by default, larger than about 90x90) are rendered
+        separately.""")
+
+    mask_mode = param.ObjectSelector(default='children',objects=['children','once'],
+        precedence=-1,doc="""
+        Whether the mask is applied to each of the generators and then
+        to the combined pattern ('children'), or only to the combined
+        pattern, drawing the generators only where the mask is non-zero
+        ('once').""")
+
 
     def _advance_pattern_generators(self,p):
         """
@@ -529,6 +1348,123 @@ class Composite(CompositeBase):
         for gen in self.generators:
             gen.state_pop()
 
+    def _child_overrides(self,pg,p):
+        """
+        Return the parameter values with which the generator pg is
+        drawn as part of this Composite.
+        """
+        # CEBALERT: mask gets applied by all PGs including the Composite itself
+        # (leads to redundant calculations in current lissom_oo_or usage, but
+        # will lead to problems/limitations in the future).  See mask_mode.
+        return dict(xdensity=p.xdensity,ydensity=p.ydensity,
+                    bounds=p.bounds,mask=p.mask if p.mask_mode=='children' else None,
+                    x=p.x+p.size*(pg.x*np.cos(p.orientation)- pg.y*np.sin(p.orientation)),
+                    y=p.y+p.size*(pg.x*np.sin(p.orientation)+ pg.y*np.cos(p.orientation)),
+                    orientation=pg.orientation+p.orientation,
+                    size=pg.size*p.size)
+
+
+    def _sample_function(self,p,xs,ys):
+        """Combine the individual patterns evaluated at xs, ys."""
+        if type(self).function != Composite.function:
+            return super(Composite,self)._sample_function(p,xs,ys)
+
+        generators = self._advance_pattern_generators(p)
+
+        assert hasattr(p.operator,'reduce'),repr(p.operator)+" does not support 'reduce'."
+
+        patterns = []
+        for pg in generators:
+            overrides = self._child_overrides(pg,p)
+            for name in ['xdensity','ydensity','bounds']:
+                del overrides[name]
+            patterns.append(pg.sample(xs,ys,**overrides))
+        return p.operator.reduce(patterns)
+
+
+    def _instance_key(self,pg,overrides):
+        """
+        Return a key shared by all generators that can be rendered
+        together with pg as instances, or None if pg has to be
+        rendered on its own.  Generators with untimed dynamic values
+        are rendered on their own, because reading their values for the
+        key would draw values that rendering them would then not use.
+        """
+        if not pg._renders_pointwise() or _has_untimed_dynamic_values(pg):
+            return None
+
+        values = tuple((name,overrides.get(name,getattr(pg,name)))
+                       for name in sorted(pg.params()) if name not in _instance_parameters)
+        key = (type(pg),values)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+
+    def _render_instances(self,instances,p,region=None):
+        """
+        Render a list of (generator,overrides) pairs sharing an
+        instance key, and return their combination under p.operator.
+
+        The generators are drawn on (instances,rows,cols) coordinate
+        arrays of at most instance_chunk_pixels values, using the
+        function of the first generator in the list.  If region is
+        given, only those (rows,cols) of the matrix are drawn.
+        """
+        pg = instances[0][0]
+        x_points,y_points = SheetCoordinateSystem(p.bounds,p.xdensity,p.ydensity).sheetcoordinates_of_matrixidx()
+        if region is not None:
+            x_points,y_points = x_points[region[1]],y_points[region[0]]
+        y_points = y_points[:,np.newaxis]
+        chunk_size = self._instance_chunk_size(p,len(y_points)*len(x_points))
+
+        combined = None
+        for start in range(0,len(instances),chunk_size):
+            chunk = instances[start:start+chunk_size]
+            x,y,orientation = [np.array([overrides[name] for g,overrides in chunk],dtype=float).reshape(-1,1,1)
+                               for name in ('x','y','orientation')]
+            scale = np.array([g.scale for g,overrides in chunk],dtype=float).reshape(-1,1,1)
+            offset = np.array([g.offset for g,overrides in chunk],dtype=float).reshape(-1,1,1)
+
+            # Same coordinates as _setup_xy, one plane per instance
+            xs, ys = x_points-x, y_points-y
+            pg.pattern_x = np.sin(orientation)*ys + np.cos(orientation)*xs
+            pg.pattern_y = np.cos(orientation)*ys - np.sin(orientation)*xs
+
+            q = ParamOverrides(pg,chunk[0][1])
+            result = pg.function(q)
+            pg._apply_mask(q,result)
+            if (scale!=1.0).any():
+                result = scale*result
+            if (offset!=0.0).any():
+                result = result+offset
+
+            reduced = p.operator.reduce(result)
+            combined = reduced if combined is None else p.operator(combined,reduced)
+
+        del pg.pattern_x, pg.pattern_y
+        return combined
+
+
+    def _instance_chunk_size(self,p,pixels):
+        "Number of instances of the given number of pixels drawn at once."
+        return max(1,p.instance_chunk_pixels//max(1,pixels))
+
+
+    def _draw_child(self,pg,overrides,region):
+        """
+        Draw one of the generators, returning only the given region
+        (rows,cols) of the matrix, or all of it if region is None.
+        """
+        if region is None:
+            return self._draw_generator(pg,overrides)
+        if pg._renders_pointwise():
+            return pg._draw_region(region[0],region[1],**overrides)
+        return self._draw_generator(pg,overrides)[region]
+
+
     # JABALERT: To support large numbers of patterns on a large input region,
     # should be changed to evaluate each pattern in a small box, and then
     # combine them at the full Composite Bounding box size.
@@ -536,23 +1472,86 @@ class Composite(CompositeBase):
         """Constructs combined pattern out of the individual ones."""
         generators = self._advance_pattern_generators(p)
 
+        # Rows and columns containing the non-zero part of the mask,
+        # when the mask is applied only once (by __call__)
+        region = None
+        if p.mask_mode=='once':
+            mask = self._mask_array(p)
+            if mask is not None and np.ndim(mask)==2:
+                region = _nonzero_region(mask)
+
         assert hasattr(p.operator,'reduce'),repr(p.operator)+" does not support 'reduce'."
 
-        # CEBALERT: mask gets applied by all PGs including the Composite itself
-        # (leads to redundant calculations in current lissom_oo_or usage, but
-        # will lead to problems/limitations in the future).
-        patterns = [pg(xdensity=p.xdensity,ydensity=p.ydensity,
-                       bounds=p.bounds,mask=p.mask,
-                       x=p.x+p.size*(pg.x*np.cos(p.orientation)- pg.y*np.sin(p.orientation)),
-                       y=p.y+p.size*(pg.x*np.sin(p.orientation)+ pg.y*np.cos(p.orientation)),
-                       orientation=pg.orientation+p.orientation,
-                       size=pg.size*p.size)
-                    for pg in generators]
-        image_array = p.operator.reduce(patterns)
+        instanced = p.instanced and p.operator in _commutative_operators
+        if instanced:
+            if region is None:
+                pixels = np.prod(SheetCoordinateSystem(p.bounds,p.xdensity,p.ydensity).shape)
+            else:
+                pixels = (region[0].stop-region[0].start)*(region[1].stop-region[1].start)
+            # Instances drawn one at a time are no faster than separately
+            instanced = self._instance_chunk_size(p,pixels)>1
+
+        # Each entry is a list of (generator,overrides) pairs, drawn
+        # together when there is more than one
+        entries, groups = [], {}
+        for pg in generators:
+            overrides = self._child_overrides(pg,p)
+            key = self._instance_key(pg,overrides) if instanced else None
+            if key is None:
+                entries.append([(pg,overrides)])
+            elif key in groups:
+                groups[key].append((pg,overrides))
+            else:
+                groups[key] = [(pg,overrides)]
+                entries.append(groups[key])
+
+        patterns = (self._render_instances(entry,p,region) if len(entry)>1
+                    else self._draw_child(entry[0][0],entry[0][1],region) for entry in entries)
+
+        if not (isinstance(p.operator,np.ufunc) and p.operator.nin==2):
+            image_array = p.operator.reduce(list(patterns))
+        else:
+            # Combine each pattern into one array as soon as it has been
+            # drawn, rather than keeping every pattern until the end.
+            # ufunc.reduce applies the operator from left to right, so the
+            # result is the same, provided the accumulator starts with the
+            # type reduce would give (e.g. int rather than bool for add).
+            image_array = None
+            for pattern in patterns:
+                if image_array is None:
+                    # Copied because generators may return arrays they keep
+                    pattern = np.asarray(pattern)
+                    dtype = p.operator.reduce(np.zeros(1,dtype=pattern.dtype)).dtype
+                    image_array = np.array(pattern,dtype=dtype)
+                    continue
+                try:
+                    p.operator(image_array,pattern,out=image_array)
+                except TypeError:
+                    # Result needs a different type, e.g. float from bool
+                    image_array = p.operator(image_array,pattern)
+
+        if region is not None:
+            # Everything outside the region is masked out anyway
+            full = np.zeros(mask.shape,dtype=np.result_type(image_array,float))
+            full[region] = image_array
+            image_array = full
         return image_array
 
 
 
+def _nonzero_region(mask):
+    """
+    Return the (rows,cols) slices of the smallest rectangle containing
+    all the non-zero values of the 2D array mask.
+    """
+    rows = np.flatnonzero(np.any(mask,axis=1))
+    cols = np.flatnonzero(np.any(mask,axis=0))
+    if len(rows)==0:
+        return slice(0,0),slice(0,0)
+    return slice(rows[0],rows[-1]+1),slice(cols[0],cols[-1]+1)
+
+
+
 class ChannelTransform(param.Parameterized):
     """
     A ChannelTransform is a callable object that takes channels as
@@ -0,0 +1,149 @@
+"""
+Description of PatternGenerators (and other Parameterized objects,
+such as the numbergen objects controlling their parameters) as
+JSON-serializable specifications plus a list of arrays, from which
+equivalent objects can be created again.
+
+A specification is much smaller and faster to create objects from
+than a pickle of the objects, which makes it suitable for sending
+generator trees to worker processes: only the parameters that differ
+from their defaults are recorded, and arrays are kept apart from the
+JSON so that they can be sent as raw buffers (e.g. as pickle protocol
+5 out-of-band buffers, or in shared memory).
+
+The objects are created again from their parameter values, so any
+state not held in parameters (e.g. images already loaded by a
+FileImage, which are loaded again from their files or image_cache) is
+not preserved.  Values that cannot be described (e.g. the random
+number generators of numbergen objects) are pickled, and the pickle
+stored as an array.
+"""
+
+import pickle
+import importlib
+import types
+
+import numpy as np
+
+import param
+import numbergen
+
+from .patterngenerator import _same_values
+
+
+# Parameterized classes created from attributes other than parameters:
+# the names of the attributes passed as positional arguments, and of
+# the attribute holding a dictionary of keyword arguments
+_constructors = [(numbergen.BinaryOperator,['lhs','rhs','operator'],'args'),
+                 (numbergen.UnaryOperator,['operand','operator'],'args')]
+
+
+def to_spec(obj):
+    """
+    Return (spec,arrays): a JSON-serializable specification of obj
+    (e.g. a PatternGenerator) and the list of arrays it refers to,
+    from which from_spec can create an equivalent object.  Objects
+    referred to more than once are described once, and shared by the
+    objects created.
+    """
+    arrays = []
+    return _encode(obj,arrays,{}), arrays
+
+
+def from_spec(spec, arrays):
+    """Return an object created from a specification returned by to_spec."""
+    return _decode(spec,arrays,{})
+
+
+
+def _path(obj):
+    "Return the importable path of a class or function, or None."
+    module, name = getattr(obj,'__module__',None), getattr(obj,'__name__',None)
+    if isinstance(obj,np.ufunc):
+        module = 'numpy'
+    if module is None or name is None:
+        return None
+    try:
+        if getattr(importlib.import_module(module),name) is obj:
+            return module+'.'+name
+    except (ImportError,AttributeError):
+        pass
+    return None
+
+
+def _resolve(path):
+    module, name = path.rsplit('.',1)
+    return getattr(importlib.import_module(module),name)
+
+
+def _encode(value, arrays, memo):
+    if value is None or isinstance(value,(bool,int,float,str)):
+        return value
+    elif isinstance(value,np.generic):
+        return value.item()
+    elif isinstance(value,np.ndarray):
+        arrays.append(value)
+        return {'__array__':len(arrays)-1}
+    elif type(value) is list:
+        return [_encode(v,arrays,memo) for v in value]
+    elif type(value) is tuple:
+        return {'__tuple__':[_encode(v,arrays,memo) for v in value]}
+    elif type(value) is dict and all(isinstance(k,str) for k in value):
+        return {'__dict__':dict((k,_encode(v,arrays,memo)) for k,v in value.items())}
+    elif isinstance(value,param.Parameterized) and _path(type(value)):
+        if id(value) in memo:
+            return {'__ref__':memo[id(value)][0]}
+        # Kept in the memo so that the id is not reused while encoding
+        memo[id(value)] = (len(memo),value)
+        spec = {'__object__':memo[id(value)][0],'class':_path(type(value))}
+        for cls,positional,keywords in _constructors:
+            if isinstance(value,cls):
+                spec['args'] = [_encode(getattr(value,a),arrays,memo) for a in positional]
+                spec['params'] = _encode(getattr(value,keywords),arrays,memo)['__dict__']
+                return spec
+
+        spec['params'] = params = {}
+        for name,param_obj in value.params().items():
+            if param_obj.readonly or isinstance(param_obj,param.Composite):
+                continue
+            v = value.get_value_generator(name)
+            # Parameterized objects (e.g. param.Time) may compare
+            # equal to the default without being it
+            if isinstance(v,param.Parameterized):
+                same = v is param_obj.default
+            else:
+                same = _same_values(v,param_obj.default)
+            if not same:
+                params[name] = _encode(v,arrays,memo)
+        return spec
+    elif isinstance(value,(type,types.FunctionType,types.BuiltinFunctionType,np.ufunc)) \
+            and _path(value):
+        return {'__path__':_path(value)}
+
+    arrays.append(np.frombuffer(pickle.dumps(value,pickle.HIGHEST_PROTOCOL),dtype=np.uint8))
+    return {'__pickle__':len(arrays)-1}
+
+
+def _decode(spec, arrays, memo):
+    if isinstance(spec,list):
+        return [_decode(v,arrays,memo) for v in spec]
+    elif not isinstance(spec,dict):
+        return spec
+    elif '__array__' in spec:
+        return arrays[spec['__array__']]
+    elif '__tuple__' in spec:
+        return tuple(_decode(v,arrays,memo) for v in spec['__tuple__'])
+    elif '__dict__' in spec:
+        return dict((k,_decode(v,arrays,memo)) for k,v in spec['__dict__'].items())
+    elif '__ref__' in spec:
+        return memo[spec['__ref__']]
+    elif '__object__' in spec:
+        args = [_decode(v,arrays,memo) for v in spec.get('args',[])]
+        params = dict((k,_decode(v,arrays,memo)) for k,v in spec['params'].items())
+        obj = memo[spec['__object__']] = _resolve(spec['class'])(*args,**params)
+        return obj
+    elif '__path__' in spec:
+        return _resolve(spec['__path__'])
+    elif '__pickle__' in spec:
+        return pickle.loads(np.asarray(arrays[spec['__pickle__']]).tobytes())
+    raise ValueError("Unknown specification %r" % (spec,))
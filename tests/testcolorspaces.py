@@ -0,0 +1,114 @@
+"""
+Unit tests for color space conversion.
+"""
+
+import colorsys
+import pickle
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+
+from imagen.colorspaces import ColorSpace, rgb_to_hsv, hsv_to_rgb, gamma_rgb
+
+
+def _colorsys_array(fn, ABC):
+    DEF = np.empty(ABC.shape)
+    for i in range(ABC.shape[0]):
+        for j in range(ABC.shape[1]):
+            DEF[i,j] = fn(*ABC[i,j])
+    return DEF
+
+
+class TestHSV(unittest.TestCase):
+
+    def setUp(self):
+        self.rgb = np.random.RandomState(0).rand(20,30,3)
+        # Gray pixels, pixels sharing a maximum, and hues just
+        # below red (which wrap around to hue 1)
+        self.rgb[0] = [0.4,0.4,0.4]
+        self.rgb[1,:10] = [0.0,0.0,0.0]
+        self.rgb[1,10:] = [0.8,0.8,0.2]
+        self.rgb[2] = [0.9,0.1,0.1000001]
+        self.hsv = np.random.RandomState(1).rand(20,30,3)
+        self.hsv[0,:,1] = 0
+        self.hsv[1,:,0] = [0.0,1.0,1/6.,5/6.,0.999999,0.5]*5
+
+    def test_rgb_to_hsv(self):
+        assert_array_almost_equal(rgb_to_hsv(self.rgb),
+                                  _colorsys_array(colorsys.rgb_to_hsv,self.rgb))
+
+    def test_hsv_to_rgb(self):
+        assert_array_almost_equal(hsv_to_rgb(self.hsv),
+                                  _colorsys_array(colorsys.hsv_to_rgb,self.hsv))
+
+    def test_out(self):
+        expected = rgb_to_hsv(self.rgb)
+        result = rgb_to_hsv(self.rgb,out=self.rgb)
+        self.assertTrue(result is self.rgb)
+        assert_array_almost_equal(result,expected)
+
+        expected = hsv_to_rgb(self.hsv)
+        hsv = self.hsv.astype(np.float32)
+        hsv_to_rgb(hsv,out=hsv)
+        self.assertEqual(hsv.dtype,np.float32)
+        assert_array_almost_equal(hsv,expected,decimal=5)
+
+
+class TestColorSpace(unittest.TestCase):
+
+    def setUp(self):
+        self.colorspace = ColorSpace()
+        # Dim colors, whose XYZ and LMS values are within limits
+        self.rgb = np.random.RandomState(0).rand(20,30,3).astype(np.float32)*0.5
+
+    def test_fused_plan(self):
+        """Consecutive linear conversions should be one matrix"""
+        plan = self.colorspace._plan('lms','rgb')
+        self.assertEqual([kind for kind,op in plan],['matrix'])
+        lms = self.colorspace.convert('rgb','lms',self.rgb)
+        assert_array_almost_equal(self.colorspace.convert('lms','rgb',lms),
+                                  self.colorspace.xyz_to_rgb(self.colorspace.lms_to_xyz(lms)),
+                                  decimal=5)
+
+    def test_direct_plan(self):
+        """Conversions should leave out stages undoing each other"""
+        self.assertEqual(self.colorspace._plan('rgb','hsv'),
+                         [('elementwise',gamma_rgb),('array',rgb_to_hsv)])
+        self.assertTrue(self.colorspace._plan('rgb','hsv') is
+                        self.colorspace._plan('rgb','hsv'))
+
+    def test_lookup(self):
+        """Integer images should convert as their fractions of the maximum"""
+        data = (np.random.RandomState(1).rand(20,30,3)*255).astype(np.uint8)
+        for from_,to in [('gammargb','xyz'),('gammargb','hsv'),('rgb','hsv'),('lms','rgb')]:
+            assert_array_almost_equal(self.colorspace.convert(from_,to,data),
+                                      self.colorspace.convert(from_,to,data/255.0),decimal=6)
+        data = data.astype(np.uint16)*257
+        assert_array_almost_equal(self.colorspace.convert('gammargb','hsv',data),
+                                  self.colorspace.convert('gammargb','hsv',data/65535.0),decimal=6)
+
+    def test_pickle(self):
+        data = (np.random.RandomState(1).rand(20,30,3)*255).astype(np.uint8)
+        expected = self.colorspace.convert('gammargb','hsv',data)
+        copy = pickle.loads(pickle.dumps(self.colorspace))
+        self.assertEqual(copy._tables,{})
+        assert_array_equal(copy.convert('gammargb','hsv',data),expected)
+
+        # As pickled before conversions were planned
+        state = self.colorspace.__getstate__()
+        del state['_plans'], state['_tables']
+        copy = ColorSpace.__new__(ColorSpace)
+        copy.__setstate__(state)
+        assert_array_equal(copy.convert('gammargb','hsv',data),expected)
+
+    def test_input_unchanged(self):
+        rgb = self.rgb.copy()
+        for space in ['xyz','lms','hsv','gammargb']:
+            self.colorspace.convert('rgb',space,rgb)
+            assert_array_equal(rgb,self.rgb)
+
+
+if __name__ == "__main__":
+    import nose
+    nose.runmodule()
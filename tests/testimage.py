@@ -0,0 +1,450 @@
+"""
+Unit tests for image patterns.
+"""
+
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+from PIL import Image
+
+import param
+import numbergen
+from imagen import Selector, ComposeChannels, Constant
+from imagen.image import FileImage, ImageCache, PatternSampler, AffineImageSampler, FastImageSampler
+from imagen.image import edge_average, image_cache, processed_image_cache, _read_pil_image
+from imagen.image import RotateHue, ScaleChannels
+from imagen.colorspaces import color_conversion
+from imagen.transferfn import DivisiveNormalizeLinf
+from imagen.imagepack import ArchiveImage, pack_images
+from imagen.patterncoordinator import PatternCoordinatorImages
+
+
+class TestPatternSampler(unittest.TestCase):
+
+    def test_index_cache(self):
+        """Sampling a cached geometry should give the same pattern"""
+        x,y = np.meshgrid(np.linspace(-0.7,0.7,12),np.linspace(0.7,-0.7,10))
+        uncached = PatternSampler(size_normalization='fit_longest',background_value_fn=np.mean,
+                                  index_cache_size=0)
+        sampler = PatternSampler(size_normalization='fit_longest',background_value_fn=np.mean)
+        for i in range(3):
+            image = np.random.RandomState(i).rand(20,30)
+            for width in [1.0,0.5]:
+                assert_array_equal(sampler(image,x,y,12.0,10.0,width),
+                                   uncached(image,x,y,12.0,10.0,width))
+        self.assertEqual(len(sampler._index_cache),2)
+        sampler(image,x+0.1,y,12.0,10.0,width)
+        self.assertEqual(len(sampler._index_cache),3)
+
+    def tearDown(self):
+        processed_image_cache.max_bytes = 0
+        processed_image_cache.clear()
+
+    def test_processed_cache(self):
+        """Images should be processed again only when they or the processing change"""
+        processed_image_cache.max_bytes = 2**20
+        x,y = np.meshgrid(np.linspace(-0.5,0.5,12),np.linspace(0.5,-0.5,10))
+        normalize = DivisiveNormalizeLinf()
+        sampler = PatternSampler(whole_pattern_output_fns=[normalize],
+                                 background_value_fn=edge_average)
+        images = [np.random.RandomState(i).rand(20,30) for i in range(2)]
+        for image in images:
+            image.flags.writeable = False
+        expected = [sampler(image.copy(),x,y,12.0,10.0) for image in images]
+        for i in range(2):
+            for image,result in zip(images,expected):
+                assert_array_equal(sampler(image,x,y,12.0,10.0),result)
+        self.assertEqual(len(processed_image_cache),2)
+
+        normalize.norm_value = 2.0
+        assert_array_almost_equal(sampler(images[0],x,y,12.0,10.0),2*expected[0])
+        del images[:], image
+        self.assertEqual(len(processed_image_cache),0)
+        self.assertEqual(processed_image_cache.nbytes,0)
+
+    def test_processed_cache_shared(self):
+        """The processed images of all samplers should be kept within one budget"""
+        x,y = np.meshgrid(np.linspace(-0.5,0.5,12),np.linspace(0.5,-0.5,10))
+        images = [np.random.RandomState(i).rand(20,30) for i in range(3)]
+        for image in images:
+            image.flags.writeable = False
+        samplers = [PatternSampler() for image in images]
+        for sampler,image in zip(samplers,images):
+            sampler(image,x,y,12.0,10.0)
+        self.assertEqual(len(processed_image_cache),0)
+
+        processed_image_cache.max_bytes = 2*images[0].nbytes
+        for sampler,image in zip(samplers,images):
+            sampler(image,x,y,12.0,10.0)
+        self.assertEqual(len(processed_image_cache),2)
+        self.assertEqual(processed_image_cache.nbytes,2*images[0].nbytes)
+
+
+    def test_mipmap(self):
+        """A mipmap should average the pixels between samples"""
+        x,y = np.meshgrid(np.linspace(-0.45,0.45,10),np.linspace(0.45,-0.45,10))
+        checks = np.indices((80,80)).sum(axis=0)%2*1.0
+        for sampler in [PatternSampler(size_normalization='fit_shortest',mipmap=True),
+                        AffineImageSampler(size_normalization='fit_shortest',mipmap=True)]:
+            assert_array_almost_equal(sampler(checks,x,y,10.0,10.0),0.5)
+            self.assertEqual(sorted(sampler._mipmaps),[1,2,4,8])
+            self.assertEqual(sampler._mipmaps[8].shape,(10,10))
+        image = np.random.RandomState(0).rand(20,30)
+        sampler = PatternSampler(mipmap=True)
+        assert_array_equal(sampler(image,x,y,10.0,10.0),PatternSampler()(image,x,y,10.0,10.0))
+
+    def test_fast_sampler(self):
+        """FastImageSampler should sample unrotated patterns as PatternSampler does"""
+        x,y = np.meshgrid(np.linspace(-0.6,0.6,12)+0.013,np.linspace(0.6,-0.6,10)+0.021)
+        rows,cols = np.indices((20,30))
+        for image in [np.random.RandomState(0).rand(20,30),0.02*rows+0.03*cols]:
+            for size_normalization in ['original','stretch_to_fit','fit_shortest','fit_longest']:
+                expected = PatternSampler(size_normalization=size_normalization,
+                                          background_value_fn=edge_average)(image,x,y,12.0,10.0,0.8,1.5)
+                sampler = FastImageSampler(size_normalization=size_normalization,
+                                           background_value_fn=edge_average)
+                assert_array_equal(sampler(image,x,y,12.0,10.0,0.8,1.5),expected)
+        sampler.sampling_method = Image.BILINEAR
+        assert_array_almost_equal(sampler(image,x,y,12.0,10.0,0.8,1.5),expected,1)
+        rotated = PatternSampler(size_normalization=size_normalization,
+                                 background_value_fn=edge_average)(image,y,x,12.0,10.0)
+        assert_array_almost_equal(sampler(image,y,x,12.0,10.0),rotated)
+
+    def test_fast_sampler_old_pillow(self):
+        """FastImageSampler should also work where resize takes no box or reducing_gap"""
+        x,y = np.meshgrid(np.linspace(-0.6,0.6,12),np.linspace(0.6,-0.6,10))
+        image = np.random.RandomState(0).rand(20,30)
+        sampler = FastImageSampler(reducing_gap=2.0,sampling_method=Image.BILINEAR)
+        expected = sampler(image,x,y,12.0,10.0)
+        resize = Image.Image.resize
+        def old_resize(self,size,resample=0):
+            return resize(self,size,resample)
+        Image.Image.resize = old_resize
+        try:
+            assert_array_almost_equal(sampler(image,x,y,12.0,10.0),expected,1)
+        finally:
+            Image.Image.resize = resize
+
+    def test_affine_sampler(self):
+        """AffineImageSampler should sample as PatternSampler does"""
+        x,y = np.meshgrid(np.linspace(-0.6,0.6,12),np.linspace(0.6,-0.6,10))
+        x,y = 0.8*x-0.6*y+0.0123, 0.6*x+0.8*y+0.0071
+        image = np.random.RandomState(0).rand(20,30)
+        for size_normalization in ['original','stretch_to_fit','fit_shortest','fit_longest']:
+            expected = PatternSampler(size_normalization=size_normalization,
+                                      background_value_fn=edge_average)
+            sampler = AffineImageSampler(size_normalization=size_normalization,
+                                         background_value_fn=edge_average)
+            assert_array_almost_equal(sampler(image,x,y,12.0,10.0,0.8,1.5),
+                                      expected(image,x,y,12.0,10.0,0.8,1.5))
+        sampler.interpolation = 'bilinear'
+        self.assertEqual(sampler(image,x,y,12.0,10.0).shape,x.shape)
+        assert_array_almost_equal(sampler(image,x**2,y,12.0,10.0),expected(image,x**2,y,12.0,10.0))
+
+
+
+class TestImageCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory,'image.png')
+        data = (np.random.RandomState(0).rand(20,30,3)*255).astype(np.uint8)
+        Image.fromarray(data).save(self.filename)
+        image_cache.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        image_cache.clear()
+
+    def draw(self, **params):
+        image = FileImage(filename=self.filename,xdensity=16,ydensity=16,**params)
+        return image(), image.channels(use_cached=True)
+
+    def test_shared_decoding(self):
+        """FileImages of the same file should decode it once"""
+        expected, expected_channels = self.draw(use_image_cache=False)
+        for i in range(3):
+            result, channels = self.draw()
+            assert_array_equal(result,expected)
+            for c in range(3):
+                assert_array_equal(channels[c],expected_channels[c])
+        self.assertEqual(image_cache.misses,1)
+        self.assertTrue(image_cache.hits>=2)
+        self.assertEqual(len(image_cache),1)
+
+    def test_modified_file(self):
+        """A file changed on disk should be loaded again"""
+        self.draw()
+        Image.fromarray(np.zeros((20,30),np.uint8)+100).save(self.filename)
+        os.utime(self.filename,(0,0))
+        result, channels = self.draw()
+        assert_array_equal(result,self.draw(use_image_cache=False)[0])
+        self.assertEqual(image_cache.misses,2)
+
+    def test_eviction(self):
+        """Entries should be discarded when the cache is over budget"""
+        cache = ImageCache(max_bytes=200)
+        a = cache.put('a',np.zeros(10))
+        self.assertFalse(a[0].flags.writeable)
+        cache.put('b',np.zeros(10))
+        cache.get('a')
+        cache.put('c',np.zeros(10))
+        self.assertEqual(cache.get('b'),None)
+        self.assertEqual(len(cache),2)
+        self.assertEqual(cache.stats()['nbytes'],160)
+        self.assertEqual(cache.evictions,1)
+        cache.put('d',np.zeros(100))
+        self.assertEqual(len(cache),2)
+
+    def test_prefetch(self):
+        """A Selector should decode the images it will select next"""
+        time_fn = param.Time()
+        images = [FileImage(filename=self.filename,use_image_cache=False)]
+        for i in range(4):
+            filename = os.path.join(self.directory,'%d.png' % i)
+            Image.fromarray(np.zeros((10,10),np.uint8)+i+1).save(filename)
+            images.append(FileImage(filename=filename,xdensity=16,ydensity=16))
+        image_cache.clear()
+
+        index = numbergen.UniformRandom(seed=1,time_dependent=True,time_fn=time_fn)
+        selector = Selector(generators=images,index=index,prefetch=3)
+        selector()
+        for pending in selector._prefetched.values():
+            pending[1].wait()
+        predicted = set()
+        for step in range(4):
+            with time_fn as t:
+                t(step)
+                predicted.add(images[int(5*index())].filename)
+        self.assertEqual(len(image_cache),len(predicted-set([self.filename])))
+        time_fn(1)
+        misses = image_cache.misses
+        selector()
+        self.assertEqual(image_cache.misses,misses)
+
+    def test_prefetch_reduced(self):
+        """Images should be prefetched at the resolution they are drawn at"""
+        time_fn = param.Time()
+        images = []
+        for i in range(4):
+            filename = os.path.join(self.directory,'%d.png' % i)
+            Image.fromarray(np.zeros((64,64),np.uint8)+i+1).save(filename)
+            images.append(FileImage(filename=filename,reduced_decoding=True,xdensity=4,ydensity=4))
+        image_cache.clear()
+
+        index = numbergen.UniformRandom(seed=1,time_dependent=True,time_fn=time_fn)
+        selector = Selector(generators=images,index=index,prefetch=2,xdensity=16,ydensity=16)
+        selector()
+        for item,pending in selector._prefetched.values():
+            pending.wait()
+        time_fn(2)
+        misses = image_cache.misses
+        selector()
+        self.assertEqual(image_cache.misses,misses)
+
+
+    def test_pickle(self):
+        """Pickled FileImages should not contain the image"""
+        image = FileImage(filename=self.filename,xdensity=16,ydensity=16,cache_image=True)
+        expected = image()
+        copy = pickle.loads(pickle.dumps(image))
+        self.assertTrue(copy._image is None)
+        self.assertEqual(copy._original_channel_data,[])
+        assert_array_equal(copy(),expected)
+
+        # As pickled before the decoding options were remembered
+        image = FileImage(filename=self.filename,xdensity=16,ydensity=16,reduced_decoding=True)
+        expected = image()
+        state = image.__getstate__()
+        del state['_last_options'], state['_last_size']
+        copy = FileImage.__new__(FileImage)
+        copy.__setstate__(state)
+        assert_array_equal(copy(),expected)
+
+    def test_reduced_decoding(self):
+        """Large images should be decoded near the resolution drawn"""
+        y,x = np.mgrid[0:384,0:512]
+        data = np.dstack([x/2.0,y/2.0,x/4.0+y/4.0]).astype(np.uint8)
+        for ext in ['.png','.jpg']:
+            filename = os.path.join(self.directory,'large'+ext)
+            Image.fromarray(data).save(filename)
+            expected = FileImage(filename=filename,xdensity=16,ydensity=16)()
+            image = FileImage(filename=filename,xdensity=16,ydensity=16,reduced_decoding=True)
+            assert_array_almost_equal(image(),expected,1)
+            self.assertEqual(image._last_options,(16,))
+            self.assertEqual(_read_pil_image(filename,16)[0].size,(32,24))
+            self.assertEqual(image(size=2).shape,expected.shape)
+            self.assertEqual(image._last_options,(8,))
+            # The full-resolution size is not read again for each draw
+            opened = []
+            def open_(*args,**kwargs):
+                opened.append(args)
+                return open_image(*args,**kwargs)
+            open_image, Image.open = Image.open, open_
+            try:
+                image(size=2)
+            finally:
+                Image.open = open_image
+            self.assertEqual(opened,[])
+
+    def test_reduced_decoding_without_reduce(self):
+        """Without Image.reduce (Pillow < 7), only the draft reduction is used"""
+        y,x = np.mgrid[0:384,0:512]
+        filename = os.path.join(self.directory,'large.png')
+        Image.fromarray((x/2.0).astype(np.uint8)).save(filename)
+        reduce_ = Image.Image.reduce
+        del Image.Image.reduce
+        try:
+            self.assertEqual(_read_pil_image(filename,16)[0].size,(512,384))
+        finally:
+            Image.Image.reduce = reduce_
+
+
+
+class TestNumpyImage(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.data = np.random.RandomState(0).rand(20,30,3)*4
+        np.save(os.path.join(self.directory,'image.npy'),self.data)
+        np.savez(os.path.join(self.directory,'image.npz'),other=self.data[:,:,0],image=self.data)
+        np.savez_compressed(os.path.join(self.directory,'compressed.npz'),self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        image_cache.clear()
+
+    def draw(self, filename, **params):
+        image = FileImage(filename=os.path.join(self.directory,filename),
+                          xdensity=16,ydensity=16,**params)
+        return [image()] + [image.channels(use_cached=True)[i] for i in range(image.num_channels())]
+
+    def test_sources(self):
+        """Memory-mapped and .npz arrays should give the same patterns"""
+        expected = self.draw('image.npy',memory_map=False,use_image_cache=False)
+        self.assertEqual(len(expected),4)
+        for filename,params in [('image.npy',{}),('image.npz',dict(npz_array='image')),
+                                ('compressed.npz',{})]:
+            for a,b in zip(self.draw(filename,**params),expected):
+                assert_array_equal(a,b)
+
+    def test_two_dimensional(self):
+        """A 2D array should give a single-channel image"""
+        result = self.draw('image.npz')
+        self.assertEqual(len(result),1)
+        assert_array_almost_equal(result[0],self.draw('image.npy')[1])
+
+    def test_channels_before_drawing(self):
+        """The loaded channels should be arrays before the first drawing"""
+        image = FileImage(filename=os.path.join(self.directory,'image.npy'))
+        channels = image.channels(use_cached=True)
+        for i in range(3):
+            self.assertTrue(isinstance(channels[i],np.ndarray))
+            assert_array_almost_equal(channels[i],self.data[:,:,i]/self.data.max())
+
+
+
+class TestImageArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.archive = os.path.join(self.directory,'images.imagepack')
+        data = (np.random.RandomState(0).rand(40,60,3)*255).astype(np.uint8)
+        self.filenames = []
+        for name,image in [('color.png',data),('gray.png',data[:,:,1])]:
+            self.filenames.append(os.path.join(self.directory,name))
+            Image.fromarray(image).save(self.filenames[-1])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        image_cache.clear()
+
+    def draw(self, image):
+        return [image()] + [image.channels(use_cached=True)[i] for i in range(image.num_channels())]
+
+    def test_archive_image(self):
+        """Images read from an archive should be those read from the files"""
+        pack_images(self.filenames,self.archive,['color','gray'],reductions=(1,2),processes=2)
+        for filename,name in zip(self.filenames,['color','gray']):
+            for reduced in [False,True]:
+                expected = self.draw(FileImage(filename=filename,xdensity=16,ydensity=16,
+                                               reduced_decoding=reduced))
+                image = ArchiveImage(filename=self.archive,member=name,xdensity=16,ydensity=16,
+                                     reduced_decoding=reduced)
+                result = self.draw(image)
+                self.assertEqual(image._last_options,(name,2 if reduced else 1))
+                self.assertEqual(len(result),len(expected))
+                for a,b in zip(result,expected):
+                    assert_array_almost_equal(a,b)
+
+    def test_pattern_coordinator(self):
+        """PatternCoordinatorImages should read a packed dataset"""
+        PatternCoordinatorImages(self.directory,patterns_per_label=2).pack(self.archive,processes=1)
+        for filename in self.filenames:
+            os.remove(filename)
+        selector = PatternCoordinatorImages(self.directory,archive=self.archive,
+                                            patterns_per_label=2)()['Input']
+        self.assertEqual([pg.member for pg in selector.generators],['color.png','gray.png'])
+        self.assertEqual(selector(xdensity=8,ydensity=8).shape,(8,8))
+
+
+class TestChannelTransforms(unittest.TestCase):
+
+    def setUp(self):
+        data = np.random.RandomState(0).rand(10,12,3)*0.8
+        self.channels = [data[:,:,i].copy() for i in range(3)]
+
+    def test_rotate_hue(self):
+        """RotateHue should convert the channels in a single buffer"""
+        cc = color_conversion
+        analysis = cc.working2analysis(cc.image2working(np.dstack(self.channels)))
+        cc.jitter_hue(analysis,0.3)
+        cc.multiply_sat(analysis,0.5)
+        expected = cc.analysis2working(analysis)
+
+        channels = RotateHue(rotation=0.3,saturation=0.5)(list(self.channels))
+        for i in range(3):
+            assert_array_almost_equal(channels[i],expected[:,:,i])
+            self.assertTrue(channels[i].flags.c_contiguous)
+            self.assertTrue(channels[i].base is channels[0].base)
+
+        again = RotateHue(rotation=0,saturation=1.0)(list(channels))
+        self.assertTrue(again[0].base is channels[0].base)
+
+    def test_scale_channels(self):
+        """ScaleChannels should only change arrays written by a transform"""
+        originals = [c.copy() for c in self.channels]
+        expected = [np.minimum(c*f,1.0) for c,f in zip(self.channels,[1.5,0.5,2.0])]
+        result = ScaleChannels(channel_factors=[1.5,0.5,2.0])(list(self.channels))
+        for i in range(3):
+            assert_array_equal(result[i],expected[i])
+            assert_array_equal(self.channels[i],originals[i])
+
+        rotated = RotateHue(rotation=0)(list(self.channels))
+        result = ScaleChannels(channel_factors=[1.5,0.5,2.0])(list(rotated))
+        for i in range(3):
+            self.assertTrue(result[i] is rotated[i])
+
+    def test_scale_cached_channels(self):
+        """Scaling should not accumulate in an image cached by a generator"""
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory,'image.png')
+            Image.fromarray(np.full((8,8),200,dtype=np.uint8)).save(filename)
+            pattern = ComposeChannels(generators=[FileImage(filename=filename,cache_image=True),
+                                                  Constant(scale=1.0)],
+                                      channel_transforms=[ScaleChannels(channel_factors=[0.5,0.5])])
+            maxima = [pattern().max() for i in range(3)]
+            self.assertEqual(maxima,[0.5]*3)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    import nose
+    nose.runmodule()
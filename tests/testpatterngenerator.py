@@ -6,6 +6,7 @@ Original written as a unit test as part of the Topographica project.
 """
 
 import os
+import json
 import unittest
 
 
@@ -13,10 +14,14 @@ cwd = os.path.abspath(os.path.split(__file__)[0])
 
 import param
 import numpy as np
-from numpy.testing import assert_array_equal
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+from holoviews import Image
 from holoviews.core.boundingregion import BoundingBox
-from imagen import Constant,PatternGenerator
-from imagen import Rectangle,Gaussian,Composite,Selector
+from imagen import Constant,PatternGenerator,GeneratorSpec
+from imagen import Rectangle,RawRectangle,Gaussian,Disk,Composite,Selector,Sweeper,ComposeChannels
+from imagen.spec import to_spec, from_spec
+from imagen.patterngenerator import _RenderContext
+from imagen.transferfn import DivisiveNormalizeLinf
 import numbergen
 
 
@@ -203,6 +208,172 @@ class TestPatternGenerator(unittest.TestCase):
 
     # Should also test rotating, resizing...
 
+    def test_composite_instances(self):
+        """
+        Test that generators rendered together as instances give the
+        same result as generators rendered one at a time.
+        """
+        bbox=BoundingBox(radius=0.5)
+        def generators():
+            return [Gaussian(size=0.1,x=0.1*i-0.2,y=0.05*i,orientation=0.3*i,scale=1+0.1*i)
+                    for i in range(5)] + [Rectangle(size=0.2,x=0.1)]
+
+        for operator in [np.add,np.maximum]:
+            c = Composite(generators=generators(),operator=operator,orientation=0.4,size=1.3,
+                          instance_chunk_pixels=200,bounds=bbox,xdensity=10,ydensity=10)
+            c_separate = Composite(generators=generators(),operator=operator,orientation=0.4,size=1.3,
+                                   instanced=False,bounds=bbox,xdensity=10,ydensity=10)
+            assert_array_almost_equal(c(),c_separate())
+
+    def test_composite_instances_untimed(self):
+        """
+        Test that generators with untimed dynamic values draw the same
+        values whether or not instancing is enabled.
+        """
+        bbox=BoundingBox(radius=0.5)
+        def generators():
+            return [Gaussian(size=0.1,x=0.1*i-0.2,
+                             aspect_ratio=numbergen.UniformRandom(lbound=0.5,ubound=2,seed=i))
+                    for i in range(5)]
+
+        c = Composite(generators=generators(),operator=np.add,
+                      instance_chunk_pixels=200,bounds=bbox,xdensity=10,ydensity=10)
+        c_separate = Composite(generators=generators(),operator=np.add,
+                               instanced=False,bounds=bbox,xdensity=10,ydensity=10)
+        assert_array_almost_equal(c(),c_separate())
+
+    def test_composite_operator_order(self):
+        """
+        Test that a non-commutative operator is applied to the
+        generators in order.
+        """
+        bbox=BoundingBox(radius=0.5)
+        gs = [Gaussian(size=0.2,x=0.1*i) for i in range(3)]
+        c = Composite(generators=gs,operator=np.subtract,bounds=bbox,xdensity=7,ydensity=7)
+        arrays = [g(bounds=bbox,xdensity=7,ydensity=7) for g in gs]
+        assert_array_almost_equal(c(),arrays[0]-arrays[1]-arrays[2])
+
+    def test_composite_bool_patterns(self):
+        """
+        Test that combining boolean patterns gives the same type of
+        result as reducing them all at once.
+        """
+        bbox=BoundingBox(radius=0.5)
+        gs = [RawRectangle(size=0.4,x=0.05*i) for i in range(3)]
+        arrays = [g(bounds=bbox,xdensity=10,ydensity=10) for g in gs]
+        for operator in [np.add,np.maximum]:
+            c = Composite(generators=gs,operator=operator,instanced=False,
+                          bounds=bbox,xdensity=10,ydensity=10)
+            result = c()
+            assert_array_equal(result,operator.reduce(arrays))
+            self.assertEqual(result.dtype,operator.reduce(arrays).dtype)
+
+    def test_getitem_region(self):
+        """
+        Test that looking up part of a pattern gives the same result
+        as looking it up in an Image of the whole pattern.
+        """
+        bbox=BoundingBox(points=((-0.4,-0.3),(0.5,0.6)))
+        g = Gaussian(size=0.3,x=0.1,orientation=0.3,scale=2,offset=0.1,
+                     bounds=bbox,xdensity=13,ydensity=11)
+        image = Image(g(),bounds=bbox)
+        self.assertAlmostEqual(g[0.12,0.03],image[0.12,0.03])
+        for coords in [(slice(-0.2,0.13),slice(0,0.3)),(slice(None,0.2),0.1),
+                       (0.0,slice(-0.1,None))]:
+            assert_array_almost_equal(g[coords].data,image[coords].data)
+            assert_array_almost_equal(g[coords].bounds.lbrt(),image[coords].bounds.lbrt())
+
+    def test_composite_mask_once(self):
+        """
+        Test that applying a binary mask only once gives the same
+        result as applying it to every generator.
+        """
+        bbox=BoundingBox(radius=0.5)
+        def generators():
+            return [Gaussian(size=0.3,x=0.1),Gaussian(size=0.2,y=0.1),Rectangle(size=0.3),
+                    Composite(generators=[Gaussian(size=0.1,x=-0.1)])]
+
+        mask = np.zeros((10,10))
+        mask[2:6,3:8] = 1.0
+        for masking in [dict(mask_shape=Disk(size=0.5,smoothing=0.0,x=0.1)),dict(mask=mask)]:
+            for operator in [np.add,np.maximum,np.multiply,np.subtract]:
+                c_once = Composite(generators=generators(),operator=operator,mask_mode='once',
+                                   orientation=0.3,bounds=bbox,xdensity=10,ydensity=10,**masking)
+                c = Composite(generators=generators(),operator=operator,
+                              orientation=0.3,bounds=bbox,xdensity=10,ydensity=10,**masking)
+                assert_array_almost_equal(c_once(),c())
+
+    def test_composite_shared_generator(self):
+        """
+        Test that a generator appearing more than once in a Composite
+        is drawn only once, with the same result.
+        """
+        class CountingGaussian(Gaussian):
+            calls = 0
+            def function(self,p):
+                CountingGaussian.calls += 1
+                return super(CountingGaussian,self).function(p)
+
+        bbox=BoundingBox(radius=0.5)
+        for output_fns in [[],[DivisiveNormalizeLinf()]]:
+            CountingGaussian.calls = 0
+            g = CountingGaussian(size=0.2,x=0.1,output_fns=output_fns)
+            c = Composite(generators=[g,Rectangle(size=0.3),g],operator=np.add,instanced=False,
+                          bounds=bbox,xdensity=8,ydensity=8)
+            result = c()
+            self.assertEqual(CountingGaussian.calls,1)
+            assert_array_almost_equal(result,2*g(bounds=bbox,xdensity=8,ydensity=8)+
+                                      Rectangle(size=0.3)(bounds=bbox,xdensity=8,ydensity=8))
+
+    def test_shared_coordinates_read_only(self):
+        """
+        Test that coordinate arrays shared within a Composite or reused
+        by a compiled pattern cannot be modified in place, while those
+        of a lone generator can.
+        """
+        class ShiftingGaussian(Gaussian):
+            def function(self,p):
+                self.pattern_x += 0.1
+                return super(ShiftingGaussian,self).function(p)
+
+        ShiftingGaussian(xdensity=4,ydensity=4)()
+        c = Composite(generators=[ShiftingGaussian(),Gaussian()],xdensity=4,ydensity=4)
+        self.assertRaises(ValueError,c)
+        self.assertRaises(ValueError,ShiftingGaussian().compile(xdensity=4,ydensity=4))
+
+    def test_sample(self):
+        """
+        Test that sampling a pattern at the centers of the matrix
+        units gives the same result as drawing it.
+        """
+        bbox=BoundingBox(radius=0.5)
+        x,y = np.meshgrid(np.linspace(-0.45,0.45,10),np.linspace(0.45,-0.45,10))
+        g = Composite(generators=[Gaussian(size=0.2,x=0.2),Rectangle(size=0.3,orientation=0.5)],
+                      orientation=0.4,size=1.2,x=0.1,operator=np.maximum,
+                      mask_shape=Gaussian(size=0.5))
+        assert_array_almost_equal(g.sample(x,y),g(bounds=bbox,xdensity=10,ydensity=10))
+        assert_array_almost_equal(g.sample(x[3],y[3]),g(bounds=bbox,xdensity=10,ydensity=10)[3])
+
+    def test_compile(self):
+        """
+        Test that a compiled pattern gives the same result as the
+        pattern itself, including after updating parameters.
+        """
+        bbox=BoundingBox(radius=0.5)
+        for g in [Gaussian(size=0.2,x=0.1,orientation=0.3,scale=2,offset=0.1),
+                  Rectangle(size=0.3,mask_shape=Gaussian(size=0.5,x=0.1))]:
+            plan = g.compile(bounds=bbox,xdensity=10,ydensity=10)
+            assert_array_equal(plan(),g(bounds=bbox,xdensity=10,ydensity=10))
+            plan.update(x=-0.2,size=0.4)
+            assert_array_equal(plan(),g(x=-0.2,size=0.4,bounds=bbox,xdensity=10,ydensity=10))
+
+    def test_compile_dynamic(self):
+        """Test that a compiled pattern follows dynamic parameters."""
+        g = Gaussian(x=numbergen.UniformRandom(lbound=-0.5,ubound=0.5,seed=1))
+        g.set_dynamic_time_fn(None)
+        plan = g.compile(xdensity=10,ydensity=10)
+        self.assertFalse(np.array_equal(plan(),plan()))
+
     def test_bug__dynamic_param_advanced_by_repr(self):
         """Check for bug where repr of a PatternGenerator causes a DynamicNumber to change."""
         # CEB: can probably remove this test now we have time-controlled dynamic parameters
@@ -223,6 +394,62 @@ class TestPatternGenerator(unittest.TestCase):
 
 
 
+class TestSweeper(unittest.TestCase):
+
+    def frames(self, fast_translation, generator=None, channels=False, **params):
+        if generator is None:
+            generator = Gaussian(size=0.1,aspect_ratio=3)
+        params = dict(dict(reset_period=4,bounds=BoundingBox(radius=0.5),
+                           xdensity=24,ydensity=24),**params)
+        sweeper = Sweeper(generator=generator,fast_translation=fast_translation,**params)
+        frames = []
+        with param.Dynamic.time_fn as t:
+            for i in range(6):
+                t(i)
+                frames.append(sweeper())
+                if channels:
+                    frames.extend(sweeper._channel_data)
+        return frames
+
+    def test_translation_integer(self):
+        """Frames shifted by whole units should match drawing each frame."""
+        for params in [dict(speed=1/24.),dict(speed=2/24.,orientation=0.3,relative_motion_orientation=0)]:
+            for a,b in zip(self.frames('integer',**params),self.frames('none',**params)):
+                assert_array_almost_equal(a,b)
+
+    def test_old_pickle(self):
+        """Sweepers pickled without the translation cache should still draw."""
+        sweeper = Sweeper(xdensity=8,ydensity=8)
+        state = sweeper.__getstate__()
+        for name in ['_translations','_episode_key','_episode']:
+            del state[name]
+        copy = Sweeper.__new__(Sweeper)
+        copy.__setstate__(state)
+        assert_array_equal(copy(),sweeper())
+
+    def test_translation_fourier(self):
+        """Subunit shifts of a smooth pattern should match approximately."""
+        params = dict(speed=0.03,relative_motion_orientation=0.7)
+        for a,b in zip(self.frames('fourier',**params),self.frames('none',**params)):
+            assert_array_almost_equal(a,b,decimal=2)
+
+    def test_precompute_episodes(self):
+        """Precomputed episodes should match drawing each frame."""
+        generators = [lambda: Gaussian(size=0.1,aspect_ratio=3,mask=np.ones((24,24))),
+                      lambda: Composite(generators=[Gaussian(size=0.1),Disk(size=0.2,x=0.1)],
+                                        mask_shape=Disk(size=0.6),operator=np.add),
+                      lambda: ComposeChannels(generators=[Gaussian(size=0.1),Disk(size=0.2)])]
+        for generator in generators:
+            for params in [dict(speed=0.03),dict(reset_period=2.5,step_offset=1),
+                           dict(speed=0.03,episode_block_bytes=1)]:
+                a = self.frames('none',generator(),channels=True,precompute_episodes=True,**params)
+                b = self.frames('none',generator(),channels=True,**params)
+                self.assertEqual(len(a),len(b))
+                for x,y in zip(a,b):
+                    assert_array_almost_equal(x,y)
+
+
+
 # CB: does not test most features of Selector!
 class TestSelector(unittest.TestCase):
 
@@ -232,6 +459,27 @@ class TestSelector(unittest.TestCase):
         self.s = Selector(generators=[self.g1,self.g2])
         self.s.set_dynamic_time_fn(None,'generators')
 
+    def test_no_render_context(self):
+        """Drawing the selected generator should not set up a render context"""
+        contexts = []
+        class ContextGaussian(Gaussian):
+            def function(self,p):
+                contexts.append(_RenderContext.current())
+                return super(ContextGaussian,self).function(p)
+
+        Selector(generators=[ContextGaussian(),ContextGaussian()])()
+        self.assertEqual(contexts,[None])
+
+    def test_old_pickle(self):
+        """Selectors pickled without the pattern cache should still draw"""
+        selector = Selector(generators=[Gaussian(),Disk()],index=0,cache_size=2)
+        state = selector.__getstate__()
+        for name in ['_cache','_prefetched','_prefetch_pool']:
+            del state[name]
+        copy = Selector.__new__(Selector)
+        copy.__setstate__(state)
+        assert_array_equal(copy(),selector())
+
     def test_dynamic_index(self):
         """index should always vary"""
         self.assertNotEqual(self.s.index,self.s.index)
@@ -240,6 +488,85 @@ class TestSelector(unittest.TestCase):
         """time_fn should have been applied to subpatterns"""
         self.assertNotEqual(self.g1.x,self.g1.x)
 
+    def test_generator_spec(self):
+        """GeneratorSpecs should be replaced by their generators when selected"""
+        def moved(pg, x):
+            pg.x = x
+            return pg
+
+        s = Selector(generators=[GeneratorSpec(Gaussian,size=0.2),
+                                 GeneratorSpec(Disk,size=0.3).apply(moved,0.1)],
+                     index=0.75,xdensity=8,ydensity=8)
+        self.assertTrue(isinstance(s.generators[0],GeneratorSpec))
+        assert_array_almost_equal(s(),Disk(size=0.3,x=0.1)(xdensity=8,ydensity=8))
+        self.assertTrue(isinstance(s.generators[0],GeneratorSpec))
+        self.assertTrue(isinstance(s.generators[1],Disk))
+
+    def test_prefetch_generator_spec(self):
+        """Predicted GeneratorSpecs should be created in the background"""
+        time_fn = param.Time()
+        index = numbergen.UniformRandom(seed=1,time_dependent=True,time_fn=time_fn)
+        s = Selector(generators=[GeneratorSpec(Selector,generators=[Disk(size=0.3)]),
+                                 GeneratorSpec(Gaussian,size=0.2)],
+                     index=index,prefetch=2,xdensity=8,ydensity=8)
+        s()
+        for item,pending in s._prefetched.values():
+            self.assertTrue(isinstance(pending.get(),(Selector,Gaussian)))
+        s.prefetch = 0
+        s()
+        self.assertTrue(s._prefetch_pool is None)
+
+    def test_cache(self):
+        """Selecting the same generator again should reuse the drawn pattern"""
+        class CountingGaussian(Gaussian):
+            calls = 0
+            def function(self,p):
+                CountingGaussian.calls += 1
+                return super(CountingGaussian,self).function(p)
+
+        g = CountingGaussian(size=0.2)
+        s = Selector(generators=[g,Disk()],index=0.25,cache_size=2,xdensity=8,ydensity=8)
+        expected = g(xdensity=8,ydensity=8)
+        CountingGaussian.calls = 0
+        first = s()
+        first += 1
+        assert_array_almost_equal(s(),expected)
+        self.assertEqual(CountingGaussian.calls,1)
+        s.index = 0.75
+        s()
+        s.index = 0.25
+        s(x=0.1)
+        self.assertEqual(CountingGaussian.calls,2)
+        g.size = 0.3
+        s()
+        self.assertEqual(CountingGaussian.calls,3)
+        self.assertEqual(len(s._cache),2)
+
+
+
+class TestSpec(unittest.TestCase):
+
+    def test_round_trip(self):
+        """Generators created from a specification should draw the same patterns"""
+        time_fn = param.Time()
+        x = numbergen.UniformRandom(seed=3,time_dependent=True,time_fn=time_fn)
+        size = numbergen.UniformRandom(seed=5,time_dependent=True,time_fn=time_fn)+0.1
+        pg = Composite(generators=[Gaussian(x=x,size=size,aspect_ratio=0.5),
+                                   Selector(generators=[Disk(y=x),Constant(scale=0.3)],index=0.6)],
+                       operator=np.maximum,xdensity=10,ydensity=10)
+        spec,arrays = to_spec(pg)
+        copy = from_spec(json.loads(json.dumps(spec)),arrays)
+
+        gaussian = copy.generators[0]
+        copied_x = gaussian.get_value_generator('x')
+        self.assertTrue(copied_x is copy.generators[1].generators[0].get_value_generator('y'))
+        self.assertTrue(copied_x.time_fn is gaussian.get_value_generator('size').lhs.time_fn)
+        for t in range(3):
+            time_fn(t)
+            copied_x.time_fn(t)
+            assert_array_equal(copy(),pg())
+
+
 if __name__ == "__main__":
     import nose
     nose.runmodule()